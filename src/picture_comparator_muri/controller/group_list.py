@@ -52,12 +52,43 @@ class GroupList:
         with self.selection.select_manually:
             self.selection.clear()
         image_group.clear_markings()
+        if self.image_group is not None and self.image_group is not image_group:
+            # Decoded images are kept only for the group which is shown.
+            for image in self.image_group:
+                image.release_handle()
         self.image_group = image_group
         self.image_group.set_identical()
         self.images.replace(image_group)
         self.comparator.reset()
         self.update_selection()
 
+    def update_group(self):
+        """
+        Shows current list of images of the group, after it was changed by the search. Images which are still in the
+        group keep their markings. Selection is reset only if marked or selected images were removed.
+        """
+        current = set(map(id, self.image_group))
+        removed = [image for image in self.images if id(image) not in current]
+        reset = any(image.selected or image.marked_for_deletion for image in removed)
+        for image in removed:
+            image.selected = False
+            image.marked_for_deletion = False
+            image.release_handle()
+        self.image_group.set_identical()
+        self.images.replace(self.image_group)
+        self.delete_button.setEnabled(self.image_group.has_marked())
+        if reset:
+            with self.selection.select_manually:
+                self.selection.clear()
+            for image in self.image_group:
+                image.selected = False
+            self.comparator.reset()
+            self.update_selection()
+        else:
+            # Changing images breaks selection model, so selected images are selected again.
+            self.selection.new_selection(self.selection.get_indexes_of_elements(
+                [image for image in self.images if image.selected]))
+
     def update_selection(self):
         index = self.list_view.model().createIndex(-1, -1)
         selection = QItemSelection(index, index)
@@ -0,0 +1,161 @@
+import json
+import signal
+import sys
+from itertools import combinations
+from typing import Dict, List, TextIO, Optional, Tuple
+
+from PySide6.QtCore import QObject, Slot, QCoreApplication, QTimer
+
+from picture_comparator_muri.controller.settings import Settings
+from picture_comparator_muri.model.hashing import packed_distance
+from picture_comparator_muri.model.image_group import ImageGroup
+from picture_comparator_muri.model.image_info import ImageInfo
+from picture_comparator_muri.model.search_engine import SearchEngine
+
+
+class HeadlessApplication(QObject):
+    """
+    Runs the search without any window and writes results as NDJSON: one JSON object per line, each with "event" key:
+    - "error": file couldn't be loaded,
+    - "group_added", "group_changed", "groups_merged", "group_removed": changes of groups, made while the scan is
+      running (with streaming) and later, in watch mode,
+    - "group": group found when the search finished, written instead of its changes during the scan with --final-only
+      or when groups aren't streamed,
+    - "scan_finished": the scan is over, with ids of all groups, from the most similar,
+    - "search_failed": the search was ended by an error, so it won't be finished.
+    Groups are identified by "id", which stays the same while the group changes.
+    """
+    def __init__(self, args, output: TextIO):
+        super().__init__()
+        self.settings = Settings(args)
+        self.output: TextIO = output
+        self.search_engine = SearchEngine(self.settings)
+        # Number and the group itself (so id() of its object isn't reused) by id() of the group.
+        self.group_ids: Dict[int, Tuple[int, ImageGroup]] = {}
+        self._next_group_id: int = 0
+        # Changes of groups made during the scan are skipped with --final-only, groups are written when it's finished.
+        self.writing_changes: bool = not self.settings.final_only
+        self.search_engine.LoadingImageFailed.connect(self.loading_image_failed)
+        self.search_engine.ResultsReady.connect(self.results_ready)
+        self.search_engine.SearchFailed.connect(self.search_failed)
+        self.search_engine.GroupAdded.connect(self.group_added)
+        self.search_engine.GroupChanged.connect(self.group_changed)
+        self.search_engine.GroupsMerged.connect(self.groups_merged)
+        self.search_engine.GroupRemoved.connect(self.group_removed)
+
+    def start(self):
+        self.search_engine.start_comparison()
+
+    def stop(self):
+        if self.search_engine.search_thread is not None:
+            self.search_engine.stop()
+
+    def _write(self, data: dict):
+        self.output.write(json.dumps(data) + '\n')
+        self.output.flush()
+
+    def _group_id(self, group: ImageGroup) -> int:
+        if id(group) not in self.group_ids:
+            self.group_ids[id(group)] = (self._next_group_id, group)
+            self._next_group_id += 1
+        return self.group_ids[id(group)][0]
+
+    @staticmethod
+    def _image_data(image: ImageInfo) -> dict:
+        width, height = image.dimensions or (None, None)
+        return {
+            'path': image.path,
+            'size': image.file_size,
+            'width': width,
+            'height': height,
+            'alias_of': image.alias_of.path if image.alias_of is not None else None,
+            # Images with identical pixels in the group have the same number, None if there are no other such images.
+            'identical': image.identical_group
+        }
+
+    def _write_group(self, event: str, group: ImageGroup, images: Optional[List[ImageInfo]] = None, **data):
+        images = images if images is not None else group.images
+        group.set_identical()
+        index_of = {id(image): i for i, image in enumerate(images)}
+        self._write({
+            'event': event,
+            'id': self._group_id(group),
+            'images': [self._image_data(image) for image in images],
+            'score': group.score,  # Lowest structural similarity of pixels, if they were compared
+            # Pairs of indices in the list of images and number of bits by which their hashes differ.
+            'distances': [[i, j, packed_distance(a.hash, b.hash)]
+                          for (i, a), (j, b) in combinations(enumerate(images), 2)],
+            # Pairs of indices of images which are similar after the first one is rotated or mirrored, with the name
+            # of the transform (e.g. "rotate90", counterclockwise), and of cropped copies, with "crop".
+            'transforms': [[index_of[id(a)], index_of[id(b)], transform] for a, b, transform in group.transforms
+                           if id(a) in index_of and id(b) in index_of],
+            **data
+        })
+
+    @Slot()
+    def loading_image_failed(self, reason: str, path: str):
+        self._write({'event': 'error', 'path': path, 'error': reason})
+
+    @Slot()
+    def results_ready(self, groups: List[ImageGroup]):
+        for group in groups:
+            if id(group) not in self.group_ids:
+                self._write_group('group', group)
+        self._write({'event': 'scan_finished', 'groups': [self._group_id(group) for group in groups]})
+        self.writing_changes = True
+        if not self.settings.watch:
+            self.search_engine.search_thread.wait()
+            QCoreApplication.quit()
+
+    @Slot()
+    def search_failed(self, error: str):
+        self._write({'event': 'search_failed', 'error': error})
+        QCoreApplication.exit(1)
+
+    @Slot()
+    def group_added(self, group: ImageGroup):
+        if self.writing_changes:
+            self._write_group('group_added', group)
+
+    @Slot()
+    def group_changed(self, group: ImageGroup, images: List[ImageInfo]):
+        group.replace_images(images)
+        if self.writing_changes:
+            self._write_group('group_changed', group)
+
+    @Slot()
+    def groups_merged(self, group: ImageGroup, images: List[ImageInfo], merged: List[ImageGroup]):
+        group.replace_images(images)
+        if not self.writing_changes:
+            return
+        self._write_group('groups_merged', group, merged=[self._group_id(g) for g in merged])
+        for merged_group in merged:
+            del self.group_ids[id(merged_group)]
+
+    @Slot()
+    def group_removed(self, group: ImageGroup):
+        if self.writing_changes:
+            self._write({'event': 'group_removed', 'id': self._group_id(group)})
+            del self.group_ids[id(group)]
+
+
+def run_headless(args) -> int:
+    app = QCoreApplication([])
+    output = open(args.output, 'w') if args.output else sys.stdout
+    # Diagnostic messages are printed, so they mustn't mix with results written to standard output.
+    sys.stdout = sys.stderr
+    try:
+        application = HeadlessApplication(args, output)
+        signal.signal(signal.SIGINT, lambda *_: QCoreApplication.quit())
+        # Python handles signals only when it runs, which doesn't happen while Qt waits for events.
+        timer = QTimer()
+        timer.timeout.connect(lambda: None)
+        timer.start(500)
+        application.start()
+        code = app.exec()
+        application.stop()
+        return code
+    finally:
+        sys.stdout = sys.__stdout__
+        if output is not sys.__stdout__:
+            output.close()
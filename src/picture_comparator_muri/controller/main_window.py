@@ -7,7 +7,6 @@ from picture_comparator_muri.controller.group_list import GroupList
 from picture_comparator_muri.controller.log import LogController
 from picture_comparator_muri.controller.matches import MatchesController
 from picture_comparator_muri.controller.settings import Settings
-from picture_comparator_muri.model.image_info import ImageInfo
 from picture_comparator_muri.model.log_engine import LogMessage, LogType
 from picture_comparator_muri.model.search_engine import SearchEngine
 from picture_comparator_muri.view.main_window import MainWindow
@@ -34,6 +33,7 @@ class MainWindowController:
         # self.window.ui.stacked_thumbs_button.clicked.connect(self.set_stack_thumbs)
         self.search_engine.ImageFound.connect(self.image_found)
         self.search_engine.LoadingImageFailed.connect(self.loading_image_failed)
+        self.search_engine.SearchFailed.connect(self.search_failed)
 
         self.comparator.compare_widget.ImageHoverChanged.connect(self.display_path_on_statusbar)
         self.group_list.list_view.ImageHoverChanged.connect(self.display_path_on_statusbar)
@@ -57,13 +57,17 @@ class MainWindowController:
     #     self.window.ui.matches_stack.setCurrentIndex(1)
 
     @Slot()
-    def image_found(self, image: ImageInfo):
-        self.log.log_message(LogMessage(LogType.INFO, f"Image found: {image.path}", True))
+    def image_found(self, path: str):
+        self.log.log_message(LogMessage(LogType.INFO, f"Image found: {path}", True))
 
     @Slot()
     def loading_image_failed(self, reason: str, path: str):
         self.log.log_message(LogMessage(LogType.ERROR, f"Could not load '{path}'. {reason}.", True))
 
+    @Slot()
+    def search_failed(self, error: str):
+        self.log.log_message(LogMessage(LogType.ERROR, f"Search failed. {error}.", True))
+
     @Slot()
     def display_path_on_statusbar(self, path: str):
         self.window.ui.statusbar.showMessage(path)
@@ -1,12 +1,13 @@
 import math
-from typing import List, Optional
+from typing import List, Optional, Dict
 
-from PySide6.QtCore import Slot, Qt, QItemSelection, QItemSelectionModel
-from PySide6.QtWidgets import QHBoxLayout, QPushButton, QButtonGroup, QScrollBar
+from PySide6.QtCore import Slot, Qt, QItemSelection, QItemSelectionModel, QTimer
+from PySide6.QtWidgets import QHBoxLayout, QPushButton, QButtonGroup, QScrollBar, QSlider, QLabel
 
 from picture_comparator_muri.controller.group_list import GroupList
 from picture_comparator_muri.controller.log import LogController
 from picture_comparator_muri.model.image_group import ImageGroup
+from picture_comparator_muri.model.image_info import ImageInfo
 from picture_comparator_muri.model.log_engine import LogMessage, LogType
 from picture_comparator_muri.model.search_engine import SearchEngine
 from picture_comparator_muri.model.utils import first
@@ -17,6 +18,7 @@ from picture_comparator_muri.view.matches_view import MatchesListView
 
 class MatchesController:
     GROUPS_PER_PAGE = 20
+    REFRESH_INTERVAL = 100  # Milliseconds for which changes of groups streamed by the search are gathered
 
     def __init__(self, main_window_controller):
         self.main_window_controller = main_window_controller
@@ -27,12 +29,41 @@ class MatchesController:
         self.list_view_model = WatchedListModel()
         self.log: LogController = self.main_window_controller.log
 
-        self.all_groups: List[ImageGroup] = []
+        self.all_groups: List[Optional[ImageGroup]] = []  # Dropped groups are None until the next refresh
+        # Position of each group in all_groups, by id of the group object. ImageGroup compares content, but here the
+        # same object is needed.
+        self.group_positions: Dict[int, int] = {}
         self.current_page: int = 0
-        self.image_groups: Optional[WatchedList] = None
+        self.refresh_timer = QTimer()
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(self.REFRESH_INTERVAL)
+        self.refresh_timer.timeout.connect(self.refresh_page)
+        # Groups can be shown while the search is still running.
+        self.image_groups: WatchedList = WatchedList([])
 
         self.search_engine.ResultsReady.connect(self.results_ready)
+        self.search_engine.GroupAdded.connect(self.group_added)
+        self.search_engine.GroupChanged.connect(self.group_changed)
+        self.search_engine.GroupsMerged.connect(self.groups_merged)
+        self.search_engine.GroupRemoved.connect(self.group_removed)
+        self.search_engine.Regrouped.connect(self.regrouped)
         self.list_view.setModel(self.list_view_model)
+        self.list_view_model.set_list(self.image_groups)
+        self.pager.addStretch()
+        # Images are grouped again from pairs kept by the search, so radius can be changed up to the maximum one.
+        settings = self.search_engine.settings
+        self.radius_label = QLabel()
+        self.radius_slider = QSlider(Qt.Horizontal)
+        self.radius_slider.setRange(0, settings.max_radius)
+        self.radius_slider.setValue(settings.radius)
+        self.radius_slider.setFixedWidth(100)
+        self.radius_slider.setTracking(False)  # Groups change when the slider is released
+        self.radius_slider.setToolTip("Maximum number of bits by which hashes of similar images may differ.")
+        self.radius_slider.sliderMoved.connect(self.update_radius_label)
+        self.radius_slider.valueChanged.connect(self.radius_changed)
+        self.update_radius_label(settings.radius)
+        self.pager.addWidget(self.radius_label)
+        self.pager.addWidget(self.radius_slider)
         self.list_view.selectionModel().selectionChanged.connect(self.result_changed)
         self.pager_button_group.buttonClicked.connect(self.pager_button_clicked)
 
@@ -54,22 +85,107 @@ class MatchesController:
 
     @Slot()
     def results_ready(self, groups: List[ImageGroup]):
-        self.all_groups = groups
-        self.image_groups = WatchedList(groups[:self.GROUPS_PER_PAGE])
+        # With streaming, these are the groups which were already added, so only order of pages may change.
+        self._set_groups(groups)
         self.log.log_message(LogMessage(LogType.INFO, "Search finished.", True))
-        self.list_view_model.set_list(self.image_groups)
-        # Prepare pager
-        pages = self.pages_count
-        if pages > 1:
-            for i in range(pages):
-                label = QPushButton(f'{i + 1}')
-                label.setCheckable(True)
-                label.setFixedWidth(20)
-                if i == 0:
-                    label.setChecked(True)
-                self.pager.addWidget(label)
-                self.pager_button_group.addButton(label)
-            self.pager.addStretch()
+        self.refresh_page()
+
+    def update_pager(self):
+        """Makes number of pager buttons match number of pages."""
+        buttons = self.pager_button_group.buttons()
+        pages = self.pages_count if self.pages_count > 1 else 0
+        for i in range(len(buttons), pages):
+            label = QPushButton(f'{i + 1}')
+            label.setCheckable(True)
+            label.setFixedWidth(20)
+            if i == self.current_page:
+                label.setChecked(True)
+            self.pager.insertWidget(i, label)
+            self.pager_button_group.addButton(label)
+        for button in buttons[pages:]:
+            self.pager.removeWidget(button)
+            self.pager_button_group.removeButton(button)
+            button.hide()
+
+    def _set_groups(self, groups: List[ImageGroup]):
+        self.all_groups = groups
+        self.group_positions = {id(group): i for i, group in enumerate(groups)}
+
+    def _compact(self):
+        """Removes dropped groups from all_groups."""
+        if len(self.group_positions) < len(self.all_groups):
+            self._set_groups([group for group in self.all_groups if group is not None])
+
+    def schedule_refresh(self):
+        """Refreshes current page soon. Changes streamed until then are shown together."""
+        if not self.refresh_timer.isActive():
+            self.refresh_timer.start()
+
+    def refresh_page(self):
+        """Updates current page after groups were changed during the search or by watching directories."""
+        self.refresh_timer.stop()
+        self._compact()
+        self.update_pager()
+        if self.current_page and self.current_page >= self.pages_count:
+            self.change_current_page(max(self.pages_count - 1, 0))
+            if self.pager_button_group.buttons():
+                self.pager_button_group.buttons()[self.current_page].setChecked(True)
+        page_start = self.current_page * self.GROUPS_PER_PAGE
+        self.image_groups.replace(self.all_groups[page_start: page_start + self.GROUPS_PER_PAGE])
+
+    def _add_group(self, group: ImageGroup):
+        self.group_positions[id(group)] = len(self.all_groups)
+        self.all_groups.append(group)
+
+    @Slot()
+    def group_added(self, group: ImageGroup):
+        self._add_group(group)
+        self.schedule_refresh()
+
+    @Slot()
+    def group_changed(self, group: ImageGroup, images: List[ImageInfo]):
+        group.replace_images(images)
+        if id(group) not in self.group_positions:
+            # Group was dropped from the view when it had too few images, but it's back.
+            self._add_group(group)
+        if group is self.group_list.image_group:
+            self.group_list.update_group()
+        self.schedule_refresh()
+
+    @Slot()
+    def groups_merged(self, group: ImageGroup, images: List[ImageInfo], merged: List[ImageGroup]):
+        for merged_group in merged:
+            self._drop_group(merged_group)
+        self.group_changed(group, images)
+
+    @Slot()
+    def group_removed(self, group: ImageGroup):
+        self._drop_group(group)
+        self.schedule_refresh()
+
+    def _drop_group(self, group: ImageGroup):
+        index = self.group_positions.pop(id(group), None)
+        if index is not None:
+            self.all_groups[index] = None
+        if group is self.group_list.image_group:
+            self.list_view.selectionModel().clearSelection()
+            self.group_list.clear()
+
+    @Slot()
+    def regrouped(self, groups: List[ImageGroup]):
+        self._set_groups(groups)
+        self.list_view.selectionModel().clearSelection()
+        self.group_list.clear()
+        self.refresh_page()
+
+    @Slot()
+    def update_radius_label(self, radius: int):
+        self.radius_label.setText(f'Radius: {radius}')
+
+    @Slot()
+    def radius_changed(self, radius: int):
+        self.update_radius_label(radius)
+        self.search_engine.regroup(radius)
 
     @Slot()
     def pager_button_clicked(self, button: QPushButton):
@@ -77,6 +193,7 @@ class MatchesController:
         self.change_current_page(new_page)
 
     def change_current_page(self, new_page: int):
+        self._compact()
         if self.current_page != new_page:
             page_start = new_page * self.GROUPS_PER_PAGE
             self.image_groups.replace(self.all_groups[page_start: page_start + self.GROUPS_PER_PAGE])
@@ -93,10 +210,13 @@ class MatchesController:
     def remove_current_match(self):
         selected = first(self.list_view.selectionModel().selection().indexes())
         index = selected.row()
+        self._compact()
         # remove the same match group from "all"
         page_start = self.current_page * self.GROUPS_PER_PAGE
-        global_index = self.current_page * self.GROUPS_PER_PAGE + index
-        del self.all_groups[global_index]
+        global_index = self.group_positions.get(id(selected.data()))
+        if global_index is not None:
+            del self.all_groups[global_index]
+            self._set_groups(self.all_groups)
 
         if self.pages_count < len(self.pager_button_group.buttons()):
             # Remove last page
@@ -1,7 +1,11 @@
-from typing import List
+from typing import List, Optional, Dict
 
 from PySide6.QtCore import QSettings
 
+from picture_comparator_muri.model.disk_order import ReadOrder
+from picture_comparator_muri.model.hashing import HashDecoding
+from picture_comparator_muri.model.neighbour_index import NeighbourIndex
+
 
 class Settings:
     """Helps to interact with settings."""
@@ -9,4 +13,32 @@ class Settings:
         self.qt_settings = QSettings('armas', 'picture_comparator_muri')
         self.directories: List[str] = args.directories
         self.scan_subdirectories: bool = not args.no_subdirs
+        self.workers: Optional[int] = args.workers
+        self.queue_size: int = args.queue_size
+        self.hash_decoding: HashDecoding = HashDecoding(args.hash_decoding)
+        # Comparison needs images to be decoded, so cached hashes can't be used.
+        self.use_cache: bool = not args.no_cache and self.hash_decoding != HashDecoding.COMPARE
+        # Incremental scan keeps directory snapshots in the cache, so it can't work without it.
+        self.incremental: bool = args.incremental and self.use_cache
+        self.watch: bool = args.watch
+        self.read_order: ReadOrder = ReadOrder(args.read_order)
+        self.hash_kind: str = args.hash
+        self.radius: int = args.radius  # Maximum number of bits by which hashes of similar images differ
+        # Pairs of images are kept up to this radius, so it's the highest one to which radius can be changed later.
+        self.max_radius: int = max(args.max_radius if args.max_radius is not None else args.radius, args.radius)
+        # Maximum number of bits by which each of hashes confirming similarity may differ, by kind of the hash.
+        self.confirmation: Dict[str, int] = dict(args.confirm)
+        # Minimum structural similarity of pixels of similar images, None if they aren't compared.
+        self.pixel_threshold: Optional[float] = args.verify_pixels
+        # Whether rotated and mirrored copies of images are found, by hashes of all orientations of each image.
+        self.orientations: bool = args.orientations
+        self.exif_orientation: bool = args.exif_orientation
+        # Whether cropped copies of images are found, by hashes of their overlapping parts.
+        self.crops: bool = args.crops
+        self.neighbour_index: NeighbourIndex = NeighbourIndex(args.neighbour_index)
+        # Groups found during the scan come from a live Hamming index, so choosing a method of the search done after
+        # the scan turns streaming off.
+        self.streaming: bool = not args.no_streaming and self.neighbour_index == NeighbourIndex.AUTO
+        # Whether headless mode writes groups only when the scan is finished, without their changes during it.
+        self.final_only: bool = args.final_only
         # self.join_similar_groups: bool = True
@@ -1,15 +1,93 @@
 import sys
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+from typing import Tuple
 
-from PySide6.QtWidgets import QApplication
+from picture_comparator_muri.model.hashing import HASH_FUNCTIONS, CANDIDATE_HASHES
 
 
-def main():
+def hash_threshold(value: str) -> Tuple[str, int]:
+    kind, _, threshold = value.partition('=')
+    if kind not in HASH_FUNCTIONS or not threshold.isdigit():
+        raise ArgumentTypeError(f"expected <hash>=<number of bits>, where hash is one of {', '.join(HASH_FUNCTIONS)}, "
+                                f"got '{value}'")
+    return kind, int(threshold)
+
+
+def create_parser() -> ArgumentParser:
     parser = ArgumentParser(description="GUI application searching for similar images in a set.")
     parser.add_argument('--directories', '-d', nargs='+', default=[])
     parser.add_argument('--no-subdirs', '-ns', action='store_true')
+    parser.add_argument('--workers', '-w', type=int, default=None,
+                        help="Number of processes used for hashing images. Defaults to number of CPUs.")
+    parser.add_argument('--queue-size', type=int, default=1000,
+                        help="Maximum number of files waiting between stages of the search.")
+    parser.add_argument('--no-cache', action='store_true', help="Don't read nor store hashes in the cache.")
+    parser.add_argument('--incremental', '-i', action='store_true',
+                        help="Don't list again directories which didn't change since previous scan.")
+    parser.add_argument('--watch', action='store_true',
+                        help="After search is finished, keep updating results as files in directories change.")
+    parser.add_argument('--hash-decoding', choices=['reduced', 'full', 'compare'], default='reduced',
+                        help="Resolution in which images are decoded for hashing. 'compare' uses both and reports "
+                             "differences between them.")
+    parser.add_argument('--read-order', choices=['listing', 'inode', 'extent'], default='inode',
+                        help="Order in which files are read for hashing. 'inode' and 'extent' (physical position "
+                             "on disk) reduce seeking on rotational disks.")
+    parser.add_argument('--hash', choices=CANDIDATE_HASHES, default='whash',
+                        help="Hash used to find similar images. With --confirm it only finds candidates, so a cheap "
+                             "one (ahash, dhash) with higher radius can be used.")
+    parser.add_argument('--radius', type=int, default=9,
+                        help="Maximum number of bits by which hashes of similar images may differ.")
+    parser.add_argument('--max-radius', type=int, default=None,
+                        help="Highest radius to which similarity can be changed after the search, without searching "
+                             "again. Defaults to --radius. Higher values make the search slower.")
+    parser.add_argument('--confirm', type=hash_threshold, nargs='+', default=[], metavar='HASH=BITS',
+                        help="Hashes which confirm similarity of images found by the main hash, with maximum number "
+                             "of bits by which they may differ, e.g. 'phash=10 colorhash=6'. They are computed only "
+                             "for images which have any similar candidate.")
+    parser.add_argument('--verify-pixels', type=float, default=None, metavar='SSIM',
+                        help="Compare pixels of similar images on small grayscale thumbnails and keep only pairs, "
+                             "which structural similarity (1 for identical images) is at least given value, e.g. 0.5. "
+                             "Groups are ordered from the most similar.")
+    parser.add_argument('--orientations', action='store_true',
+                        help="Find also rotated and mirrored copies of images. Hashes of all 8 orientations of each "
+                             "image are computed from the same decoded image. Pairs found this way are confirmed only "
+                             "by --verify-pixels, not by --confirm.")
+    parser.add_argument('--exif-orientation', action='store_true',
+                        help="Rotate images as given by their EXIF orientation before hashing, so they are compared "
+                             "as they are shown.")
+    parser.add_argument('--crops', action='store_true',
+                        help="Find also images which differ by a crop, letterbox or border. Overlapping parts of each "
+                             "image are hashed from its thumbnail and images sharing similar parts are paired. Pairs "
+                             "found this way are confirmed only by --verify-pixels, on their most similar parts.")
+    parser.add_argument('--neighbour-index', choices=['auto', 'brute-force', 'hamming', 'balltree', 'compare'],
+                        default='auto',
+                        help="Method of finding similar hashes. 'auto' compares all pairs in smaller collections and "
+                             "uses Hamming index for bigger ones. 'compare' uses all methods and reports differences. "
+                             "Methods other than 'auto' are used after the scan, so they turn streaming off.")
+    parser.add_argument('--no-streaming', action='store_true',
+                        help="Don't show groups while the scan is running, find them all after it's finished.")
+    parser.add_argument('--headless', action='store_true',
+                        help="Run without GUI and write found groups as NDJSON (one JSON object per line).")
+    parser.add_argument('--output', '-o', default=None,
+                        help="File to which results are written in headless mode. Defaults to standard output.")
+    parser.add_argument('--final-only', action='store_true',
+                        help="In headless mode, write groups only when the scan is finished, instead of their changes "
+                             "while it's running.")
+    return parser
+
+
+def main():
+    parser = create_parser()
     args = parser.parse_args()
 
+    if args.headless:
+        if not args.directories:
+            parser.error("directories must be given in headless mode")
+        # Doesn't import widgets, so it works without display.
+        from picture_comparator_muri.controller.headless import run_headless
+        sys.exit(run_headless(args))
+
+    from PySide6.QtWidgets import QApplication
     app = QApplication([])
     # QApplication must be called before using some of qt library elements
     from picture_comparator_muri.controller.application import Application
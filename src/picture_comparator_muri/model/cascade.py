@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Callable, Optional, Tuple
+
+import numpy
+from PIL import Image
+
+from picture_comparator_muri.model.catalog import ImageCatalog, popcount
+from picture_comparator_muri.model.hashing import THUMBNAIL_SIZE, TRANSFORM_NAMES, CROP, block_box
+from picture_comparator_muri.model.neighbour_index import Pairs
+
+SSIM_BLOCK = 8  # Side of blocks in which structural similarity is computed
+# Constants which stabilize division, for pixel values from 0 to 255, as in the original definition of SSIM.
+SSIM_C1 = (.01 * 255) ** 2
+SSIM_C2 = (.03 * 255) ** 2
+# Transforms of hashing.TRANSFORMS applied to arrays of pixels, which have rows and columns as the last two axes.
+ARRAY_TRANSFORMS: Dict[str, Callable[[numpy.ndarray], numpy.ndarray]] = {
+    'mirror': lambda a: a[..., ::-1],
+    'flip': lambda a: a[..., ::-1, :],
+    'rotate90': lambda a: numpy.rot90(a, 1, axes=(-2, -1)),
+    'rotate180': lambda a: a[..., ::-1, ::-1],
+    'rotate270': lambda a: numpy.rot90(a, -1, axes=(-2, -1)),
+    'transpose': lambda a: a.swapaxes(-2, -1),
+    'transverse': lambda a: a[..., ::-1, ::-1].swapaxes(-2, -1),
+}
+
+
+def transform_thumbnails(thumbnails: numpy.ndarray, transforms: numpy.ndarray) -> numpy.ndarray:
+    """Rotates or mirrors each of stacked thumbnails by its transform (number from 1, 0 for none)."""
+    thumbnails = thumbnails.copy()
+    for number, name in enumerate(TRANSFORM_NAMES, 1):
+        selected = transforms == number
+        if selected.any():
+            thumbnails[selected] = ARRAY_TRANSFORMS[name](thumbnails[selected])
+    return thumbnails
+
+
+def crop_thumbnail(thumbnail: numpy.ndarray, block: int) -> numpy.ndarray:
+    """Part of the thumbnail covered by the block, scaled back to the size of the thumbnail."""
+    return numpy.asarray(Image.fromarray(thumbnail).crop(block_box(block)).resize(
+        (THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.Resampling.BILINEAR))
+
+
+def structural_similarity(a: numpy.ndarray, b: numpy.ndarray) -> numpy.ndarray:
+    """
+    SSIM of pairs of thumbnails, given as arrays of shape (pairs, THUMBNAIL_SIZE, THUMBNAIL_SIZE). It's computed in
+    separate blocks and averaged. 1 means identical images, values close to 0 (or below) unrelated ones.
+    """
+    blocks = THUMBNAIL_SIZE // SSIM_BLOCK
+    shape = (len(a), blocks, SSIM_BLOCK, blocks, SSIM_BLOCK)
+    a = a.reshape(shape).astype(numpy.float32)
+    b = b.reshape(shape).astype(numpy.float32)
+    mean_a = a.mean(axis=(2, 4), keepdims=True)
+    mean_b = b.mean(axis=(2, 4), keepdims=True)
+    a -= mean_a
+    b -= mean_b
+    variance_a = (a * a).mean(axis=(2, 4))
+    variance_b = (b * b).mean(axis=(2, 4))
+    covariance = (a * b).mean(axis=(2, 4))
+    mean_a, mean_b = mean_a[:, :, 0, :, 0], mean_b[:, :, 0, :, 0]
+    ssim = ((2 * mean_a * mean_b + SSIM_C1) * (2 * covariance + SSIM_C2) /
+            ((mean_a ** 2 + mean_b ** 2 + SSIM_C1) * (variance_a + variance_b + SSIM_C2)))
+    return ssim.mean(axis=(1, 2))
+
+
+class HashCascade:
+    """
+    Second step of comparison, which reduces false positives. Candidates are pairs of images which main hash (cheap
+    one, compared with generous radius) found similar. They are kept only if each of confirmation hashes differs by
+    at most its own threshold and, if pixel threshold is set, structural similarity of their thumbnails reaches it.
+    Confirmation data is computed only for images which are part of any candidate pair. It's done by compute,
+    which gets rows of such images and sets their hashes and thumbnails in the catalog.
+    Pairs of rotated or mirrored images have their transforms. Confirmation hashes are computed only for images as
+    they are, so such pairs are only compared by pixels, after the thumbnail is transformed the same way. Cropped
+    copies are compared by pixels of their blocks which are the most similar.
+    """
+    PAIRS_PER_TASK = 256  # Pairs of thumbnails compared at once by a thread
+
+    def __init__(self, catalog: ImageCatalog, thresholds: Dict[str, int], compute: Callable[[numpy.ndarray], None],
+                 pixel_threshold: Optional[float] = None, workers: Optional[int] = None):
+        self.catalog: ImageCatalog = catalog
+        self.thresholds: Dict[str, int] = thresholds  # Maximum number of different bits by kind of hash
+        self.compute: Callable[[numpy.ndarray], None] = compute
+        self.pixel_threshold: Optional[float] = pixel_threshold  # Minimum structural similarity
+        self.workers: int = workers or os.cpu_count() or 1
+
+    def confirm(self, pairs: Pairs, transforms: Optional[numpy.ndarray] = None) \
+            -> Tuple[Pairs, Optional[numpy.ndarray], Optional[numpy.ndarray]]:
+        """
+        Returns pairs which are similar according to all confirmation data, if pixels were compared, structural
+        similarity of each of them and transforms of pairs, if they were given.
+        """
+        first, second = pairs
+        if not self.thresholds and self.pixel_threshold is None or not len(first):
+            return pairs, None, transforms
+        rows = numpy.unique(numpy.concatenate(pairs))
+        missing = rows[self.catalog.rows['confirmation'][rows] == 0]
+        if len(missing):
+            self.compute(missing)
+        keep = self.similar(first, second, transforms)
+        first, second = first[keep], second[keep]
+        transforms = transforms[keep] if transforms is not None else None
+        if self.pixel_threshold is None:
+            return (first, second), None, transforms
+        scores = self.pixel_scores(first, second, transforms)
+        keep = scores >= self.pixel_threshold
+        return (first[keep], second[keep]), scores[keep], transforms[keep] if transforms is not None else None
+
+    def similar(self, first: numpy.ndarray, second: numpy.ndarray,
+                transforms: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+        """Compares confirmation hashes of pairs of rows, which were already computed."""
+        rows = self.catalog.rows
+        keep = (rows['confirmation'][first] > 0) & (rows['confirmation'][second] > 0)
+        similar = numpy.ones(len(first), dtype=bool)
+        for kind, threshold in self.thresholds.items():
+            similar &= popcount(rows[kind][first] ^ rows[kind][second]) <= threshold
+        if transforms is not None:
+            similar |= transforms > 0
+        return keep & similar
+
+    def pixel_scores(self, first: numpy.ndarray, second: numpy.ndarray,
+                     transforms: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+        """
+        Structural similarity of thumbnails of pairs of rows, with the first one transformed, if transforms are given.
+        Pairs are split between threads.
+        """
+        thumbnails = self.catalog.thumbnails
+        blocks: Dict[int, Tuple[int, int]] = {}  # Most similar blocks of cropped copies, by index of the pair
+        if transforms is not None:
+            crops = numpy.flatnonzero(transforms == CROP)
+            if len(crops):
+                best = self.catalog.block_matches(first[crops], second[crops], 0)[3]
+                blocks = dict(zip(crops.tolist(), map(tuple, best.tolist())))
+
+        def thumbnail(pair: int, side: int) -> numpy.ndarray:
+            pixels = thumbnails[int((first, second)[side][pair])]
+            return crop_thumbnail(pixels, blocks[pair][side]) if pair in blocks else pixels
+
+        def score(start: int) -> numpy.ndarray:
+            pairs = range(start, min(start + self.PAIRS_PER_TASK, len(first)))
+            first_thumbnails = numpy.stack([thumbnail(pair, 0) for pair in pairs])
+            if transforms is not None:
+                first_thumbnails = transform_thumbnails(first_thumbnails, transforms[start:start + len(pairs)])
+            return structural_similarity(first_thumbnails, numpy.stack([thumbnail(pair, 1) for pair in pairs]))
+
+        if not len(first):
+            return numpy.zeros(0, dtype=numpy.float32)
+        with ThreadPoolExecutor(self.workers) as executor:
+            return numpy.concatenate(list(executor.map(score, range(0, len(first), self.PAIRS_PER_TASK))))
@@ -0,0 +1,284 @@
+from __future__ import annotations
+
+import os
+from typing import List, Dict, Optional, Sequence, Tuple
+
+import numpy
+
+from picture_comparator_muri.model.hashing import THUMBNAIL_SIZE, PIXEL_DIGEST, BLOCK_NAMES
+from picture_comparator_muri.model.image_info import ImageInfo
+
+CATALOG_DTYPE = numpy.dtype([
+    ('hash', numpy.uint64),
+    ('size', numpy.int64),
+    ('mtime_ns', numpy.int64),
+    ('device', numpy.uint64),
+    ('inode', numpy.uint64),
+    ('width', numpy.int32),  # 0 if unknown
+    ('height', numpy.int32),
+    ('format', numpy.uint8),  # Index in ImageCatalog.formats
+    ('directory', numpy.uint32),  # Index in ImageCatalog.directories
+    ('alias_of', numpy.int32),  # Row of the image this one is a link to or a copy of, -1 if it isn't
+    ('reduced_distance', numpy.int8),  # -1 if reduced and full decoding weren't compared
+    ('confirmation', numpy.int8),  # 1 if data confirming similarity is known, -1 if computing it failed
+    ('pixel_digest', numpy.uint64),  # 0 if it's unknown, NO_PIXEL_DIGEST if pixels couldn't be decoded
+    ('removed', numpy.bool_),
+])
+# Hash used to find similar images is in the hash column. Hashes which confirm similarity have their own columns,
+# named after them, added to CATALOG_DTYPE. Thumbnails used to compare pixels are kept aside, as they are big and
+# only images with similar candidates have them. Hashes of rotated and mirrored images have columns named after
+# transforms, if they are used. Hashes of blocks, if they are used, are kept together in the blocks column.
+NO_PIXEL_DIGEST = 1  # Computed digests always have the highest bit set
+MIN_BLOCK_BITS = 16  # Bits which hash of a block must have set (and unset) to be used
+NO_MATCH = 255  # Distance of blocks which aren't compared
+
+if hasattr(numpy, 'bitwise_count'):
+    popcount = numpy.bitwise_count
+else:
+    _BYTE_BITS = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
+    def popcount(values: numpy.ndarray) -> numpy.ndarray:
+        values = numpy.ascontiguousarray(values, dtype=numpy.uint64)
+        return _BYTE_BITS[values.view(numpy.uint8)].reshape(values.shape + (8,)).sum(axis=-1, dtype=numpy.uint8)
+
+
+def unpack_hashes(hashes: numpy.ndarray) -> numpy.ndarray:
+    """Returns array of 0/1 values with a row of 64 bits for each hash, the most significant bit first."""
+    return numpy.unpackbits(hashes.astype('>u8').view(numpy.uint8).reshape(-1, 8), axis=1)
+
+
+def informative_blocks(blocks: numpy.ndarray) -> numpy.ndarray:
+    """
+    Mask of hashes of blocks which tell images apart. Blocks of plain or smoothly changing areas have almost all bits
+    of their difference hashes equal, so they match blocks of unrelated images.
+    """
+    bits = popcount(blocks)
+    return (bits >= MIN_BLOCK_BITS) & (bits <= 64 - MIN_BLOCK_BITS)
+
+
+PAIRS_PER_CHUNK = 1024  # Pairs which blocks are compared at once. Their distances take 1.3 MB.
+
+
+class ImageCatalog:
+    """
+    All found images, stored column-wise in a structured array, so even millions of them take little memory and can
+    be filtered without Python loops. Paths are split into interned directories and names.
+    Rows are never moved. Removed images are only marked, so indices stay valid.
+
+    ImageInfo records are created only when requested (for images in groups) and the same object is returned for
+    a row each time.
+    """
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, confirmation_hashes: Sequence[str] = (), use_thumbnails: bool = False,
+                 transforms: Sequence[str] = (), blocks: bool = False):
+        self.confirmation_hashes: List[str] = list(confirmation_hashes)
+        self.use_thumbnails: bool = use_thumbnails
+        self.transforms: List[str] = list(transforms)
+        self.blocks: bool = blocks
+        self.thumbnails: Dict[int, numpy.ndarray] = {}
+        self.dtype = numpy.dtype(CATALOG_DTYPE.descr +
+                                 [(kind, numpy.uint64) for kind in self.confirmation_hashes + self.transforms] +
+                                 ([('blocks', numpy.uint64, (len(BLOCK_NAMES),))] if blocks else []))
+        self._rows = numpy.zeros(self.INITIAL_CAPACITY, dtype=self.dtype)
+        self._length: int = 0
+        self.directories: List[str] = []
+        self._directory_ids: Dict[str, int] = {}
+        self.names: List[str] = []
+        self.real_paths: Dict[int, str] = {}  # Only for rows which real path differs from the path
+        self.formats: List[Optional[str]] = [None]
+        self._format_codes: Dict[Optional[str], int] = {None: 0}
+        self._paths: Dict[int, Dict[str, int]] = {}  # Row of each image which wasn't removed, by directory and name
+        self._images: Dict[int, ImageInfo] = {}
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def rows(self) -> numpy.ndarray:
+        """View of all rows, including removed ones. It's invalidated by adding more rows."""
+        return self._rows[:self._length]
+
+    @property
+    def hashes(self) -> numpy.ndarray:
+        return self.rows['hash']
+
+    @property
+    def valid(self) -> numpy.ndarray:
+        return ~self.rows['removed']
+
+    def append(self, path: str, real_path: str, hash: int, stat: os.stat_result, width: Optional[int] = None,
+               height: Optional[int] = None, format: Optional[str] = None, alias_of: int = -1,
+               reduced_distance: Optional[int] = None, hashes: Optional[Dict[str, int]] = None,
+               thumbnail: Optional[bytes] = None) -> int:
+        if self._length == len(self._rows):
+            rows = numpy.zeros(len(self._rows) * 2, dtype=self.dtype)
+            rows[:self._length] = self._rows
+            self._rows = rows
+        row = self._length
+        directory, name = os.path.split(path)
+        directory_id = self._directory_ids.get(directory)
+        if directory_id is None:
+            directory_id = len(self.directories)
+            self.directories.append(directory)
+            self._directory_ids[directory] = directory_id
+        format_code = self._format_codes.get(format)
+        if format_code is None:
+            format_code = len(self.formats)
+            self.formats.append(format)
+            self._format_codes[format] = format_code
+        self._rows[row] = (hash, stat.st_size, stat.st_mtime_ns, stat.st_dev, stat.st_ino, width or 0, height or 0,
+                           format_code, directory_id, alias_of,
+                           reduced_distance if reduced_distance is not None else -1, 0, 0, False,
+                           *(0 for _ in self.confirmation_hashes + self.transforms),
+                           *([(0,) * len(BLOCK_NAMES)] if self.blocks else []))
+        if hashes is not None and all(kind in hashes for kind in self.confirmation_hashes) and \
+                (thumbnail is not None or not self.use_thumbnails):
+            self.set_confirmation(row, hashes, thumbnail)
+        if hashes is not None and PIXEL_DIGEST in hashes:
+            self._rows['pixel_digest'][row] = hashes[PIXEL_DIGEST]
+        for transform in self.transforms:
+            if hashes is not None and transform in hashes:
+                self._rows[transform][row] = hashes[transform]
+        if self.blocks and hashes is not None and all(name in hashes for name in BLOCK_NAMES):
+            self._rows['blocks'][row] = [hashes[name] for name in BLOCK_NAMES]
+        self.names.append(name)
+        if real_path != path:
+            self.real_paths[row] = real_path
+        self._paths.setdefault(directory_id, {})[name] = row
+        self._length += 1
+        return row
+
+    def path(self, row: int) -> str:
+        return os.path.join(self.directories[self._rows[row]['directory']], self.names[row])
+
+    def real_path(self, row: int) -> str:
+        return self.real_paths.get(row) or self.path(row)
+
+    def format(self, row: int) -> Optional[str]:
+        return self.formats[self._rows[row]['format']]
+
+    def find(self, path: str) -> Optional[int]:
+        """Returns row of the image with given path, unless it was removed."""
+        directory, name = os.path.split(path)
+        directory_id = self._directory_ids.get(directory)
+        if directory_id is None:
+            return None
+        return self._paths.get(directory_id, {}).get(name)
+
+    def in_directory(self, directory: str) -> numpy.ndarray:
+        """Rows of images in the directory and its subdirectories, which weren't removed."""
+        directory = directory.rstrip(os.sep)
+        prefix = directory + os.sep
+        ids = [i for i, d in enumerate(self.directories) if d == directory or d.startswith(prefix)]
+        return numpy.flatnonzero(numpy.isin(self.rows['directory'], ids) & self.valid)
+
+    def set_confirmation(self, row: int, hashes: Optional[Dict[str, int]], thumbnail: Optional[bytes] = None):
+        """Sets hashes and thumbnail which confirm similarity. None hashes mean they couldn't be computed."""
+        if hashes is None:
+            self._rows['confirmation'][row] = -1
+            return
+        for kind in self.confirmation_hashes:
+            self._rows[kind][row] = hashes[kind]
+        if self.use_thumbnails:
+            self.thumbnails[row] = numpy.frombuffer(thumbnail, numpy.uint8).reshape(THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+        self._rows['confirmation'][row] = 1
+
+    def confirmation_of(self, row: int) -> Tuple[Optional[Dict[str, int]], Optional[bytes]]:
+        """Returns hashes and thumbnail which confirm similarity, if they are known."""
+        if self._rows['confirmation'][row] <= 0:
+            return None, None
+        thumbnail = self.thumbnails[row].tobytes() if self.use_thumbnails else None
+        return {kind: int(self._rows[kind][row]) for kind in self.confirmation_hashes}, thumbnail
+
+    def transformed_hashes(self, rows: numpy.ndarray, transforms: numpy.ndarray) -> numpy.ndarray:
+        """Hashes of images in rows, each after its transform (number of one of transforms, 0 for none)."""
+        hashes = self.hashes[rows]
+        for number, name in enumerate(self.transforms, 1):
+            selected = transforms == number
+            hashes[selected] = self._rows[name][rows[selected]]
+        return hashes
+
+    def transformed_hashes_of(self, row: int) -> Dict[str, int]:
+        return {name: int(self._rows[name][row]) for name in self.transforms}
+
+    def block_hashes_of(self, row: int) -> Dict[str, int]:
+        if not self.blocks:
+            return {}
+        return dict(zip(BLOCK_NAMES, self._rows['blocks'][row].tolist()))
+
+    def block_matches(self, first: numpy.ndarray, second: numpy.ndarray, radius: int) \
+            -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """
+        Compares each block of the first image of each pair with each block of the second one, leaving out blocks of
+        plain areas. Returns masks of blocks of the first and of the second image, which hashes differ by at most
+        radius bits from a block of the other image (arrays of shape (pairs, blocks)), the smallest distances and
+        blocks of the first and the second image which differ by them, as an array of shape (pairs, 2). Pairs with no
+        blocks to compare have the smallest distance of NO_MATCH.
+        """
+        count = len(BLOCK_NAMES)
+        first_matched = numpy.zeros((len(first), count), dtype=bool)
+        second_matched = numpy.zeros((len(first), count), dtype=bool)
+        smallest = numpy.zeros(len(first), dtype=numpy.uint8)
+        best = numpy.zeros((len(first), 2), dtype=numpy.int64)
+        blocks = self.rows['blocks']
+        for start in range(0, len(first), PAIRS_PER_CHUNK):
+            end = start + PAIRS_PER_CHUNK
+            first_blocks, second_blocks = blocks[first[start:end]], blocks[second[start:end]]
+            distances = popcount(first_blocks[:, :, None] ^ second_blocks[:, None, :])
+            compared = informative_blocks(first_blocks)[:, :, None] & informative_blocks(second_blocks)[:, None, :]
+            distances[~compared] = NO_MATCH
+            matched = distances <= radius
+            first_matched[start:end] = matched.any(axis=2)
+            second_matched[start:end] = matched.any(axis=1)
+            distances = distances.reshape(len(distances), -1)
+            closest = distances.argmin(axis=1)
+            smallest[start:end] = distances[numpy.arange(len(distances)), closest]
+            best[start:end] = numpy.stack(numpy.divmod(closest, count), axis=1)
+        return first_matched, second_matched, smallest, best
+
+    def set_pixel_digest(self, row: int, digest: Optional[int]):
+        """Sets digest of decoded pixels. None means the image couldn't be decoded."""
+        self._rows['pixel_digest'][row] = digest if digest is not None else NO_PIXEL_DIGEST
+        image = self._images.get(row)
+        if image is not None:
+            image.pixel_digest = digest
+
+    def pixel_digest(self, row: int) -> Optional[int]:
+        digest = int(self._rows['pixel_digest'][row])
+        return digest if digest > NO_PIXEL_DIGEST else None
+
+    def original(self, row: int) -> int:
+        """Row of the image which hash the image shares, the row itself if it was hashed on its own."""
+        while self._rows['alias_of'][row] >= 0:
+            row = int(self._rows['alias_of'][row])
+        return row
+
+    def remove(self, row: int):
+        self._rows['removed'][row] = True
+        paths = self._paths.get(self._rows['directory'][row], {})
+        if paths.get(self.names[row]) == row:
+            del paths[self.names[row]]
+        self._images.pop(row, None)
+        self.thumbnails.pop(row, None)
+
+    def image(self, row: int) -> ImageInfo:
+        image = self._images.get(row)
+        if image is None:
+            values = self._rows[row]
+            image = ImageInfo(self.path(row), self.real_path(row), int(values['hash']))
+            image.index = row
+            image.set_file_info(int(values['size']), int(values['mtime_ns']), int(values['device']),
+                                int(values['inode']))
+            if values['width']:
+                image.dimensions = (int(values['width']), int(values['height']))
+            if values['reduced_distance'] >= 0:
+                image.reduced_distance = int(values['reduced_distance'])
+            image.pixel_digest = self.pixel_digest(row)
+            if values['alias_of'] >= 0:
+                image.alias_of = self.image(int(values['alias_of']))
+            self._images[row] = image
+        return image
+
+    def clear(self):
+        self.__init__(self.confirmation_hashes, self.use_thumbnails, self.transforms, self.blocks)
@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import hashlib
+from typing import Dict, List, Optional, Tuple, Set
+
+from picture_comparator_muri.model.hash_cache import FileEntry
+
+PARTIAL_SIZE = 0x10000  # Bytes read from the beginning and from the end of the file, to tell apart files of equal size
+READ_SIZE = 0x100000
+DIGEST_SIZE = 16
+
+
+def partial_digest(path: str, size: int) -> Optional[bytes]:
+    """Hash of the first and the last PARTIAL_SIZE bytes of the file. For smaller files it covers all of them."""
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    try:
+        with open(path, 'rb') as file:
+            digest.update(file.read(PARTIAL_SIZE))
+            if size > PARTIAL_SIZE:
+                file.seek(max(size - PARTIAL_SIZE, PARTIAL_SIZE))
+                digest.update(file.read(PARTIAL_SIZE))
+    except OSError:
+        return None
+    return digest.digest()
+
+
+def full_digest(path: str) -> Optional[bytes]:
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    try:
+        with open(path, 'rb') as file:
+            while True:
+                data = file.read(READ_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+    except OSError:
+        return None
+    return digest.digest()
+
+
+class CopyFinder:
+    """
+    Finds files with exactly the same content as files found before, so copies don't need to be decoded. Most files
+    are never read here: a file is read only after another file of the same size is found. Files are indexed by size
+    and hash of their beginning and end and, once another file has the same ones, by hash of the whole content. Each
+    file is read at most once for each of them. Files which couldn't be read aren't indexed, so they never match.
+    """
+    def __init__(self):
+        self.unread: Dict[int, List[FileEntry]] = {}  # Files of sizes which no other file had so far
+        self.read_sizes: Set[int] = set()
+        # None for files with the same beginning and end as another file, which are indexed by the whole content.
+        self.by_partial: Dict[Tuple[int, bytes], Optional[FileEntry]] = {}
+        self.by_full: Dict[Tuple[int, bytes], FileEntry] = {}
+        self.by_real_path: Dict[str, FileEntry] = {}
+
+    def add(self, entry: FileEntry):
+        """Adds file which other files may be copies of."""
+        size = entry[2].st_size
+        self.by_real_path[entry[1]] = entry
+        if size in self.read_sizes:
+            self._index(entry)
+        else:
+            self.unread.setdefault(size, []).append(entry)
+
+    def find_original(self, entry: FileEntry) -> Optional[FileEntry]:
+        """Returns earlier file with the same content. If there isn't one, the file is added as a possible original."""
+        size = entry[2].st_size
+        if size not in self.read_sizes:
+            if not size or size not in self.unread:
+                self.add(entry)
+                return None
+            self.read_sizes.add(size)
+            for other in self.unread.pop(size):
+                self._index(other)
+        partial = partial_digest(entry[1], size)
+        key = (size, partial)
+        if partial is not None and key in self.by_partial:
+            if size <= 2 * PARTIAL_SIZE:  # Partial digest covers the whole file
+                return self.by_partial[key]
+            self._index_by_content(key)
+            full = full_digest(entry[1])
+            original = self.by_full.get((size, full)) if full is not None else None
+            if original is not None:
+                return original
+            if full is not None:
+                self.by_full[(size, full)] = entry
+        elif partial is not None:
+            self.by_partial[key] = entry
+        self.by_real_path[entry[1]] = entry
+        return None
+
+    def cached_original(self, entry: FileEntry, original: Tuple[str, int]) -> Optional[FileEntry]:
+        """
+        Returns the original of a copy, given by its real path and modification time stored in the cache entry of the
+        copy, if it was found since and didn't change.
+        """
+        real_path, mtime_ns = original
+        other = self.by_real_path.get(real_path)
+        if other is None or other[2].st_mtime_ns != mtime_ns or other[2].st_size != entry[2].st_size:
+            return None
+        return other
+
+    def _index(self, entry: FileEntry):
+        size = entry[2].st_size
+        partial = partial_digest(entry[1], size)
+        if partial is None:
+            return
+        key = (size, partial)
+        if key not in self.by_partial:
+            self.by_partial[key] = entry
+        elif size > 2 * PARTIAL_SIZE:
+            self._index_by_content(key)
+            full = full_digest(entry[1])
+            if full is not None:
+                self.by_full.setdefault((size, full), entry)
+
+    def _index_by_content(self, key: Tuple[int, bytes]):
+        """Moves file with given size and partial digest to the index of whole content, as another file has them too."""
+        entry = self.by_partial[key]
+        if entry is None:
+            return
+        self.by_partial[key] = None
+        full = full_digest(entry[1])
+        if full is not None:
+            self.by_full.setdefault((key[0], full), entry)
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import os
+import struct
+from enum import Enum
+from typing import List, Optional
+
+from picture_comparator_muri.model.hash_cache import FileEntry
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows. Files are ordered by inodes there.
+    fcntl = None
+
+# Reading files in the order in which they are stored avoids seeking on rotational disks. Order of directory listing
+# has nothing to do with it, while inode numbers and physical offsets usually follow it closely.
+
+
+class ReadOrder(Enum):
+    LISTING = 'listing'  # As files were found
+    INODE = 'inode'  # By inode number, which doesn't require any additional access to the disk
+    EXTENT = 'extent'  # By physical offset of the first extent, if filesystem reports it. Requires opening each file.
+
+
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct('=QQIIII')  # start, length, flags, mapped extents, extent count, reserved
+FIEMAP_EXTENT_SIZE = 56  # logical, physical, length, 2 reserved (all 64 bit), flags and 3 reserved (32 bit)
+FIEMAP_MAX_OFFSET = 0xFFFFFFFFFFFFFFFF
+
+
+def physical_offset(path: str) -> Optional[int]:
+    """Returns position of the beginning of the file on the disk, or None if it can't be told."""
+    if fcntl is None:
+        return None
+    request = bytearray(FIEMAP_HEADER.pack(0, FIEMAP_MAX_OFFSET, 0, 0, 1, 0) + bytes(FIEMAP_EXTENT_SIZE))
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+    except OSError:  # Filesystem doesn't support it
+        return None
+    finally:
+        os.close(fd)
+    mapped_extents = FIEMAP_HEADER.unpack_from(request)[3]
+    if not mapped_extents:  # Empty file or data stored inline
+        return None
+    return struct.unpack_from('=Q', request, FIEMAP_HEADER.size + 8)[0]
+
+
+def sort_for_reading(files: List[FileEntry], order: ReadOrder) -> List[FileEntry]:
+    if order == ReadOrder.LISTING:
+        return files
+    if order == ReadOrder.EXTENT:
+        offsets = {real_path: physical_offset(real_path) for _, real_path, _ in files}
+        if any(offset is not None for offset in offsets.values()):
+            # Files without known offset go after the others, in order of inodes.
+            return sorted(files, key=lambda entry: (entry[2].st_dev, offsets[entry[1]] is None,
+                                                    offsets[entry[1]] or 0, entry[2].st_ino))
+    return sorted(files, key=lambda entry: (entry[2].st_dev, entry[2].st_ino))
+
+
+def read_ahead(path: str):
+    """Asks the system to start reading the file into the page cache, so it's ready when a worker opens it."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return  # Worker will report the problem.
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
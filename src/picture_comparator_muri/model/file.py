@@ -5,13 +5,13 @@ from typing import Optional, List, Iterable
 import magic
 from PySide6.QtCore import QFileInfo
 from PySide6.QtGui import QIcon
-from PySide6.QtWidgets import QFileIconProvider
 
 from picture_comparator_muri.utils import readable_size
 
 
 class FileInfo:
-    provider = QFileIconProvider()
+    # Created on first use, so headless mode, which uses files too, doesn't import widgets.
+    provider = None
 
     def __init__(self, path: str, parent: FileInfo = None, known_children=None):
         self.path = os.path.abspath(path)
@@ -38,6 +38,9 @@ class FileInfo:
 
     @property
     def icon(self) -> QIcon:
+        if FileInfo.provider is None:
+            from PySide6.QtWidgets import QFileIconProvider
+            FileInfo.provider = QFileIconProvider()
         return self.provider.icon(QFileInfo(self.path))
 
     @property
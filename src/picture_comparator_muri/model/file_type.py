@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import os
+from typing import Optional, BinaryIO
+
+import magic
+
+# Quick classification of files, so most of the non-images can be rejected before libmagic or PIL is used.
+# This module is used by worker processes, so it must not depend on Qt.
+
+# Read at once. Signatures below need only few bytes, but libmagic may need more to decide.
+HEADER_SIZE = 4096
+
+IMAGE_EXTENSIONS = {
+    '.jpg', '.jpeg', '.jpe', '.jfif', '.png', '.gif', '.bmp', '.dib', '.webp', '.tif', '.tiff', '.ico', '.icns',
+    '.ppm', '.pgm', '.pbm', '.pnm', '.tga', '.pcx', '.psd', '.jp2', '.j2k', '.jpx', '.heic', '.heif', '.avif',
+    '.xbm', '.sgi', '.dds', '.im', '.msp', '.qoi'
+}
+
+# Files with these extensions are never opened.
+NON_IMAGE_EXTENSIONS = {
+    '.mp4', '.m4v', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.webm', '.mpg', '.mpeg', '.3gp', '.ts', '.vob',
+    '.mp3', '.flac', '.ogg', '.opus', '.wav', '.m4a', '.aac', '.wma',
+    '.zip', '.rar', '.7z', '.tar', '.gz', '.bz2', '.xz', '.zst', '.iso', '.dmg',
+    '.txt', '.md', '.json', '.xml', '.html', '.htm', '.css', '.js', '.py', '.c', '.h', '.log', '.csv',
+    '.pdf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx', '.odt', '.ods', '.epub',
+    '.exe', '.dll', '.so', '.o', '.a', '.bin', '.db', '.sqlite', '.part', '.torrent'
+}
+
+# Signature, offset and format name.
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 0, 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 0, 'PNG'),
+    (b'GIF87a', 0, 'GIF'),
+    (b'GIF89a', 0, 'GIF'),
+    (b'BM', 0, 'BMP'),
+    (b'II*\x00', 0, 'TIFF'),
+    (b'MM\x00*', 0, 'TIFF'),
+    (b'\x00\x00\x01\x00', 0, 'ICO'),
+    (b'icns', 0, 'ICNS'),
+    (b'8BPS', 0, 'PSD'),
+    (b'\x00\x00\x00\x0cjP  ', 0, 'JPEG2000'),
+    (b'\xff\x4f\xff\x51', 0, 'JPEG2000'),
+    (b'qoif', 0, 'QOI'),
+    (b'DDS ', 0, 'DDS'),
+)
+
+# Formats which are containers for many kinds of data and need closer look.
+RIFF_IMAGES = {b'WEBP': 'WEBP'}
+ISO_BMFF_IMAGES = {b'heic': 'HEIF', b'heix': 'HEIF', b'mif1': 'HEIF', b'msf1': 'HEIF', b'avif': 'AVIF'}
+
+IMAGE = 'image'  # Format which isn't known yet, of a file which is an image by its extension
+NOT_IMAGE = 'not image'
+
+
+def classify_extension(path: str) -> Optional[str]:
+    """Returns IMAGE for image extensions, NOT_IMAGE for known non-image ones and None if extension tells nothing."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in IMAGE_EXTENSIONS:
+        return IMAGE
+    if extension in NON_IMAGE_EXTENSIONS:
+        return NOT_IMAGE
+    return None
+
+
+def sniff(header: bytes) -> Optional[str]:
+    """
+    Recognizes file by its first bytes. Returns name of the image format, NOT_IMAGE if file certainly isn't an image,
+    or None if signature is unknown.
+    """
+    for signature, offset, format in IMAGE_SIGNATURES:
+        if header.startswith(signature, offset):
+            return format
+    if header.startswith(b'RIFF'):
+        return RIFF_IMAGES.get(header[8:12], NOT_IMAGE)
+    if header[4:8] == b'ftyp':
+        return ISO_BMFF_IMAGES.get(header[8:12], NOT_IMAGE)
+    if header[:2] in (b'P1', b'P2', b'P3', b'P4', b'P5', b'P6') and header[2:3].isspace():
+        return 'PPM'
+    if header.startswith((b'PK\x03\x04', b'Rar!', b'7z\xbc\xaf', b'\x1f\x8b', b'%PDF', b'\x7fELF', b'ID3', b'OggS',
+                          b'fLaC', b'\x1a\x45\xdf\xa3', b'SQLite format 3')):
+        return NOT_IMAGE
+    return None
+
+
+def detect_format(file: BinaryIO, path: str) -> Optional[str]:
+    """
+    Returns format of the image or None if file isn't one. Reads beginning of the file in a single read and rewinds
+    it afterwards, so the same file object can be passed to PIL. libmagic is used only if the signature is unknown
+    and the extension doesn't tell that the file is an image, otherwise IMAGE is returned and PIL decides.
+    """
+    extension_type = classify_extension(path)
+    if extension_type == NOT_IMAGE:
+        return None
+    header = file.read(HEADER_SIZE)
+    file.seek(0)
+    format = sniff(header)
+    if format is None and extension_type == IMAGE:
+        return IMAGE
+    if format is None:
+        mime = magic.from_buffer(header, mime=True)
+        format = mime if mime.startswith('image/') else NOT_IMAGE
+    return format if format != NOT_IMAGE else None
@@ -0,0 +1,410 @@
+from __future__ import annotations
+
+from enum import Enum
+from typing import List, Dict, Set, Iterable, NamedTuple, Sequence, Optional, Tuple
+
+import numpy
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+from picture_comparator_muri.model.cascade import HashCascade
+from picture_comparator_muri.model.catalog import ImageCatalog, popcount
+from picture_comparator_muri.model.hashing import PAIR_TRANSFORMS, CROP, BLOCKS
+from picture_comparator_muri.model.image_group import ImageGroup
+from picture_comparator_muri.model.image_info import ImageInfo
+from picture_comparator_muri.model.neighbour_index import Pairs, LiveHammingIndex, transformed_pairs, BlockIndex, \
+    TransformedPairs
+
+# Candidates sharing blocks are cropped copies if at least two separate blocks of each image have a matching block
+# in the other one, with hash which differs by at most BLOCK_RADIUS bits. All blocks cover the middle of the image, so
+# blocks are separate if the area they share is at most MAX_BLOCK_OVERLAP of the area they cover together.
+BLOCK_RADIUS = 6
+MAX_BLOCK_OVERLAP = .8
+
+
+def _overlap(a: Tuple[float, float, float, float], b: Tuple[float, float, float, float]) -> float:
+    shared = max(0, min(a[2], b[2]) - max(a[0], b[0])) * max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    return shared / ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - shared)
+
+
+SEPARATE_BLOCKS = numpy.array([[_overlap(a, b) <= MAX_BLOCK_OVERLAP for b in BLOCKS] for a in BLOCKS])
+
+
+class GroupChange(Enum):
+    ADDED = 1
+    CHANGED = 2
+    REMOVED = 3
+    MERGED = 4  # Other groups were merged into the group
+
+
+class Change(NamedTuple):
+    type: GroupChange
+    group: ImageGroup
+    images: List[ImageInfo]  # New list of images of the group, empty if it was removed
+    merged: Sequence[ImageGroup] = ()  # Groups which no longer exist, as they became part of this one
+
+
+def connected_groups(pairs: Pairs, size: int) -> List[numpy.ndarray]:
+    """
+    Groups indices linked by pairs, directly or through other indices. Works on a sparse graph, so even millions of
+    pairs are grouped in seconds. Returns only groups with more than one element.
+    """
+    first, second = pairs
+    graph = csr_matrix((numpy.ones(len(first), dtype=numpy.int8), (first, second)), shape=(size, size))
+    count, labels = connected_components(graph, directed=False)
+    grouped = numpy.flatnonzero(numpy.bincount(labels, minlength=count)[labels] > 1)
+    if not len(grouped):
+        return []
+    grouped = grouped[numpy.argsort(labels[grouped], kind='stable')]
+    return numpy.split(grouped, numpy.flatnonzero(numpy.diff(labels[grouped])) + 1)
+
+
+def has_separate_blocks(matched: numpy.ndarray) -> numpy.ndarray:
+    """Whether each row of the mask of blocks (array of shape (pairs, blocks)) has two separate blocks."""
+    matched = matched.astype(numpy.int32)
+    return ((matched @ SEPARATE_BLOCKS.astype(numpy.int32)) * matched).any(axis=1)
+
+
+def crop_pairs(catalog: ImageCatalog, candidates: Pairs) -> TransformedPairs:
+    """
+    Verifies candidates found by BlockIndex by hashes of their blocks. Pairs which are at least as similar as a whole
+    are dropped, as they are found by the main hash.
+    """
+    first, second = candidates
+    valid = catalog.valid
+    keep = valid[first] & valid[second]
+    first, second = first[keep], second[keep]
+    first_matched, second_matched, smallest, _ = catalog.block_matches(first, second, BLOCK_RADIUS)
+    keep = has_separate_blocks(first_matched) & has_separate_blocks(second_matched)
+    keep &= smallest < popcount(catalog.hashes[first] ^ catalog.hashes[second])
+    return first[keep], second[keep], numpy.full(numpy.count_nonzero(keep), CROP, dtype=numpy.uint8)
+
+
+def lowest_scores(pairs: Pairs, scores: Optional[numpy.ndarray], components: List[numpy.ndarray],
+                  size: int) -> List[Optional[float]]:
+    """Lowest score of a pair in each of components. Scores are None if pixels of images weren't compared."""
+    if scores is None:
+        return [None] * len(components)
+    component_of = numpy.full(size, -1)
+    for i, members in enumerate(components):
+        component_of[members] = i
+    lowest = numpy.full(len(components), numpy.inf)
+    numpy.minimum.at(lowest, component_of[pairs[0]], scores)
+    return [float(score) for score in lowest]
+
+
+class SimilarityGraph:
+    """
+    Confirmed pairs of similar images with distances between their hashes, up to the largest radius to which grouping
+    can be changed. Groups for any smaller radius are connected components of pairs within it, so they are found again
+    in milliseconds, without searching for pairs. Images of pairs are kept here, so the graph stays usable after the
+    catalog is cleared at the end of the search. Pairs of rotated or mirrored images have the number of the transform
+    of the first image, pairs of cropped images have CROP, other pairs have 0. Distance of cropped images is the
+    smallest distance between hashes of their blocks.
+    """
+    INITIAL_CAPACITY = 1024
+    _BUFFERS = ('first', 'second', 'distances', 'scores', 'transforms', 'removed')
+
+    def __init__(self, max_radius: int):
+        self.max_radius: int = max_radius
+        # Pairs are kept in buffers with room for more of them, which double when they're full, so adding pairs
+        # doesn't copy all previous ones. Only first count pairs are used. Pairs of removed images are only marked.
+        self.count: int = 0
+        self.removed_count: int = 0
+        self.first = numpy.zeros(self.INITIAL_CAPACITY, dtype=numpy.int64)
+        self.second = numpy.zeros(self.INITIAL_CAPACITY, dtype=numpy.int64)
+        self.distances = numpy.zeros(self.INITIAL_CAPACITY, dtype=numpy.uint8)
+        # NaN for pairs which pixels weren't compared
+        self.scores = numpy.zeros(self.INITIAL_CAPACITY, dtype=numpy.float32)
+        self.transforms = numpy.zeros(self.INITIAL_CAPACITY, dtype=numpy.uint8)
+        self.removed = numpy.zeros(self.INITIAL_CAPACITY, dtype=bool)
+        self.positions: Dict[int, List[numpy.ndarray]] = {}  # Positions of pairs of each row
+        self.has_transforms: bool = False
+        self.images: Dict[int, ImageInfo] = {}
+
+    def __len__(self):
+        return self.count - self.removed_count
+
+    def _reserve(self, size: int):
+        capacity = len(self.first)
+        if self.count + size <= capacity:
+            return
+        capacity = max(capacity * 2, self.count + size)
+        for name in self._BUFFERS:
+            old = getattr(self, name)
+            buffer = numpy.zeros(capacity, dtype=old.dtype)
+            buffer[:self.count] = old[:self.count]
+            setattr(self, name, buffer)
+
+    def add(self, catalog: ImageCatalog, pairs: Pairs, scores: Optional[numpy.ndarray] = None,
+            transforms: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+        """Adds pairs of rows of the catalog and returns distances between their (transformed) hashes."""
+        first, second = pairs
+        if transforms is None:
+            transforms = numpy.zeros(len(first), dtype=numpy.uint8)
+        distances = popcount(catalog.transformed_hashes(first, transforms) ^ catalog.hashes[second])
+        distances = distances.astype(numpy.uint8)
+        crops = transforms == CROP
+        if crops.any():
+            distances[crops] = catalog.block_matches(first[crops], second[crops], BLOCK_RADIUS)[2]
+        self._reserve(len(first))
+        start, end = self.count, self.count + len(first)
+        self.first[start:end] = first
+        self.second[start:end] = second
+        self.distances[start:end] = distances
+        self.scores[start:end] = scores if scores is not None else numpy.nan
+        self.transforms[start:end] = transforms
+        self.count = end
+        self.has_transforms |= bool(transforms.any())
+        rows = numpy.concatenate(pairs)
+        order = numpy.argsort(rows, kind='stable')
+        rows, starts = numpy.unique(rows[order], return_index=True)
+        positions = numpy.tile(numpy.arange(start, end), 2)[order]
+        for row, row_positions in zip(rows.tolist(), numpy.split(positions, starts[1:])):
+            self.positions.setdefault(row, []).append(row_positions)
+            if row not in self.images:
+                self.images[row] = catalog.image(row)
+        return distances
+
+    def remove(self, row: int):
+        for positions in self.positions.pop(row, ()):
+            positions = positions[~self.removed[positions]]
+            self.removed[positions] = True
+            self.removed_count += len(positions)
+        self.images.pop(row, None)
+
+    def _within(self, radius: int, rows: Optional[Iterable[int]] = None) -> numpy.ndarray:
+        """Positions of pairs within the radius. Only pairs of given rows are returned, if they are given."""
+        if rows is None:
+            return numpy.flatnonzero(~self.removed[:self.count] & (self.distances[:self.count] <= radius))
+        rows = numpy.fromiter(rows, dtype=numpy.int64)
+        positions = [positions for row in rows.tolist() for positions in self.positions.get(row, ())]
+        if not positions:
+            return numpy.zeros(0, dtype=numpy.int64)
+        positions = numpy.unique(numpy.concatenate(positions))
+        keep = ~self.removed[positions] & (self.distances[positions] <= radius)
+        keep &= numpy.isin(self.first[positions], rows) & numpy.isin(self.second[positions], rows)
+        return positions[keep]
+
+    def components(self, radius: int, rows: Optional[Iterable[int]] = None) \
+            -> List[Tuple[numpy.ndarray, Optional[float]]]:
+        """
+        Rows of each group of images similar within the radius, with its lowest score. Only pairs of given rows are
+        used, if they are given.
+        """
+        keep = self._within(radius, rows)
+        if not len(keep):
+            return []
+        rows, inverse = numpy.unique(numpy.concatenate((self.first[keep], self.second[keep])), return_inverse=True)
+        pairs = (inverse[:len(inverse) // 2], inverse[len(inverse) // 2:])
+        scores = self.scores[keep]
+        components = connected_groups(pairs, len(rows))
+        lowest = lowest_scores(pairs, None if numpy.isnan(scores).all() else scores, components, len(rows))
+        return [(rows[component], score) for component, score in zip(components, lowest)]
+
+    def transformed(self, radius: int, rows: Iterable[int]) -> List[Tuple[ImageInfo, ImageInfo, str]]:
+        """
+        Pairs of given rows which are similar within the radius only after the first image is transformed or which
+        are crops of each other.
+        """
+        if not self.has_transforms:
+            return []
+        keep = self._within(radius, rows)
+        keep = keep[self.transforms[keep] > 0]
+        pairs = []
+        found = set()
+        for first, second, transform in zip(self.first[keep].tolist(), self.second[keep].tolist(),
+                                            self.transforms[keep].tolist()):
+            # Pair is usually found from both sides, with inverse transforms.
+            if (second, first) not in found:
+                found.add((first, second))
+                pairs.append((self.images[first], self.images[second], PAIR_TRANSFORMS[transform - 1]))
+        return pairs
+
+    def groups(self, radius: int) -> List[ImageGroup]:
+        groups = []
+        for rows, score in self.components(radius):
+            group = ImageGroup()
+            group.score = score
+            group.transforms = self.transformed(radius, rows.tolist())
+            group.add_images(self.images[row] for row in rows.tolist())
+            groups.append(group)
+        return groups
+
+
+class IncrementalGrouper:
+    """
+    Keeps groups of similar images up to date while images are added and removed, without rebuilding them. Groups are
+    connected components of a graph, in which images are linked if their hashes differ by at most max_distance bits.
+    Images are identified by their rows in the catalog. Removed image must be taken out of groups before it's marked
+    as removed in the catalog.
+
+    Added hashes are put in a live Hamming index, so finding neighbours of a new image doesn't require comparing it
+    with all others. Images can be added in batches, which is much faster when many of them come at once. Neighbours
+    are confirmed by the cascade of stronger hashes, if there is one. They are found up to the maximum radius of the
+    similarity graph and kept there, so images can be grouped again with another max_distance. If the catalog has
+    hashes of rotated and mirrored images, they are queried in the index too. If it has hashes of blocks, they are
+    added to a block index, which finds cropped copies.
+
+    Membership is tracked here and only reported as changes. ImageGroup objects are updated by the receiver of those
+    changes, so they can be owned by the GUI thread. Only their scores and transformed pairs are set here, as they are
+    replaced as a whole.
+    """
+    def __init__(self, catalog: ImageCatalog, max_distance: int, cascade: Optional[HashCascade] = None,
+                 graph: Optional[SimilarityGraph] = None):
+        self.catalog: ImageCatalog = catalog
+        self.max_distance: int = max_distance
+        self.cascade: Optional[HashCascade] = cascade
+        self.graph: SimilarityGraph = graph if graph is not None else SimilarityGraph(max_distance)
+        self.index = LiveHammingIndex(self.graph.max_radius)
+        self.blocks: Optional[BlockIndex] = BlockIndex() if catalog.blocks else None
+        self.group_of: Dict[int, int] = {}  # Group id for each row which belongs to a group
+        self.members: Dict[int, Set[int]] = {}
+        self.groups: Dict[int, ImageGroup] = {}
+        self._next_group_id: int = 0
+
+    def load(self, groups: Iterable[ImageGroup]):
+        """Takes over results of a full search of all images in the catalog. Its pairs should be in the graph."""
+        rows = numpy.flatnonzero(self.catalog.valid)
+        self.index.add(rows, self.catalog.hashes[rows])
+        if self.blocks is not None:
+            self.blocks.add(rows, self.catalog.rows['blocks'][rows])
+        for group in groups:
+            self._new_group(group, {image.index for image in group})
+
+    def _new_group(self, group: ImageGroup, members: Set[int]) -> int:
+        id = self._next_group_id
+        self._next_group_id += 1
+        self.groups[id] = group
+        self.members[id] = members
+        for row in members:
+            self.group_of[row] = id
+        return id
+
+    def _drop_group(self, id: int) -> ImageGroup:
+        for row in self.members.pop(id):
+            if self.group_of.get(row) == id:
+                del self.group_of[row]
+        return self.groups.pop(id)
+
+    def _images_of(self, id: int) -> List[ImageInfo]:
+        return sorted((self.catalog.image(row) for row in self.members[id]), key=lambda image: image.path)
+
+    def _components(self, rows: Set[int]) -> List[Tuple[Set[int], Optional[float]]]:
+        """Splits rows into groups of similar images, each with its score. Drops rows which aren't similar to any."""
+        return [(set(component.tolist()), score) for component, score in self.graph.components(self.max_distance, rows)]
+
+    def _set_transforms(self, id: int):
+        self.groups[id].transforms = self.graph.transformed(self.max_distance, self.members[id])
+
+    def add(self, rows: Sequence[int]) -> List[Change]:
+        """Adds images in given rows, which weren't added before."""
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        first, second = self.index.add(rows, self.catalog.hashes[rows])
+        transforms = numpy.zeros(len(first), dtype=numpy.uint8)
+        if self.catalog.transforms:
+            pairs = transformed_pairs(self.index.query, rows,
+                                      [self.catalog.rows[name][rows] for name in self.catalog.transforms])
+            first, second, transforms = (numpy.concatenate(parts) for parts in zip((first, second, transforms), pairs))
+        if self.blocks is not None:
+            pairs = crop_pairs(self.catalog, self.blocks.add(rows, self.catalog.rows['blocks'][rows]))
+            first, second, transforms = (numpy.concatenate(parts) for parts in zip((first, second, transforms), pairs))
+        # Images removed in the meantime stay in the index, but aren't linked to anything.
+        valid = self.catalog.valid
+        keep = valid[first] & valid[second]
+        first, second, transforms = first[keep], second[keep], transforms[keep]
+        scores = None
+        if self.cascade:
+            (first, second), scores, transforms = self.cascade.confirm((first, second), transforms)
+        keep = self.graph.add(self.catalog, (first, second), scores, transforms) <= self.max_distance
+        first, second = first[keep], second[keep]
+        scores = scores[keep] if scores is not None else None
+        if not len(first):
+            return []
+        # Graph of images linked by new pairs, in which each existing group is an additional node linked to its
+        # members. Its components are images which should end up in the same group.
+        linked = numpy.unique(numpy.concatenate((first, second)))
+        group_of = numpy.array([self.group_of.get(int(row), -1) for row in linked])
+        in_group = numpy.flatnonzero(group_of >= 0)
+        group_ids, group_nodes = numpy.unique(group_of[in_group], return_inverse=True)
+        pairs = (numpy.concatenate((numpy.searchsorted(linked, first), in_group)),
+                 numpy.concatenate((numpy.searchsorted(linked, second), group_nodes + len(linked))))
+        components = connected_groups(pairs, len(linked) + len(group_ids))
+        # Scores of new pairs, which come first. Links to group nodes aren't pairs of images.
+        new_pairs = (pairs[0][:len(first)], pairs[1][:len(first)])
+        lowest = lowest_scores(new_pairs, scores, components, len(linked) + len(group_ids))
+        changes = []
+        for component, score in zip(components, lowest):
+            ids = [int(id) for id in group_ids[component[component >= len(linked)] - len(linked)]]
+            nodes = component[component < len(linked)]
+            new_members = {int(row) for row in linked[nodes][group_of[nodes] < 0]}
+            if not ids:
+                group = ImageGroup()
+                group.score = score
+                id = self._new_group(group, new_members)
+                self._set_transforms(id)
+                group.add_images(self._images_of(id))
+                changes.append(Change(GroupChange.ADDED, group, group.images))
+                continue
+            # New images can connect several groups. All of them are merged into the biggest one.
+            main_id = max(ids, key=lambda i: len(self.members[i]))
+            merged = []
+            for id in ids:
+                if id != main_id:
+                    new_members.update(self.members[id])
+                    merged.append(self._drop_group(id))
+            if score is not None:
+                self.groups[main_id].score = min([score] + [g.score for g in [self.groups[main_id], *merged]
+                                                            if g.score is not None])
+            self.members[main_id].update(new_members)
+            for member in new_members:
+                self.group_of[member] = main_id
+            self._set_transforms(main_id)
+            change = GroupChange.MERGED if merged else GroupChange.CHANGED
+            changes.append(Change(change, self.groups[main_id], self._images_of(main_id), merged))
+        return changes
+
+    def regroup(self, max_distance: int) -> List[ImageGroup]:
+        """Groups all images again, using pairs in the graph. Returns new groups, which replace all previous ones."""
+        self.max_distance = max_distance
+        self.group_of.clear()
+        self.members.clear()
+        self.groups.clear()
+        groups = []
+        for rows, score in self.graph.components(max_distance):
+            group = ImageGroup()
+            group.score = score
+            id = self._new_group(group, set(rows.tolist()))
+            self._set_transforms(id)
+            group.add_images(self._images_of(id))
+            groups.append(group)
+        return groups
+
+    def remove(self, row: int) -> List[Change]:
+        self.graph.remove(row)
+        id = self.group_of.pop(row, None)
+        if id is None:
+            return []
+        members = self.members[id]
+        members.discard(row)
+        # Removed image could be the only link between parts of the group.
+        components = self._components(members) if len(members) > 1 else []
+        if not components:
+            return [Change(GroupChange.REMOVED, self._drop_group(id), [])]
+        components.sort(key=lambda component: len(component[0]), reverse=True)
+        changes = []
+        for component, score in components[1:]:
+            members.difference_update(component)
+            group = ImageGroup()
+            group.score = score
+            new_id = self._new_group(group, component)
+            self._set_transforms(new_id)
+            group.add_images(self._images_of(new_id))
+            changes.append(Change(GroupChange.ADDED, group, group.images))
+        for member in members - components[0][0]:
+            del self.group_of[member]
+        self.members[id] = components[0][0]
+        self.groups[id].score = components[0][1]
+        self._set_transforms(id)
+        changes.insert(0, Change(GroupChange.CHANGED, self.groups[id], self._images_of(id)))
+        return changes
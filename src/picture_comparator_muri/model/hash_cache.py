@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+from typing import Optional, List, Tuple, Iterable, Dict, Sequence
+
+from picture_comparator_muri.model.hashing import HashResult, pack_hash, unpack_hash
+
+FileEntry = Tuple[str, str, os.stat_result]  # path, real path, stat of the real path
+
+
+class SnapshotStat:
+    """Stands in for os.stat_result of files restored from a directory snapshot, which were not accessed again."""
+    def __init__(self, st_size: int, st_mtime_ns: int, st_ino: int, st_dev: int):
+        self.st_size = st_size
+        self.st_mtime_ns = st_mtime_ns
+        self.st_ino = st_ino
+        self.st_dev = st_dev
+
+
+class DirectorySnapshot:
+    """
+    Content of a directory at the time it was last listed. Real paths are stored only for symbolic links, as all other
+    entries are resolved relative to the real path of the directory.
+    """
+    def __init__(self, real_path: str, mtime_ns: int):
+        self.real_path = real_path
+        self.mtime_ns = mtime_ns
+        self.dirs: List[Tuple[str, Optional[str]]] = []  # name, real path
+        self.files: List[Tuple[str, Optional[str], int, int, int, int]] = []  # name, real path, size, mtime, ino, dev
+
+    def add_dir(self, name: str, real_path: str):
+        self.dirs.append((name, real_path if real_path != os.path.join(self.real_path, name) else None))
+
+    def add_file(self, name: str, real_path: str, stat: os.stat_result):
+        self.files.append((name, real_path if real_path != os.path.join(self.real_path, name) else None,
+                           stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev))
+
+    def restore_dirs(self, directory: str) -> List[Tuple[str, str]]:
+        return [(os.path.join(directory, name), real_path or os.path.join(self.real_path, name))
+                for name, real_path in self.dirs]
+
+    def restore_files(self, directory: str) -> List[FileEntry]:
+        return [(os.path.join(directory, name), real_path or os.path.join(self.real_path, name),
+                 SnapshotStat(size, mtime_ns, ino, dev))
+                for name, real_path, size, mtime_ns, ino, dev in self.files]
+
+    def file_real_paths(self) -> List[str]:
+        return [real_path or os.path.join(self.real_path, name) for name, real_path, *_ in self.files]
+
+    def dumps(self) -> str:
+        return json.dumps({'dirs': self.dirs, 'files': self.files})
+
+    @classmethod
+    def loads(cls, real_path: str, mtime_ns: int, content: str) -> DirectorySnapshot:
+        snapshot = cls(real_path, mtime_ns)
+        data = json.loads(content)
+        snapshot.dirs = [tuple(d) for d in data['dirs']]
+        snapshot.files = [tuple(f) for f in data['files']]
+        return snapshot
+
+
+def default_cache_dir() -> str:
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'picture_comparator_muri')
+
+
+class HashCache:
+    """
+    Keeps results of hashing between runs. Entry is valid as long as size, modification time and inode of the file
+    didn't change. Files which turned out not to be images are stored as well, so they don't need to be checked again.
+    Also keeps snapshots of directories used by incremental scans.
+    Each image can have several kinds of hashes. Entry is used only if it has the main hash and required ones, other
+    ones (and thumbnail used to compare pixels) are optional. Hashes of fully decoded images and of images rotated by
+    their EXIF orientation are stored as separate kinds of the main hash, with '+full' and '+exif' suffixes.
+    Entries of byte-identical copies point to their original, so they are linked to it again without being read.
+    Can be shared by threads, access to the database is serialized.
+    """
+    # Increase whenever hashing algorithm or table layout changes. Cache with different version is dropped.
+    SCHEMA_VERSION = 6
+    BATCH_SIZE = 500  # Stays below the SQLite limit of variables in a single query.
+
+    def __init__(self, path: Optional[str] = None, hash_kind: str = 'whash', required: Sequence[str] = ()):
+        self.hash_kind: str = hash_kind  # Main hash, stored in hash of results
+        self.required: List[str] = list(required)
+        if path is None:
+            path = os.path.join(default_cache_dir(), 'hashes.sqlite')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self._to_write: List[HashResult] = []
+        self._snapshots_to_write: List[DirectorySnapshot] = []
+        self._prepare()
+
+    def _prepare(self):
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        with self.connection:
+            if version != self.SCHEMA_VERSION:
+                self.connection.execute('DROP TABLE IF EXISTS files')
+                self.connection.execute('DROP TABLE IF EXISTS directories')
+                self.connection.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    real_path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    inode INTEGER NOT NULL,
+                    hashes TEXT,
+                    thumbnail BLOB,
+                    width INTEGER,
+                    height INTEGER,
+                    format TEXT,
+                    error TEXT,
+                    message TEXT,
+                    original TEXT,
+                    original_mtime_ns INTEGER
+                )''')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS directories (
+                    real_path TEXT PRIMARY KEY,
+                    mtime_ns INTEGER NOT NULL,
+                    content TEXT NOT NULL
+                )''')
+
+    def lookup(self, files: Iterable[FileEntry]) -> Tuple[List[HashResult], List[FileEntry]]:
+        """Splits files into those with valid cached results and those which still need to be hashed."""
+        with self.lock:
+            files = list(files)
+            rows: Dict[str, Tuple] = {}
+            for start in range(0, len(files), self.BATCH_SIZE):
+                batch = files[start:start + self.BATCH_SIZE]
+                query = 'SELECT * FROM files WHERE real_path IN (%s)' % ','.join('?' * len(batch))
+                for row in self.connection.execute(query, [real_path for _, real_path, _ in batch]):
+                    rows[row[0]] = row
+
+            found: List[HashResult] = []
+            missing: List[FileEntry] = []
+            for path, real_path, stat in files:
+                row = rows.get(real_path)
+                hashes = json.loads(row[4]) if row is not None and row[4] is not None else None
+                if row is None or row[1:4] != (stat.st_size, stat.st_mtime_ns, stat.st_ino) or \
+                        hashes is not None and any(kind not in hashes for kind in [self.hash_kind, *self.required]):
+                    missing.append((path, real_path, stat))
+                    continue
+                _, _, _, _, _, thumbnail, width, height, format, error, message, original, original_mtime_ns = row
+                # Main hash stays among others, as it can be one of hashes confirming similarity too.
+                result = HashResult(path, real_path, unpack_hash(hashes[self.hash_kind])
+                                    if hashes is not None else None, error, message)
+                result.hashes = hashes or {}
+                result.thumbnail = thumbnail
+                result.width, result.height, result.format = width, height, format
+                result.stat = stat
+                result.from_cache = True
+                if original is not None:
+                    result.original = (original, original_mtime_ns)
+                found.append(result)
+            return found, missing
+
+    def add(self, result: HashResult):
+        """Schedules result to be saved. Results are written in batches."""
+        with self.lock:
+            if result.stat is None:
+                return
+            self._to_write.append(result)
+            if len(self._to_write) >= self.BATCH_SIZE:
+                self.flush()
+
+    def snapshot(self, real_path: str, mtime_ns: Optional[int] = None) -> Optional[DirectorySnapshot]:
+        """Returns stored snapshot of the directory. If mtime_ns is given, returns it only if it's still valid."""
+        with self.lock:
+            row = self.connection.execute('SELECT mtime_ns, content FROM directories WHERE real_path = ?',
+                                          (real_path,)).fetchone()
+            if row is None or mtime_ns is not None and row[0] != mtime_ns:
+                return None
+            return DirectorySnapshot.loads(real_path, row[0], row[1])
+
+    def add_snapshot(self, snapshot: DirectorySnapshot):
+        with self.lock:
+            self._snapshots_to_write.append(snapshot)
+            if len(self._snapshots_to_write) >= self.BATCH_SIZE:
+                self.flush()
+
+    def _flush_snapshots(self):
+        """Writes new snapshots and drops hashes of files which disappeared since previous ones were taken."""
+        removed: List[str] = []
+        for snapshot in self._snapshots_to_write:
+            old = self.snapshot(snapshot.real_path)
+            if old is not None:
+                removed.extend(set(old.file_real_paths()).difference(snapshot.file_real_paths()))
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO directories VALUES (?, ?, ?)',
+                                        [(s.real_path, s.mtime_ns, s.dumps()) for s in self._snapshots_to_write])
+            self.connection.executemany('DELETE FROM files WHERE real_path = ?', [(path,) for path in removed])
+        self._snapshots_to_write.clear()
+
+    def flush(self):
+        with self.lock:
+            if self._snapshots_to_write:
+                self._flush_snapshots()
+            if not self._to_write:
+                return
+            rows = []
+            for result in self._to_write:
+                hashes = None
+                if result.hash is not None:
+                    hashes = json.dumps({self.hash_kind: pack_hash(result.hash), **result.hashes})
+                original, original_mtime_ns = result.original or (None, None)
+                rows.append((result.real_path, result.stat.st_size, result.stat.st_mtime_ns, result.stat.st_ino, hashes,
+                             result.thumbnail, result.width, result.height, result.format, result.error,
+                             result.message, original, original_mtime_ns))
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO files VALUES '
+                                            '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self._to_write.clear()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.connection.close()
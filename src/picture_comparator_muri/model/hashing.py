@@ -0,0 +1,460 @@
+from __future__ import annotations
+
+import hashlib
+import multiprocessing
+import os
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from enum import Enum
+from functools import partial
+from typing import Optional, Tuple, Dict, List, Sequence, Callable, Iterable, Any
+
+import imagehash
+from PIL import Image, UnidentifiedImageError
+
+from picture_comparator_muri.model.exceptions import ImageTooBigException
+from picture_comparator_muri.model.file_type import detect_format
+
+# This module is imported by worker processes, so it must not depend on Qt.
+
+# Limit of pixels for decoding in full resolution.
+SIZE_LIMIT = 0x2000000
+# Limit of memory taken by a single decode in reduced resolution. Images which can be decoded in lower resolution
+# (or contain smaller version of themselves) are hashed even if they exceed SIZE_LIMIT.
+DECODE_MEMORY_LIMIT = 0x10000000
+# Size to which image is scaled before the wavelet transform. It is fixed, so the hash doesn't depend on resolution
+# in which image was decoded.
+HASH_IMAGE_SCALE = 64
+# Reduced image keeps a margin over the hashing scale, so resampling it gives the same result as resampling full one.
+REDUCED_SIZE = HASH_IMAGE_SCALE * 4
+REDUCIBLE_MODES = {'L', 'LA', 'RGB', 'RGBA', 'I', 'F'}
+# Side of grayscale thumbnails used to compare pixels of images.
+THUMBNAIL_SIZE = 64
+
+HashBits = Tuple[bool, ...]
+PackedHash = int  # Bits of the hash packed into a single number, first bit being the most significant one
+
+HASH_FUNCTIONS: Dict[str, Callable[[Image.Image], imagehash.ImageHash]] = {
+    'ahash': imagehash.average_hash,
+    'dhash': imagehash.dhash,
+    'phash': imagehash.phash,
+    'whash': partial(imagehash.whash, image_scale=HASH_IMAGE_SCALE),
+    'colorhash': partial(imagehash.colorhash, binbits=3),  # 42 bits: 14 bins of colors
+}
+# Hashes of 64 bits, which can be used by neighbour index to find candidates. The others only confirm them.
+CANDIDATE_HASHES = ['ahash', 'dhash', 'phash', 'whash']
+# Key of the digest of decoded pixels among other hashes of an image. It tells which images are identical.
+PIXEL_DIGEST = 'pixels'
+# Rotations and mirrorings of an image, other than the image as it is. Hashes of images transformed this way are
+# stored among other hashes, by names of transforms. In arrays, transforms are numbered from 1, 0 meaning none.
+TRANSFORMS: Dict[str, Image.Transpose] = {
+    'mirror': Image.Transpose.FLIP_LEFT_RIGHT,
+    'flip': Image.Transpose.FLIP_TOP_BOTTOM,
+    'rotate90': Image.Transpose.ROTATE_90,  # Counterclockwise
+    'rotate180': Image.Transpose.ROTATE_180,
+    'rotate270': Image.Transpose.ROTATE_270,
+    'transpose': Image.Transpose.TRANSPOSE,
+    'transverse': Image.Transpose.TRANSVERSE,
+}
+TRANSFORM_NAMES = list(TRANSFORMS)
+# Pairs of images of which one is a crop of the other (or of the other with a border) are numbered after transforms.
+CROP = len(TRANSFORMS) + 1
+PAIR_TRANSFORMS = TRANSFORM_NAMES + ['crop']
+# Overlapping parts of an image (blocks) hashed separately, so images which differ by a crop or a border still share
+# some of them. Each block spans one of BLOCK_RANGES horizontally and one vertically, as fractions of the image.
+BLOCK_RANGES = [(0, 1), (0, .9), (.1, 1), (.1, .9), (0, .8), (.2, 1)]
+BLOCKS = [(left, top, right, bottom) for top, bottom in BLOCK_RANGES for left, right in BLOCK_RANGES]
+# Hashes of blocks are stored among other hashes, under these names.
+BLOCK_NAMES = [f'block{i}' for i in range(len(BLOCKS))]
+EXIF_ORIENTATION_TAG = 0x0112
+# Transforms which show the image as intended, by value of its EXIF orientation tag.
+EXIF_TRANSFORMS: Dict[int, Image.Transpose] = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+class HashDecoding(Enum):
+    REDUCED = 'reduced'
+    FULL = 'full'
+    COMPARE = 'compare'  # Computes hash both ways and reports differences. Used to verify reduced decoding.
+
+
+class HashResult:
+    """Outcome of hashing a single file. Travels between processes, so it has to stay picklable."""
+    def __init__(self, path: str, real_path: str, hash: Optional[HashBits] = None,
+                 error: Optional[str] = None, message: Optional[str] = None):
+        self.path = path
+        self.real_path = real_path
+        self.hash: Optional[HashBits] = hash
+        self.hashes: Dict[str, PackedHash] = {}  # Hashes used to confirm similarity, by name, if they were computed
+        self.thumbnail: Optional[bytes] = None  # Grayscale pixels, THUMBNAIL_SIZE squared, if it was requested
+        self.width: Optional[int] = None
+        self.height: Optional[int] = None
+        self.format: Optional[str] = None
+        self.error: Optional[str] = error  # Short reason shown to the user
+        self.message: Optional[str] = message  # Detailed description of an error
+        self.stat: Optional[os.stat_result] = None  # Filled in by the scanning thread, not by workers
+        self.reduced_distance: Optional[int] = None  # Set only when comparing reduced and full decoding
+        self.from_cache: bool = False
+        # Real path and modification time of the file which this one is a byte-identical copy of. Kept in the cache,
+        # so the copy isn't read again to find it.
+        self.original: Optional[Tuple[str, int]] = None
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path})'
+
+    @property
+    def is_image(self) -> bool:
+        return self.hash is not None
+
+
+def _file_name(image: Image.Image) -> str:
+    # Images opened from file objects don't have a name.
+    name = getattr(image, 'filename', None)
+    return name if isinstance(name, str) else ''
+
+
+def decoded_size(image: Image.Image) -> int:
+    """Estimates memory needed to decode the image. PIL keeps images with 3 and 4 channels in 4 bytes per pixel."""
+    if image.mode in ('1', 'L', 'P'):
+        pixel_size = 1
+    elif image.mode.startswith('I;16'):
+        pixel_size = 2
+    else:
+        pixel_size = 4
+    if image.mode not in REDUCIBLE_MODES:
+        pixel_size += 1  # Converted copy
+    return image.width * image.height * pixel_size
+
+
+def _smallest_sufficient_frame(image: Image.Image):
+    """Picks smallest page of multi-page TIFF, which is a reduced copy of the main one and is enough for hashing."""
+    width, height = image.size
+    best = None
+    for frame in range(getattr(image, 'n_frames', 1)):
+        image.seek(frame)
+        w, h = image.size
+        if min(w, h) >= REDUCED_SIZE and abs(w / h - width / height) < .01 and (best is None or w < best[1]):
+            best = (frame, w)
+    image.seek(best[0] if best else 0)
+
+
+def reduce_for_hashing(image: Image.Image, color: bool = False) -> Image.Image:
+    """
+    Decodes image in the lowest resolution which is still enough for hashing. Raises ImageTooBigException if that
+    would take more memory than DECODE_MEMORY_LIMIT. Colors are dropped, unless they are needed by the hash.
+    """
+    if image.format == 'JPEG':
+        # Decoder scales DCT coefficients, so the image is decoded directly at 1/2, 1/4 or 1/8 of its size.
+        image.draft('RGB' if color else 'L', (REDUCED_SIZE, REDUCED_SIZE))
+    elif image.format == 'TIFF' and decoded_size(image) > DECODE_MEMORY_LIMIT:
+        _smallest_sufficient_frame(image)
+    if decoded_size(image) > DECODE_MEMORY_LIMIT:
+        raise ImageTooBigException(_file_name(image))
+    factor = min(image.width, image.height) // REDUCED_SIZE
+    if factor > 1:
+        if image.mode not in REDUCIBLE_MODES:
+            image = image.convert('RGB' if color else 'L')
+        image = image.reduce(factor)
+    return image
+
+
+def prepare_for_hashing(image: Image.Image, reduced: bool = True, color: bool = False) -> Image.Image:
+    if reduced:
+        return reduce_for_hashing(image, color)
+    if image.width * image.height >= SIZE_LIMIT:
+        raise ImageTooBigException(_file_name(image))
+    return image
+
+
+def hashes_of(image: Image.Image, kinds: Sequence[str]) -> Dict[str, PackedHash]:
+    """Computes hashes of given kinds of prepared image."""
+    return {kind: pack_hash(bool(bit) for bit in HASH_FUNCTIONS[kind](image).hash.flatten()) for kind in kinds}
+
+
+def transformed_hashes(image: Image.Image, kind: str) -> Dict[str, PackedHash]:
+    """Hashes of the prepared image after each of TRANSFORMS, by their names."""
+    return {name: hashes_of(image.transpose(method), [kind])[kind] for name, method in TRANSFORMS.items()}
+
+
+def exif_orientation(image: Image.Image) -> Optional[int]:
+    try:
+        return image.getexif().get(EXIF_ORIENTATION_TAG)
+    except (OSError, ValueError, SyntaxError):  # Broken metadata
+        return None
+
+
+def orient(image: Image.Image, orientation: Optional[int]) -> Image.Image:
+    """Rotates or mirrors the image as given by its EXIF orientation."""
+    method = EXIF_TRANSFORMS.get(orientation)
+    return image.transpose(method) if method is not None else image
+
+
+def image_hashes(image: Image.Image, kinds: Sequence[str], reduced: bool = True) -> Dict[str, PackedHash]:
+    """Computes hashes of given kinds. Image is decoded only once for all of them."""
+    return hashes_of(prepare_for_hashing(image, reduced, 'colorhash' in kinds), kinds)
+
+
+def pixel_thumbnail(image: Image.Image) -> bytes:
+    """Grayscale pixels of the image scaled to a square, which doesn't depend on resolution in which it was decoded."""
+    return image.convert('L').resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.Resampling.BOX).tobytes()
+
+
+def block_box(block: int) -> Tuple[int, int, int, int]:
+    """Pixels of the thumbnail covered by the block, as a box for Image.crop."""
+    return tuple(round(fraction * THUMBNAIL_SIZE) for fraction in BLOCKS[block])
+
+
+def block_hashes(thumbnail: bytes) -> Dict[str, PackedHash]:
+    """Difference hashes of blocks of the thumbnail, by their names. They are cheap, as the thumbnail is small."""
+    image = Image.frombytes('L', (THUMBNAIL_SIZE, THUMBNAIL_SIZE), thumbnail)
+    return {name: pack_hash(bool(bit) for bit in imagehash.dhash(image.crop(block_box(block))).hash.flatten())
+            for block, name in enumerate(BLOCK_NAMES)}
+
+
+def pixel_digest(image: Image.Image) -> PackedHash:
+    """
+    Digest of pixels of the image decoded in full resolution and converted to RGBA, so it doesn't depend on format
+    of the file. Images with the same digest look the same.
+    """
+    digest = hashlib.blake2b(f'{image.width}x{image.height}'.encode(), digest_size=8)
+    digest.update(image.convert('RGBA').tobytes())
+    # The highest bit is always set, so digest is never 0, which means unknown one.
+    return int.from_bytes(digest.digest(), 'big') | 1 << 63
+
+
+def compute_pixel_digest(real_path: str) -> Optional[PackedHash]:
+    """Decodes the file in full resolution for pixel_digest. Returns None if it fails. Runs inside worker processes."""
+    try:
+        with Image.open(real_path) as image:
+            if image.width * image.height >= SIZE_LIMIT:
+                return None
+            return pixel_digest(image)
+    except (UnidentifiedImageError, OSError, ValueError):
+        return None
+
+
+def image_hash(image: Image.Image, reduced: bool = True, kind: str = 'whash') -> HashBits:
+    return unpack_hash(image_hashes(image, [kind], reduced)[kind])
+
+
+def hash_distance(a: HashBits, b: HashBits) -> int:
+    return sum(x != y for x, y in zip(a, b))
+
+
+def packed_distance(a: PackedHash, b: PackedHash) -> int:
+    return bin(a ^ b).count('1')
+
+
+def pack_hash(hash: Iterable[bool]) -> PackedHash:
+    value = 0
+    for bit in hash:
+        value = value << 1 | bit
+    return value
+
+
+def unpack_hash(value: PackedHash, length: int = 64) -> HashBits:
+    return tuple(bool(value >> i & 1) for i in reversed(range(length)))
+
+
+def compute_hash(path: str, real_path: str, decoding: HashDecoding = HashDecoding.REDUCED, hash_kind: str = 'whash',
+                 other_kinds: Sequence[str] = (), thumbnail: bool = False, transforms: bool = False,
+                 exif: bool = False, blocks: bool = False) -> HashResult:
+    """
+    Hashes the file if it's an image. Hash of the given kind is the main one, others are only stored in the hashes
+    dictionary of the result, as are main hashes of transformed image and hashes of blocks, if they are requested.
+    Thumbnail is made from the same decoded image and blocks are hashed from it. With exif, image is first rotated as
+    given by its EXIF orientation. Runs inside worker processes.
+    """
+    try:
+        with open(real_path, 'rb') as file:
+            if not detect_format(file, path):
+                return HashResult(path, real_path)
+            image = Image.open(file)
+            width, height, format = image.width, image.height, image.format
+            # Reduced image doesn't keep metadata.
+            orientation = exif_orientation(image) if exif else None
+            try:
+                kinds = [hash_kind, *(kind for kind in other_kinds if kind != hash_kind)]
+                image = orient(prepare_for_hashing(image, decoding != HashDecoding.FULL, 'colorhash' in kinds),
+                               orientation)
+                hashes = hashes_of(image, kinds)
+                result = HashResult(path, real_path, unpack_hash(hashes[hash_kind]))
+                # Main hash can be one of other kinds too, when it confirms similarity found with a wider radius.
+                result.hashes = {kind: hashes[kind] for kind in other_kinds}
+                if transforms:
+                    result.hashes.update(transformed_hashes(image, hash_kind))
+                if thumbnail or blocks:
+                    pixels = pixel_thumbnail(image)
+                    if thumbnail:
+                        result.thumbnail = pixels
+                    if blocks:
+                        result.hashes.update(block_hashes(pixels))
+                if decoding == HashDecoding.COMPARE and width * height < SIZE_LIMIT:
+                    file.seek(0)
+                    full_hash = image_hash(orient(Image.open(file), orientation), False, hash_kind)
+                    result.reduced_distance = hash_distance(result.hash, full_hash)
+            except ImageTooBigException:
+                result = HashResult(path, real_path, error='Image too big',
+                                    message=f'"{path}": image is too big and cannot be loaded.')
+            result.width, result.height, result.format = width, height, format
+            return result
+    except (UnidentifiedImageError, OSError) as e:
+        return HashResult(path, real_path, error='Loading image failed', message=str(e))
+
+
+def _init_worker():
+    """
+    Makes worker ignore Ctrl-C, which is handled by the main process. Otherwise each worker prints a traceback.
+    Workers check size of each decode themselves, before the image is loaded, so PIL's limit, which would refuse to
+    even open big images, is turned off only here.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Image.MAX_IMAGE_PIXELS = None
+
+
+class HashingPool:
+    """
+    Sends decoding and hashing of files to a pool of worker processes. If a worker dies (e.g. decoder of a broken file
+    crashes), all tasks in the pool fail. The pool is then replaced and these tasks are run again one by one in
+    a separate process, so only the file which killed the worker is reported as failed.
+    """
+    PENDING_PER_WORKER = 4
+
+    def __init__(self, workers: Optional[int] = None, decoding: HashDecoding = HashDecoding.REDUCED,
+                 hash_kind: str = 'whash', transforms: bool = False, exif: bool = False, blocks: bool = False):
+        self.workers: int = workers or os.cpu_count() or 1
+        self.decoding: HashDecoding = decoding
+        self.hash_kind: str = hash_kind
+        self.transforms: bool = transforms  # Whether hashes of rotated and mirrored images are computed
+        self.exif: bool = exif
+        self.blocks: bool = blocks  # Whether hashes of blocks are computed
+        self.executor: ProcessPoolExecutor = self._create_executor(self.workers)
+        # Executor is replaced by the thread which first finds it broken. Others use the new one.
+        self.executor_lock = threading.Lock()
+        self.retry_executor: Optional[ProcessPoolExecutor] = None  # Single process running tasks again, one by one
+        self.retry_lock = threading.Lock()
+        # Task, its file and the executor running it, for each future.
+        self.pending: Dict[Future, Tuple[tuple, Optional[os.stat_result], ProcessPoolExecutor]] = {}
+
+    @staticmethod
+    def _create_executor(workers: int) -> ProcessPoolExecutor:
+        # Forking process which already runs Qt threads is not safe, so workers are spawned.
+        return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker)
+
+    @property
+    def is_full(self) -> bool:
+        return len(self.pending) >= self.workers * self.PENDING_PER_WORKER
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _replace_executor(self, broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+        with self.executor_lock:
+            if self.executor is broken:
+                broken.shutdown(wait=False)
+                self.executor = self._create_executor(self.workers)
+            return self.executor
+
+    def _submit(self, task: tuple) -> Tuple[Future, ProcessPoolExecutor]:
+        executor = self.executor
+        try:
+            return executor.submit(*task), executor
+        except BrokenProcessPool:  # Worker died since the last result was collected
+            executor = self._replace_executor(executor)
+            return executor.submit(*task), executor
+
+    def _result(self, future: Future, executor: ProcessPoolExecutor, task: tuple) -> Any:
+        """
+        Returns result of the task. If a worker died, the task is run again alone, to tell whether it was the one
+        which killed it. Raises BrokenProcessPool only in that case.
+        """
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            self._replace_executor(executor)
+        with self.retry_lock:
+            if self.retry_executor is None:
+                self.retry_executor = self._create_executor(1)
+            try:
+                return self.retry_executor.submit(*task).result()
+            except BrokenProcessPool:
+                self.retry_executor.shutdown(wait=False)
+                self.retry_executor = None
+                raise
+
+    def _hash_result(self, future: Future, executor: ProcessPoolExecutor, task: tuple) -> HashResult:
+        path, real_path = task[1:3]
+        try:
+            return self._result(future, executor, task)
+        except BrokenProcessPool:
+            return HashResult(path, real_path, error='Loading image failed',
+                              message=f'"{path}": worker process crashed while loading the image.')
+        except Exception as e:  # Result couldn't be transferred
+            return HashResult(path, real_path, error='Loading image failed', message=str(e))
+
+    def submit(self, path: str, real_path: str, stat: Optional[os.stat_result] = None):
+        task = (compute_hash, path, real_path, self.decoding, self.hash_kind, (), False, self.transforms, self.exif,
+                self.blocks)
+        future, executor = self._submit(task)
+        self.pending[future] = (task, stat, executor)
+
+    def compute(self, files: Sequence[Tuple[str, str]], other_kinds: Sequence[str],
+                thumbnail: bool = False) -> List[HashResult]:
+        """
+        Hashes files again, computing also hashes of other kinds and thumbnails, and waits for the results. Can be
+        called from another thread than the one submitting files, as it doesn't share the list of pending tasks.
+        """
+        decoding = HashDecoding.FULL if self.decoding == HashDecoding.FULL else HashDecoding.REDUCED
+        tasks = [(compute_hash, path, real_path, decoding, self.hash_kind, other_kinds, thumbnail, False, self.exif)
+                 for path, real_path in files]
+        futures = [self._submit(task) for task in tasks]
+        return [self._hash_result(future, executor, task) for (future, executor), task in zip(futures, tasks)]
+
+    def pixel_digests(self, real_paths: Sequence[str]) -> List[Optional[PackedHash]]:
+        """Computes digests of pixels of files and waits for them. Like compute, can be called from another thread."""
+        tasks = [(compute_pixel_digest, real_path) for real_path in real_paths]
+        futures = [self._submit(task) for task in tasks]
+        digests = []
+        for (future, executor), task in zip(futures, tasks):
+            try:
+                digests.append(self._result(future, executor, task))
+            except Exception:  # Image killed the worker or result couldn't be transferred
+                digests.append(None)
+        return digests
+
+    def collect(self, timeout: Optional[float] = 0) -> List[HashResult]:
+        """Returns results of finished tasks. Waits up to timeout seconds (or indefinitely if it's None) for one."""
+        if not self.pending:
+            return []
+        done, _ = wait(self.pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        results = []
+        for future in done:
+            task, stat, executor = self.pending.pop(future)
+            if future.cancelled():
+                continue
+            result = self._hash_result(future, executor, task)
+            result.stat = stat
+            results.append(result)
+        return results
+
+    def cancel(self):
+        """Drops all queued tasks. Tasks that already started will still finish, but their results are discarded."""
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=True)
+        if self.retry_executor is not None:
+            self.retry_executor.shutdown(wait=True)
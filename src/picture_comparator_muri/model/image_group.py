@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import Iterable, List, Dict
+from typing import Iterable, List, Dict, Optional, Tuple
 
 from PySide6.QtCore import QFile
 
@@ -9,14 +9,28 @@ from picture_comparator_muri.model.image_info import ImageInfo
 class ImageGroup:
     def __init__(self):
         self.images: List[ImageInfo] = []
+        # Lowest structural similarity of pixels of similar images in the group, if they were compared.
+        self.score: Optional[float] = None
+        # Pairs of images which are similar after the first one is rotated or mirrored, with name of the transform,
+        # and pairs of cropped copies, named 'crop'.
+        self.transforms: List[Tuple[ImageInfo, ImageInfo, str]] = []
 
     def add_images(self, images: Iterable[ImageInfo]):
         self.images.extend(images)
         self.images.sort(key=lambda a: a.path)
 
     def set_identical(self):
+        """
+        Marks images with identical pixels. They are bucketed by digests of pixels computed during the search, images
+        without one are identical only to their links and copies.
+        """
+        by_digest: Dict[int, List[ImageInfo]] = {}
         groups: List[List[ImageInfo]] = []
         for image in self.images:
+            digest = image.original.pixel_digest
+            if digest is not None:
+                by_digest.setdefault(digest, []).append(image)
+                continue
             found = False
             for group in groups:
                 if image.is_identical(group[0]):
@@ -26,7 +40,7 @@ class ImageGroup:
             if not found:
                 groups.append([image])
         id = 0
-        for group in groups:
+        for group in [*by_digest.values(), *groups]:
             if len(group) > 1:
                 for image in group:
                     image.identical_group = id
@@ -51,6 +65,9 @@ class ImageGroup:
             if len(group) == 1:
                 group[0].identical_group = None
 
+    def replace_images(self, images: Iterable[ImageInfo]):
+        self.images = sorted(images, key=lambda a: a.path)
+
     def merge(self, other: ImageGroup):
         to_add = []
         for image in other:
@@ -1,17 +1,15 @@
 from __future__ import annotations
 
+import math
 import os
-from typing import Optional, Dict
+from typing import Optional, Dict, Tuple
 
-import imagehash
-import magic
-from PIL import Image
 from PySide6.QtCore import QSize, Qt
-from PySide6.QtGui import QImage
+from PySide6.QtGui import QImage, QImageReader
 from wand.image import Image as WImage
 
-from picture_comparator_muri.model.exceptions import ImageTooBigException
 from picture_comparator_muri.model.file import FileInfo
+from picture_comparator_muri.model.hashing import PackedHash, SIZE_LIMIT
 
 
 class ImageQuality:
@@ -56,77 +54,148 @@ class ImageQuality:
         return cls(*format_map.get(wimage.format, (None, None, None)))
 
 
-class ImageInfo:
-    SIZE_LIMIT = 0x2000000
+class ImageHandle:
+    """
+    Decoded image with its scaled versions and quality. Created on demand for images shown in the GUI, so records of
+    all other images stay small.
+    """
+    SIZE_LIMIT = SIZE_LIMIT
+
+    def __init__(self, path: str):
+        self.path = path
+        self._qimage: Optional[QImage] = None
+        self._scaled: Dict[QSize, QImage] = {}
+        self._scaled_width: Dict[int, int] = {}
+        self._quality: Optional[ImageQuality] = None
+
+    def qimage(self, size: QSize = None) -> QImage:
+        if self._qimage is None:
+            reader = QImageReader(self.path)
+            original = reader.size()
+            pixels = original.width() * original.height()
+            if pixels > self.SIZE_LIMIT:
+                # Huge images are shown in reduced resolution, so they don't take gigabytes of memory.
+                scale = math.sqrt(self.SIZE_LIMIT / pixels)
+                reader.setScaledSize(QSize(int(original.width() * scale), int(original.height() * scale)))
+            self._qimage = reader.read()
+        if size is None:
+            return self._qimage
+        img = self._scaled.get(size)
+        if img is None:
+            img = self._qimage.scaled(size, Qt.KeepAspectRatio)
+            self._scaled[size] = img
+        return img
 
-    def __init__(self, path: str, realpath: str):
+    def scaled_width(self, height: int) -> int:
+        width = self._scaled_width.get(height)
+        if width is None:
+            image = self.qimage()
+            width = round(height * image.width() / image.height()) if image.height() else 0
+            self._scaled_width[height] = width
+        return width
+
+    @property
+    def quality(self) -> ImageQuality:
+        if self._quality is None:
+            wimg = WImage(filename=self.path)
+            self._quality = ImageQuality.from_wimage(wimg)
+        return self._quality
+
+
+class ImageInfo:
+    """
+    Record of a found image. There may be millions of them, so it keeps only what's needed for grouping and takes
+    little memory. Decoded image is kept by ImageHandle, created when the image is shown.
+    """
+    __slots__ = ('path', '_real_path', 'index', 'identical_group', 'hash', 'reduced_distance', 'alias_of', 'selected',
+                 'marked_for_deletion', 'pixel_digest', '_file_size', 'mtime_ns', 'device', 'inode', 'dimensions',
+                 '_handle')
+    SIZE_LIMIT = SIZE_LIMIT
+
+    def __init__(self, path: str, realpath: str, hash: PackedHash):
         self.path = path
-        self.real_path = realpath
+        self._real_path: Optional[str] = realpath if realpath != path else None  # Stored only if it differs
         self.index: Optional[int] = None  # Index in list of all found images
         self.identical_group: Optional[int] = None
-        image = Image.open(path)
-        if image.width * image.height >= self.SIZE_LIMIT:
-            raise ImageTooBigException(path)
-        # a_hash = imagehash.average_hash(image)
-        hash = imagehash.whash(image)
-        self.hash = []
-        for h in hash.hash:
-            self.hash.extend(h)
-        self.hash = tuple(self.hash)
+        self.hash: PackedHash = hash
+        self.reduced_distance: Optional[int] = None
+        # Set for hardlinks, symlinks and byte-identical copies of a file which was already found. Such images share
+        # hash with the original.
+        self.alias_of: Optional[ImageInfo] = None
         self.selected: bool = False
         self.marked_for_deletion: bool = False
-        self._file_size: int = 0
-        self._quality: Optional[ImageQuality] = None
-        self._qimage: Optional[QImage] = None
-        self._catche = {}
-        self._cache_width: Dict[int, int] = {}
+        # Digest of decoded pixels, the same for identical images. Computed during the search only for images which
+        # may be identical to others in their group, and only for originals of aliases.
+        self.pixel_digest: Optional[PackedHash] = None
+        # Taken from the stat of the file when it was found. Unknown for images created with path only.
+        self._file_size: Optional[int] = None
+        self.mtime_ns: Optional[int] = None
+        self.device: Optional[int] = None
+        self.inode: Optional[int] = None
+        self.dimensions: Optional[Tuple[int, int]] = None  # Original size, known if image was hashed
+        self._handle: Optional[ImageHandle] = None
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.path})'
 
     @property
-    def file_size(self):
-        if not self._file_size:
+    def real_path(self) -> str:
+        return self._real_path or self.path
+
+    @property
+    def file_size(self) -> int:
+        if self._file_size is None:
             self._file_size = os.path.getsize(self.path)
         return self._file_size
 
+    def set_file_info(self, size: int, mtime_ns: int, device: int, inode: int):
+        self._file_size = size
+        self.mtime_ns = mtime_ns
+        self.device = device
+        self.inode = inode
+
     @property
     def is_link(self) -> bool:
         return os.path.islink(self.path)
 
-    @classmethod
-    def from_path_if_image(cls, path: str) -> Optional[ImageInfo]:
-        path: str = os.path.abspath(path)
-        realpath: str = os.path.realpath(path)
-        if not os.path.exists(realpath):
-            return None
-        mime = magic.from_file(realpath, mime=True)
-        if not mime.startswith('image/'):
-            return None
-        return cls(path, realpath)
+    def is_same_file(self, other: ImageInfo) -> bool:
+        if self.real_path == other.real_path:
+            return True
+        return self.inode is not None and (self.device, self.inode) == (other.device, other.inode)
+
+    @property
+    def original(self) -> ImageInfo:
+        """Image which hash this one shares, itself if it was hashed on its own."""
+        image = self
+        while image.alias_of is not None:
+            image = image.alias_of
+        return image
 
     def is_identical(self, other: ImageInfo) -> bool:
-        if self.width() != other.width() or self.height() != other.height():
-            return False
-        return self.qimage().bits() == other.qimage().bits()  # TODO; check how time consuming it is
+        """
+        Whether pixels of both images are the same. Other files are compared only by digests of their pixels, so
+        images without one (e.g. ones too big to be decoded in full) are never identical to them.
+        """
+        if self.is_same_file(other) or self.original is other.original:
+            return True
+        digest, other_digest = self.original.pixel_digest, other.original.pixel_digest
+        return digest is not None and digest == other_digest
 
-    def qimage(self, size: QSize = None):
-        if self._qimage is None:
-            self._qimage = QImage(self.path)
-        if size is None:
-            return self._qimage
-        img = self._catche.get(size)
-        if img is None:
-            img = self._qimage.scaled(size, Qt.KeepAspectRatio)
-            self._catche[size] = img
-        return img
+    @property
+    def handle(self) -> ImageHandle:
+        if self._handle is None:
+            self._handle = ImageHandle(self.path)
+        return self._handle
+
+    def release_handle(self):
+        """Frees decoded image. It will be loaded again if needed."""
+        self._handle = None
+
+    def qimage(self, size: QSize = None) -> QImage:
+        return self.handle.qimage(size)
 
     def scaled_width(self, height: int) -> int:
-        width = self._cache_width.get(height)
-        if width is None:
-            image = self.qimage()
-            width = round(height * image.width() / image.height()) if image.height() else 0
-        return width
+        return self.handle.scaled_width(height)
 
     def height(self) -> int:
         return self.qimage().height()
@@ -135,6 +204,9 @@ class ImageInfo:
         return self.qimage().width()
 
     def size(self) -> QSize:
+        """Original size of the image. It may differ from size of qimage, if the image is too big to show in full."""
+        if self.dimensions is not None:
+            return QSize(*self.dimensions)
         return self.qimage().size()
 
     def ratio(self) -> float:
@@ -142,10 +214,7 @@ class ImageInfo:
 
     @property
     def quality(self) -> ImageQuality:
-        if self._quality is None:
-            wimg = WImage(filename=self.path)
-            self._quality = ImageQuality.from_wimage(wimg)
-        return self._quality
+        return self.handle.quality
 
     def __hash__(self):
         return hash(self.path)
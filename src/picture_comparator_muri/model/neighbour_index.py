@@ -0,0 +1,376 @@
+from __future__ import annotations
+
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from itertools import combinations
+from typing import List, Tuple, Optional, Callable, Sequence
+
+import numpy
+from sklearn.neighbors import BallTree
+
+from picture_comparator_muri.model.catalog import popcount, unpack_hashes, informative_blocks
+
+Pairs = Tuple[numpy.ndarray, numpy.ndarray]  # Indices of the first and second element of each pair, first < second
+# Pairs in which the first hash is of a transformed image, with numbers of transforms (from 1). Order doesn't matter.
+TransformedPairs = Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+
+HASH_BITS = 64
+# Block of distances computed at once by brute force. Its XOR takes 8 MB, popcount 1 MB.
+BLOCK_ROWS = 256
+BLOCK_COLUMNS = 4096
+# Brute force is used in auto mode up to this number of hashes per square root of the number of threads, as its time
+# grows with the square of the number of hashes. For bigger collections the Hamming index is faster, unless hashes
+# are very unevenly distributed.
+BRUTE_FORCE_LIMIT = 30000
+
+
+class NeighbourIndex(Enum):
+    AUTO = 'auto'  # Brute force for small and medium collections, Hamming index for bigger ones
+    BRUTE_FORCE = 'brute-force'
+    HAMMING = 'hamming'
+    BALLTREE = 'balltree'
+    COMPARE = 'compare'  # Uses all methods and reports differences. Used to verify them.
+
+
+class HammingIndex:
+    """
+    Exact search of hashes which differ by at most given number of bits, working on packed hashes.
+    Uses multi-index hashing: hashes are split into bands and, if two hashes differ by at most r bits, at least one
+    of m bands differs by at most r // m bits. Hashes are sorted by each band, so candidates are found by binary search
+    for values of the band with up to r // m bits flipped. Candidates are then verified on full hashes.
+    """
+    CHUNK_SIZE = 1 << 16  # Hashes queried at once
+    MAX_CANDIDATES = 1 << 22  # Candidates verified at once. Limits memory when many hashes share values of a band.
+
+    def __init__(self, hashes: numpy.ndarray, radius: int):
+        self.hashes = numpy.ascontiguousarray(hashes, dtype=numpy.uint64)
+        self.radius: int = radius
+        self.bands: int = self._best_band_count(len(self.hashes), radius)
+        widths = [HASH_BITS // self.bands + (i < HASH_BITS % self.bands) for i in range(self.bands)]
+        self.shifts: List[int] = [sum(widths[i + 1:]) for i in range(self.bands)]
+        self.widths: List[int] = widths
+        self.orders: List[numpy.ndarray] = []
+        self.sorted_bands: List[numpy.ndarray] = []
+        for shift, width in zip(self.shifts, self.widths):
+            band = self._band(self.hashes, shift, width)
+            order = numpy.argsort(band, kind='stable')
+            self.orders.append(order)
+            self.sorted_bands.append(band[order])
+
+    @staticmethod
+    def _band(hashes: numpy.ndarray, shift: int, width: int) -> numpy.ndarray:
+        return (hashes >> numpy.uint64(shift)) & numpy.uint64((1 << width) - 1)
+
+    @staticmethod
+    def _flips(width: int, bits: int) -> numpy.ndarray:
+        """All values of given width with at most given number of bits set."""
+        return numpy.array([sum(1 << i for i in ones)
+                            for k in range(bits + 1) for ones in combinations(range(width), k)], dtype=numpy.uint64)
+
+    @staticmethod
+    def _best_band_count(size: int, radius: int) -> int:
+        """Picks number of bands, for which number of binary searches and expected number of candidates is lowest."""
+        def cost(bands: int) -> float:
+            width = HASH_BITS // bands
+            probes = sum(math.factorial(width) // math.factorial(k) // math.factorial(width - k)
+                         for k in range(radius // bands + 1))
+            return bands * probes * (math.log2(size + 1) + size / 2 ** width)
+        return min(range(1, min(radius + 1, HASH_BITS) + 1), key=cost)
+
+    def pairs(self) -> Pairs:
+        """Returns all pairs of indices of hashes which differ by at most radius bits."""
+        return self._search(self.hashes, True)
+
+    def query(self, hashes: numpy.ndarray) -> Pairs:
+        """Returns pairs of indices of given hashes and of hashes in the index, which differ by at most radius bits."""
+        return self._search(numpy.ascontiguousarray(hashes, dtype=numpy.uint64), False)
+
+    def _search(self, hashes: numpy.ndarray, own: bool) -> Pairs:
+        """Searches for hashes similar to given ones. If they are the hashes of the index, each pair is found once."""
+        found = []
+        for start in range(0, len(hashes), self.CHUNK_SIZE):
+            queries = numpy.arange(start, min(start + self.CHUNK_SIZE, len(hashes)))
+            for shift, width, order, sorted_band in zip(self.shifts, self.widths, self.orders, self.sorted_bands):
+                band = self._band(hashes[queries], shift, width)
+                for flip in self._flips(width, self.radius // self.bands):
+                    keys = band ^ flip
+                    left = numpy.searchsorted(sorted_band, keys, 'left')
+                    counts = numpy.searchsorted(sorted_band, keys, 'right') - left
+                    for part in self._batches(counts):
+                        found.append(self._verify(hashes, queries[part], left[part], counts[part], order, own))
+        # The same pair can be found in several bands.
+        found = numpy.unique(numpy.concatenate(found)) if found else numpy.zeros(0, dtype=numpy.int64)
+        return found // len(self.hashes), found % len(self.hashes)
+
+    def _batches(self, counts: numpy.ndarray) -> List[slice]:
+        """Splits queries into parts with at most MAX_CANDIDATES candidates, unless a single query has more."""
+        total = numpy.cumsum(counts)
+        if not len(total) or total[-1] <= self.MAX_CANDIDATES:
+            return [slice(None)]
+        ends = numpy.searchsorted(total, numpy.arange(self.MAX_CANDIDATES, total[-1], self.MAX_CANDIDATES), 'right')
+        bounds = [0] + sorted(set(max(int(end), 1) for end in ends)) + [len(counts)]
+        return [slice(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+    def _verify(self, hashes: numpy.ndarray, queries: numpy.ndarray, left: numpy.ndarray, counts: numpy.ndarray,
+                order: numpy.ndarray, own: bool) -> numpy.ndarray:
+        """Returns pairs of queries and candidates, which are similar, encoded as query * size + candidate."""
+        first = numpy.repeat(queries, counts)
+        # Positions in the sorted band: start of the range of each query, plus offset within it.
+        offsets = numpy.arange(len(first)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        second = order[numpy.repeat(left, counts) + offsets]
+        if own:
+            keep = first < second
+            first, second = first[keep], second[keep]
+        keep = popcount(hashes[first] ^ self.hashes[second]) <= self.radius
+        return first[keep] * len(self.hashes) + second[keep]
+
+
+class LiveHammingIndex:
+    """
+    Hamming index to which hashes are added while it's used, so similar hashes are found as soon as they are computed.
+    HammingIndex can't be extended, so hashes are kept in several of them (segments), each at least twice as big as
+    the next one. Added hashes form a new segment, into which smaller segments are merged, so each hash is indexed
+    again only about log2(n) times.
+    """
+    def __init__(self, radius: int):
+        self.radius: int = radius
+        self.segments: List[HammingIndex] = []
+        self.segment_ids: List[numpy.ndarray] = []
+
+    def __len__(self):
+        return sum(len(ids) for ids in self.segment_ids)
+
+    def add(self, ids: numpy.ndarray, hashes: numpy.ndarray) -> Pairs:
+        """Adds hashes with given ids. Returns pairs of ids of similar hashes, of which at least one was just added."""
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        hashes = numpy.ascontiguousarray(hashes, dtype=numpy.uint64)
+        if not len(ids):
+            return _no_pairs()
+        segment = HammingIndex(hashes, self.radius)
+        first, second = segment.pairs()
+        parts = [(ids[first], ids[second])]
+        for older, older_ids in zip(self.segments, self.segment_ids):
+            first, second = older.query(hashes)
+            parts.append((ids[first], older_ids[second]))
+        if self.segment_ids and len(self.segment_ids[-1]) <= len(ids):
+            while self.segment_ids and len(self.segment_ids[-1]) <= len(ids):
+                ids = numpy.concatenate((self.segment_ids.pop(), ids))
+                hashes = numpy.concatenate((self.segments.pop().hashes, hashes))
+            segment = HammingIndex(hashes, self.radius)
+        self.segments.append(segment)
+        self.segment_ids.append(ids)
+        return _concatenate(parts)
+
+    def query(self, hashes: numpy.ndarray) -> Pairs:
+        """Returns pairs of indices of given hashes and ids of similar hashes in the index."""
+        parts = []
+        for segment, ids in zip(self.segments, self.segment_ids):
+            first, second = segment.query(hashes)
+            parts.append((first, ids[second]))
+        return _concatenate(parts)
+
+
+class BlockIndex:
+    """
+    Inverted index of hashes of blocks of images, which finds images sharing some of their parts, even if they differ
+    as a whole. Each block hash is split into BANDS bands and each band with its value is a key. Images which share keys
+    in at least min_shared distinct blocks are candidates. Blocks of plain areas aren't indexed, as they match blocks
+    of unrelated images. Keys of more than MAX_POSTINGS blocks don't tell images apart either and are skipped, so adding
+    an image takes time proportional to the number of its blocks.
+    Like in LiveHammingIndex, images are added while the index is used and keys are kept sorted in segments.
+    """
+    BANDS = 3
+    BAND_BITS = 2  # Low bits of a key, which hold the number of the band
+    MAX_POSTINGS = 64
+
+    def __init__(self, min_shared: int = 2):
+        self.min_shared: int = min_shared
+        widths = [HASH_BITS // self.BANDS + (i < HASH_BITS % self.BANDS) for i in range(self.BANDS)]
+        self.shifts: List[int] = [sum(widths[i + 1:]) for i in range(self.BANDS)]
+        self.masks: List[int] = [(1 << width) - 1 for width in widths]
+        self.segment_keys: List[numpy.ndarray] = []
+        self.segment_ids: List[numpy.ndarray] = []
+        self.segment_blocks: List[numpy.ndarray] = []
+
+    def __len__(self):
+        return sum(len(ids) for ids in self.segment_ids)
+
+    def _keys(self, ids: numpy.ndarray, blocks: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """Keys of informative blocks, ids of images which have them and numbers of the blocks, sorted by keys."""
+        blocks = numpy.asarray(blocks, dtype=numpy.uint64)
+        informative = numpy.tile(informative_blocks(blocks), self.BANDS)
+        keys = numpy.concatenate([(blocks >> numpy.uint64(shift) & numpy.uint64(mask)) << numpy.uint64(self.BAND_BITS)
+                                  | numpy.uint64(band)
+                                  for band, (shift, mask) in enumerate(zip(self.shifts, self.masks))], axis=1)
+        numbers = numpy.tile(numpy.arange(blocks.shape[1], dtype=numpy.uint8), (len(ids), self.BANDS))
+        ids = numpy.repeat(ids, keys.shape[1]).reshape(keys.shape)
+        keys, ids, numbers = keys[informative], ids[informative], numbers[informative]
+        order = numpy.lexsort((ids, keys))
+        return keys[order], ids[order], numbers[order]
+
+    def add(self, ids: numpy.ndarray, blocks: numpy.ndarray) -> Pairs:
+        """
+        Adds hashes of blocks (array of shape (images, blocks)) of images with given ids. Returns pairs of ids of
+        candidates, of which at least one was just added.
+        """
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        if not len(ids):
+            return _no_pairs()
+        keys, key_ids, numbers = self._keys(ids, blocks)
+        starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+        counts = numpy.diff(numpy.append(starts, len(keys)))
+        group_starts = numpy.repeat(starts, counts)
+        ranks = numpy.arange(len(keys)) - group_starts  # Equal keys added before in this batch
+        postings = numpy.repeat(counts, counts)
+        older = []
+        for segment_keys in self.segment_keys:
+            left = numpy.searchsorted(segment_keys, keys, 'left')
+            older.append((left, numpy.searchsorted(segment_keys, keys, 'right') - left))
+            postings += older[-1][1]
+        informative = postings <= self.MAX_POSTINGS
+        new_ids, new_numbers = key_ids[informative], numbers[informative]
+        # Each key is linked to equal keys added before it. Within the batch, those are of images with lower ids, so
+        # blocks are always counted on the side of the image with the higher id.
+        ranks = ranks[informative]
+        parts = [(numpy.repeat(new_ids, ranks), key_ids[_ranges(group_starts[informative], ranks)],
+                  numpy.repeat(new_numbers, ranks))]
+        for (left, lengths), segment_ids in zip(older, self.segment_ids):
+            lengths = lengths[informative]
+            parts.append((numpy.repeat(new_ids, lengths), segment_ids[_ranges(left[informative], lengths)],
+                          numpy.repeat(new_numbers, lengths)))
+        if self.segment_ids and len(self.segment_ids[-1]) <= len(key_ids):
+            while self.segment_ids and len(self.segment_ids[-1]) <= len(key_ids):
+                keys = numpy.concatenate((self.segment_keys.pop(), keys))
+                key_ids = numpy.concatenate((self.segment_ids.pop(), key_ids))
+                numbers = numpy.concatenate((self.segment_blocks.pop(), numbers))
+            order = numpy.argsort(keys, kind='stable')
+            keys, key_ids, numbers = keys[order], key_ids[order], numbers[order]
+        self.segment_keys.append(keys)
+        self.segment_ids.append(key_ids)
+        self.segment_blocks.append(numbers)
+        return self._shared(*(numpy.concatenate([part[i] for part in parts]) for i in range(3)))
+
+    def _shared(self, first: numpy.ndarray, second: numpy.ndarray, blocks: numpy.ndarray) -> Pairs:
+        """Pairs of different images which share keys in at least min_shared distinct blocks of the first one."""
+        keep = first != second
+        first, second, blocks = first[keep], second[keep], blocks[keep]
+        codes = numpy.minimum(first, second) << 32 | numpy.maximum(first, second)
+        order = numpy.lexsort((blocks, codes))
+        codes, blocks = codes[order], blocks[order]
+        distinct = numpy.ones(len(codes), dtype=bool)
+        distinct[1:] = (codes[1:] != codes[:-1]) | (blocks[1:] != blocks[:-1])
+        codes, counts = numpy.unique(codes[distinct], return_counts=True)
+        codes = codes[counts >= self.min_shared]
+        return codes >> 32, codes & 0xFFFFFFFF
+
+
+def _ranges(starts: numpy.ndarray, lengths: numpy.ndarray) -> numpy.ndarray:
+    """Concatenated ranges of indices, each from its start, of given lengths."""
+    offsets = starts - numpy.cumsum(lengths) + lengths
+    return numpy.repeat(offsets, lengths) + numpy.arange(lengths.sum())
+
+
+def transformed_pairs(query: Callable[[numpy.ndarray], Pairs], ids: numpy.ndarray,
+                      transformed: Sequence[numpy.ndarray]) -> TransformedPairs:
+    """
+    Finds images, which are similar to other images after they are rotated or mirrored. Hashes of images with given
+    ids after each transform are queried in the index, which returns pairs of their indices and ids of similar hashes.
+    Only main hashes are indexed, so the index doesn't grow. Images aren't paired with themselves.
+    """
+    parts = []
+    for number, hashes in enumerate(transformed, 1):
+        first, second = query(hashes)
+        first = ids[first]
+        keep = first != second
+        parts.append((first[keep], second[keep], numpy.full(numpy.count_nonzero(keep), number, dtype=numpy.uint8)))
+    if not parts:
+        return _no_pairs() + (numpy.zeros(0, dtype=numpy.uint8),)
+    return tuple(numpy.concatenate([part[i] for part in parts]) for i in range(3))
+
+
+def _no_pairs() -> Pairs:
+    return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+
+
+def hamming_pairs(hashes: numpy.ndarray, radius: int) -> Pairs:
+    if not len(hashes):
+        return _no_pairs()
+    return HammingIndex(hashes, radius).pairs()
+
+
+def brute_force_pairs(hashes: numpy.ndarray, radius: int, workers: Optional[int] = None) -> Pairs:
+    """
+    Compares every pair of hashes. Hashes are compared in blocks small enough to stay in cache, and blocks of rows
+    are split between threads (NumPy releases GIL while computing). Memory use depends only on the number of found
+    pairs. Time grows with the square of the number of hashes, but doesn't depend on how they are distributed.
+    """
+    hashes = numpy.ascontiguousarray(hashes, dtype=numpy.uint64)
+
+    def compare_rows(start: int) -> Pairs:
+        rows = hashes[start:start + BLOCK_ROWS, None]
+        parts = []
+        for column in range(start, len(hashes), BLOCK_COLUMNS):
+            first, second = numpy.nonzero(popcount(rows ^ hashes[None, column:column + BLOCK_COLUMNS]) <= radius)
+            first += start
+            second += column
+            keep = first < second
+            parts.append((first[keep], second[keep]))
+        return _concatenate(parts)
+
+    if not len(hashes):
+        return _no_pairs()
+    with ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+        return _concatenate(list(executor.map(compare_rows, range(0, len(hashes), BLOCK_ROWS))))
+
+
+def _concatenate(parts: List[Pairs]) -> Pairs:
+    if not parts:
+        return _no_pairs()
+    return numpy.concatenate([p[0] for p in parts]), numpy.concatenate([p[1] for p in parts])
+
+
+def balltree_pairs(hashes: numpy.ndarray, radius: int) -> Pairs:
+    """
+    Finds the same pairs as other methods, using BallTree on unpacked bits. Euclidean distance between vectors of zeros
+    and ones is a square root of the number of different bits.
+    """
+    if not len(hashes):
+        return _no_pairs()
+    bits = unpack_hashes(hashes)
+    # Margin protects pairs at exactly the radius from rounding errors. Next possible distance is much further.
+    neighbours = BallTree(bits).query_radius(bits, math.sqrt(radius) + 1e-6)
+    first = numpy.repeat(numpy.arange(len(neighbours)), [len(n) for n in neighbours])
+    second = numpy.concatenate(neighbours).astype(numpy.int64)
+    keep = first < second
+    return first[keep], second[keep]
+
+
+def similar_pairs(hashes: numpy.ndarray, radius: int, method: NeighbourIndex = NeighbourIndex.AUTO,
+                  workers: Optional[int] = None) -> Pairs:
+    """Finds all pairs of hashes which differ by at most radius bits."""
+    workers = workers or os.cpu_count()
+    if method == NeighbourIndex.AUTO:
+        use_brute_force = len(hashes) <= BRUTE_FORCE_LIMIT * math.sqrt(workers)
+        method = NeighbourIndex.BRUTE_FORCE if use_brute_force else NeighbourIndex.HAMMING
+    if method == NeighbourIndex.BRUTE_FORCE:
+        return brute_force_pairs(hashes, radius, workers)
+    if method == NeighbourIndex.HAMMING:
+        return hamming_pairs(hashes, radius)
+    if method == NeighbourIndex.BALLTREE:
+        return balltree_pairs(hashes, radius)
+    results = {}
+    for method in (NeighbourIndex.BALLTREE, NeighbourIndex.HAMMING, NeighbourIndex.BRUTE_FORCE):
+        start = time.monotonic()
+        pairs = similar_pairs(hashes, radius, method, workers)
+        results[method] = pairs
+        found = set(zip(pairs[0].tolist(), pairs[1].tolist()))
+        if method == NeighbourIndex.BALLTREE:
+            expected = found
+            print(f'{method.value}: {len(found)} pairs in {time.monotonic() - start:.2f}s.')
+        else:
+            print(f'{method.value}: {len(found)} pairs in {time.monotonic() - start:.2f}s. '
+                  f'{len(expected - found)} missing, {len(found - expected)} unexpected.')
+    return results[NeighbourIndex.HAMMING]
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import queue
+import time
+from enum import Enum
+from typing import Optional, Callable, Any, List
+
+
+class MarkerType(Enum):
+    SCAN_FINISHED = 1  # All files found by walking directories were sent before this marker
+    FILE_REMOVED = 2
+    DIRECTORY_REMOVED = 3
+    DONE = 4  # Nothing more will be sent
+
+
+class Marker:
+    """
+    Control message passed through the pipeline in order with files. Stages which reorder their work wait until all
+    files sent before a marker are done, before they pass it on.
+    """
+    def __init__(self, type: MarkerType, path: Optional[str] = None):
+        self.type: MarkerType = type
+        self.path: Optional[str] = path
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.type.name}, {self.path})'
+
+
+class StageQueue:
+    """
+    Bounded queue connecting two stages of the pipeline. Keeps track of time producers spent blocked because the queue
+    was full (the next stage is the bottleneck) and time consumers spent waiting for items (previous stage is).
+    """
+    POLL_INTERVAL = .1  # How often blocked stages check whether the search was stopped
+
+    def __init__(self, name: str, maxsize: int, is_stopped: Callable[[], bool]):
+        self.name = name
+        self._queue = queue.Queue(maxsize)
+        self._is_stopped = is_stopped
+        self.items: int = 0
+        self.full_time: float = 0.
+        self.empty_time: float = 0.
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def put(self, item: Any) -> bool:
+        """Returns False if search was stopped before item could be added."""
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            start = time.monotonic()
+            while True:
+                if self._is_stopped():
+                    return False
+                try:
+                    self._queue.put(item, timeout=self.POLL_INTERVAL)
+                    break
+                except queue.Full:
+                    continue
+            self.full_time += time.monotonic() - start
+        self.items += 1
+        return True
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Any]:
+        """
+        Returns None if search was stopped or nothing came in given time. Without timeout, waits until something
+        comes or search is stopped.
+        """
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        start = time.monotonic()
+        try:
+            while True:
+                if self._is_stopped():
+                    return None
+                wait = self.POLL_INTERVAL
+                if timeout is not None:
+                    wait = min(wait, start + timeout - time.monotonic())
+                    if wait <= 0:
+                        return None
+                try:
+                    return self._queue.get(timeout=wait)
+                except queue.Empty:
+                    continue
+        finally:
+            self.empty_time += time.monotonic() - start
+
+    def get_nowait(self) -> Optional[Any]:
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            return None
+
+    def stats(self) -> str:
+        return f'{self.name}: {self.items} items, {len(self)} queued, ' \
+               f'full for {self.full_time:.1f}s, empty for {self.empty_time:.1f}s'
+
+
+def format_stats(queues: List[StageQueue]) -> str:
+    return 'Pipeline: ' + '; '.join(q.stats() for q in queues)
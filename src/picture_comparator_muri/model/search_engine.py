@@ -1,17 +1,32 @@
 from __future__ import annotations
 
 import os
-from typing import Optional, Set, List, Dict
+import threading
+import time
+import traceback
+from stat import S_ISREG
+from typing import Optional, List, Dict, Union, Iterable, Set, Callable
 
-from PIL import UnidentifiedImageError
 from PySide6.QtCore import QObject, QThread, Signal, QMutex
-from numpy import ndarray
-from sklearn.neighbors import BallTree
+import numpy
 
 from picture_comparator_muri.controller.settings import Settings
-from picture_comparator_muri.model.exceptions import ImageTooBigException
-from picture_comparator_muri.model.image_group import ImageGroup
+from picture_comparator_muri.model.cascade import HashCascade
+from picture_comparator_muri.model.catalog import ImageCatalog
+from picture_comparator_muri.model.copies import CopyFinder
+from picture_comparator_muri.model.disk_order import sort_for_reading, read_ahead
+from picture_comparator_muri.model.file_type import classify_extension, NOT_IMAGE
+from picture_comparator_muri.model.grouping import IncrementalGrouper, Change, GroupChange, SimilarityGraph, \
+    crop_pairs
+from picture_comparator_muri.model.hash_cache import HashCache, FileEntry, SnapshotStat
+from picture_comparator_muri.model.hashing import HashingPool, HashResult, HashDecoding, pack_hash, unpack_hash, \
+    PIXEL_DIGEST, TRANSFORM_NAMES, BLOCK_NAMES
 from picture_comparator_muri.model.image_info import ImageInfo
+from picture_comparator_muri.model.image_group import ImageGroup
+from picture_comparator_muri.model.neighbour_index import similar_pairs, transformed_pairs, HammingIndex, BlockIndex
+from picture_comparator_muri.model.pipeline import StageQueue, Marker, MarkerType, format_stats
+from picture_comparator_muri.model.walker import DirectoryWalker, FileId, file_id
+from picture_comparator_muri.model.watcher import create_watcher, Watcher, WatchEvent
 
 
 class Mutex:
@@ -31,127 +46,660 @@ class Mutex:
         self._mutex.unlock()
 
 
+class Alias:
+    """Link to a file which was already hashed or its byte-identical copy, found during classification."""
+    def __init__(self, row: int, entry: FileEntry):
+        self.row = row  # Row of the original in the catalog
+        self.entry = entry
+
+
 class SearchThread(QThread):
+    """
+    Runs the search as a pipeline of stages connected by bounded queues, so memory use doesn't depend on the number
+    of files waiting for processing:
+    - walking directories (and watching them for changes in watch mode),
+    - classification: filtering by extension, skipping links to already found files and using cached hashes;
+      byte-identical copies of found files share their hash too, only remaining files are sorted in the order they
+      are stored on disk,
+    - decoding and hashing in a pool of processes (file type is checked there too, using the same read); readahead
+      of each file is requested once it's queued in the pool,
+    - adding images to results, which happens in this thread. With streaming, images are grouped as they come, so
+      groups are shown before the scan is finished. Images which may be similar are decoded again in the pool, if
+      stronger hashes or comparison of pixels confirm the similarity. Images of the same size in a group are decoded
+      in full resolution there too, so identical ones are found by digests of their pixels.
+    """
+    WATCH_TIMEOUT = .5  # How often stop flag is checked in watch mode
+    BATCH_WAIT = .05
+    HASH_POLL_INTERVAL = .05
+    STATS_INTERVAL = 30.
+    STREAM_INTERVAL = .5  # How long added images may wait for grouping, when more of them keep coming
+    REQUEST_INTERVAL = .2  # How often requests of the GUI thread are checked, when no results come
+    CONFIRMATION_BATCH = 256  # Images decoded again at once, before stop flag is checked
+
     def __init__(self, search_engine: SearchEngine):
         super().__init__()
         self.was_stopped: bool = False
         self.stopped_mutex = Mutex()
+        self.stage_error: Optional[Exception] = None  # Error which ended one of the stages, guarded by stopped_mutex
         self.search_engine = search_engine
-        self.all_dirs: Set[str] = set()
-        self.image_tree = None
+        self.hashing_pool: Optional[HashingPool] = None
+        self.hash_cache: Optional[HashCache] = None
+        queue_size = self.settings.queue_size
+        self.found_files = StageQueue('found', queue_size, self._is_stopped)
+        self.files_to_hash = StageQueue('to hash', queue_size, self._is_stopped)
+        self.hashed_files = StageQueue('hashed', queue_size, self._is_stopped)
+        # Row of the image in the catalog for each file id, False if file isn't an image and None if it wasn't checked
+        # yet.
+        self.known_files: Dict[FileId, Union[int, bool, None]] = {}
+        self.waiting_aliases: Dict[FileId, List[FileEntry]] = {}
+        self.cached_copies: Set[str] = set()  # Real paths of copies linked by their cache entries, which are up to date
+        self.known_files_lock = threading.Lock()
+        self.copy_finder = CopyFinder()  # Used only by the classification stage
+        self.cascade = HashCascade(self.catalog, self.settings.confirmation, self._compute_confirmation,
+                                   self.settings.pixel_threshold, self.settings.workers)
+        self.grouper: Optional[IncrementalGrouper] = None
+        self.ungrouped_rows: List[int] = []  # Rows added to the catalog, but not to the grouper yet
+        # Files decoded by the hashing stage and ones decoded again by this thread to compare them. Each is counted
+        # only by one thread.
+        self.hashed_count: int = 0
+        self.decoded_again_count: int = 0
+        # Graph is used by this thread until results are ready (or until it's stopped, in watch mode). Until then,
+        # radius changes are only requested by the GUI thread and applied here, between results.
+        self.regroup_lock = threading.Lock()
+        self.uses_graph: bool = True
+        self.regroup_requested: bool = False
+        self.last_grouping: float = 0.
+        self.scan_finished: bool = False
+        self.skipped_directories: int = 0
 
     @property
     def settings(self) -> Settings:
         return self.search_engine.settings
 
     @property
-    def images(self) -> List[ImageInfo]:
-        return self.search_engine.images
-
-    @property
-    def images_hash_map(self):
-        return self.search_engine.images_hash_map
-
-    @property
-    def raw_results(self):
-        return self.search_engine.raw_results
-
-    @raw_results.setter
-    def raw_results(self, value):
-        self.search_engine.raw_results = value
+    def catalog(self) -> ImageCatalog:
+        return self.search_engine.catalog
 
     @property
     def groups(self):
         return self.search_engine.groups
 
     @property
-    def group_map(self):
-        return self.search_engine.group_map
+    def graph(self) -> SimilarityGraph:
+        return self.search_engine.graph
+
+    @property
+    def queues(self) -> List[StageQueue]:
+        return [self.found_files, self.files_to_hash, self.hashed_files]
 
     def run(self) -> None:
-        self._scan_files()
-        self._find_results()
-        self.images.clear()
-        self.images_hash_map.clear()
+        self.hashing_pool = HashingPool(self.settings.workers, self.settings.hash_decoding, self.settings.hash_kind,
+                                        self.settings.orientations, self.settings.exif_orientation,
+                                        self.settings.crops)
+        if self.settings.use_cache:
+            # Hashes of fully decoded images and of images rotated by EXIF orientation differ, so they are cached as
+            # other kinds.
+            hash_kind = self.settings.hash_kind
+            if self.settings.hash_decoding == HashDecoding.FULL:
+                hash_kind += '+full'
+            if self.settings.exif_orientation:
+                hash_kind += '+exif'
+            self.hash_cache = HashCache(hash_kind=hash_kind,
+                                        required=self.catalog.transforms + (BLOCK_NAMES if self.catalog.blocks
+                                                                            else []))
+        if self.settings.streaming:
+            self.grouper = IncrementalGrouper(self.catalog, self.settings.radius, self.cascade, self.graph)
+        stages = [threading.Thread(target=self._run_stage, args=(target,), name=name, daemon=True) for target, name in
+                  ((self._walk_stage, 'walk'), (self._classify_stage, 'classify'), (self._hash_stage, 'hash'))]
+        for stage in stages:
+            stage.start()
+        try:
+            self._add_results()
+        except Exception as e:
+            traceback.print_exc()
+            self.search_engine.SearchFailed.emit(f'{type(e).__name__}: {e}')
+        finally:
+            self._release_graph()
+            self.stop()
+            for stage in stages:
+                stage.join()
+            # Drops queued files if search was stopped.
+            self.hashing_pool.shutdown()
+            self.hashing_pool = None
+            if self.hash_cache:
+                self.hash_cache.close()
+                self.hash_cache = None
+            self.grouper = None
+            self.ungrouped_rows.clear()
+        self.catalog.clear()
+        self.known_files.clear()
+        self.waiting_aliases.clear()
+        self.cached_copies.clear()
+        self.copy_finder = CopyFinder()
+
+    def _is_stopped(self) -> bool:
+        with self.stopped_mutex:
+            return self.was_stopped
+
+    def _run_stage(self, stage: Callable[[], None]):
+        """
+        Runs the stage in its own thread. If it fails, the search is stopped, so other stages don't wait for it
+        forever, and the error is raised again by this thread.
+        """
+        try:
+            stage()
+        except Exception as e:
+            with self.stopped_mutex:
+                self.stage_error = self.stage_error or e
+                self.was_stopped = True
+            self.hashed_files.put(Marker(MarkerType.DONE))
 
-    def _scan_files(self):
-        for directory in self.settings.directories:
-            self._add_directory(directory)
+    def _raise_stage_error(self):
+        with self.stopped_mutex:
+            error = self.stage_error
+        if error is not None:
+            raise error
+
+    # Walking stage
+
+    def _walk_stage(self):
+        # Watcher is created before the walk, so changes in directories which were already walked aren't missed. They
+        # are reported once the scan is finished.
+        watcher = create_watcher(self.settings.directories, self.settings.scan_subdirectories) \
+            if self.settings.watch else None
+        try:
+            walker = DirectoryWalker(self.settings.directories, self.settings.scan_subdirectories,
+                                     self.hash_cache if self.settings.incremental else None)
+            for entry in walker:
+                if not self.found_files.put(entry):
+                    return
+            self.skipped_directories = walker.skipped_directories
+            if not self.found_files.put(Marker(MarkerType.SCAN_FINISHED)):
+                return
+            if watcher is not None:
+                self._watch(watcher)
+            self.found_files.put(Marker(MarkerType.DONE))
+        finally:
+            if watcher is not None:
+                watcher.close()
+
+    def _watch(self, watcher: Watcher):
+        """Sends changes in searched directories down the pipeline until the search is stopped."""
+        while not self._is_stopped():
+            for event, path in watcher.events(self.WATCH_TIMEOUT):
+                if event == WatchEvent.CHANGED:
+                    item = self._changed_file_entry(path)
+                elif event == WatchEvent.REMOVED:
+                    item = Marker(MarkerType.FILE_REMOVED, path)
+                else:
+                    item = Marker(MarkerType.DIRECTORY_REMOVED, path)
+                if item is not None and not self.found_files.put(item):
+                    return
 
-    def _add_directory(self, directory: str):
-        self.all_dirs.add(directory)
-        for file in os.listdir(directory):
-            with self.stopped_mutex:
-                if self.was_stopped:
+    @staticmethod
+    def _changed_file_entry(path: str) -> Union[FileEntry, Marker, None]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Previous version of the file is no longer valid, even if the new one can't be read.
+            return Marker(MarkerType.FILE_REMOVED, path)
+        if not S_ISREG(stat.st_mode):
+            return None
+        return path, os.path.realpath(path), stat
+
+    # Classification stage
+
+    def _classify_stage(self):
+        batch: List[FileEntry] = []
+        while True:
+            # Files are looked up in the cache in batches, but they aren't held for long if no more come.
+            item = self.found_files.get(self.BATCH_WAIT if batch else None)
+            if item is None and self._is_stopped():
+                return
+            if item is None or isinstance(item, Marker) or len(batch) >= HashCache.BATCH_SIZE:
+                if not self._classify(batch):
+                    return
+                batch = []
+            if isinstance(item, Marker):
+                if not self.files_to_hash.put(item):
+                    return
+                if item.type == MarkerType.DONE:
+                    return
+            elif item is not None and self._is_new_file(item):
+                batch.append(item)
+
+    def _is_new_file(self, entry: FileEntry) -> bool:
+        """Returns False for files which certainly aren't images and for links to files which were already found."""
+        if classify_extension(entry[0]) == NOT_IMAGE:
+            return False
+        id = file_id(entry[2])
+        with self.known_files_lock:
+            if id not in self.known_files or self.settings.watch and self.known_files[id] is not None \
+                    and self._is_modified(self.known_files[id], entry):
+                self.known_files[id] = None
+                return True
+            # Hardlink or symlink to already found file. It will share its hash instead of being decoded again.
+            row = self.known_files[id]
+            if row is None:
+                self.waiting_aliases.setdefault(id, []).append(entry)
+                return False
+        if row is not False:
+            self.hashed_files.put(Alias(row, entry))
+        return False
+
+    def _is_modified(self, row: Union[int, bool], entry: FileEntry) -> bool:
+        if row is False:  # Non image files aren't kept, so it can't be told.
+            return True
+        values = self.catalog.rows[row]
+        return values['mtime_ns'] != entry[2].st_mtime_ns or values['size'] != entry[2].st_size
+
+    def _classify(self, files: List[FileEntry]) -> bool:
+        """Uses cached hashes of gathered files and skips copies. Sends remaining ones to be hashed."""
+        if not files:
+            return True
+        if self.hash_cache:
+            found, files = self.hash_cache.lookup(files)
+            for result in found:
+                if result.is_image and result.original is None:
+                    self.copy_finder.add((result.path, result.real_path, result.stat))
+            for result in found:
+                if result.original is not None:
+                    entry = (result.path, result.real_path, result.stat)
+                    original = self.copy_finder.cached_original(entry, result.original)
+                    if original is not None and self._add_copy(entry, original):
+                        with self.known_files_lock:
+                            self.cached_copies.add(result.real_path)
+                        continue
+                    # Original changed or wasn't found. Hashes of the copy are still valid on their own.
+                    if original is None and result.original[0] in self.copy_finder.by_real_path:
+                        result.original = None  # Original changed, so the link is dropped from the cache
+                        self.hash_cache.add(result)
+                    self.copy_finder.add(entry)
+                if not self.hashed_files.put(result):
+                    return False
+        files = [entry for entry in files if not self._is_copy(entry)]
+        for entry in sort_for_reading(files, self.settings.read_order):
+            if not self.files_to_hash.put(entry):
+                return False
+        return True
+
+    def _is_copy(self, entry: FileEntry) -> bool:
+        """
+        Checks if the file has the same content as a file found before. Such copy isn't decoded, but shares the hash
+        of the original, like links do.
+        """
+        original = self.copy_finder.find_original(entry)
+        return original is not None and self._add_copy(entry, original)
+
+    def _add_copy(self, entry: FileEntry, original: FileEntry) -> bool:
+        """Adds the copy as an alias of the original. Returns False if the original was removed in the meantime."""
+        id = file_id(original[2])
+        with self.known_files_lock:
+            if id not in self.known_files:  # Original was removed in the meantime
+                return False
+            row = self.known_files[id]
+            if row is None:
+                self.waiting_aliases.setdefault(id, []).append(entry)
+                return True
+        if row is not False:
+            self.hashed_files.put(Alias(row, entry))
+        return True
+
+    # Hashing stage
+
+    def _hash_stage(self):
+        marker: Optional[Marker] = None  # Marker waiting until all files sent before it are hashed
+        while not self._is_stopped():
+            while marker is None and not self.hashing_pool.is_full:
+                item = self.files_to_hash.get(None if not len(self.hashing_pool) else 0)
+                if item is None:
+                    break
+                if isinstance(item, Marker):
+                    marker = item
+                else:
+                    # Workers take tasks in order, so the file will be read in the meantime by the system.
+                    read_ahead(item[1])
+                    self.hashing_pool.submit(*item)
+                    self.hashed_count += 1
+            for result in self.hashing_pool.collect(self.HASH_POLL_INTERVAL):
+                if not self.hashed_files.put(result):
                     return
-            path = os.path.join(directory, file)
-            if os.path.isdir(path):
-                if self.settings.scan_subdirectories and path not in self.all_dirs:
-                    self._add_directory(path)
+            if marker is not None and not len(self.hashing_pool):
+                if not self.hashed_files.put(marker) or marker.type == MarkerType.DONE:
+                    return
+                marker = None
+
+    # Adding results
+
+    def _add_results(self):
+        last_stats = time.monotonic()
+        while True:
+            if self.grouper and self._take_regroup_request():
+                self._regroup()
+            item = self.hashed_files.get(self.REQUEST_INTERVAL)
+            if item is None:
+                if self._is_stopped():
+                    self._raise_stage_error()
+                    return
+                continue
+            if isinstance(item, Marker):
+                # Removals and end of the scan apply to images grouped so far.
+                self._group_added_images()
+            if isinstance(item, HashResult):
+                if self.hash_cache and not item.from_cache:
+                    self.hash_cache.add(item)
+                self._add_result(item)
+            elif isinstance(item, Alias):
+                self._add_alias(item.row, item.entry)
+            elif item.type == MarkerType.SCAN_FINISHED:
+                self._scan_finished()
+            elif item.type == MarkerType.FILE_REMOVED:
+                self._remove_image(item.path)
+            elif item.type == MarkerType.DIRECTORY_REMOVED:
+                for row in self.catalog.in_directory(item.path):
+                    self._remove_row(int(row))
             else:
-                try:
-                    image = ImageInfo.from_path_if_image(path)
-                except ImageTooBigException as e:
-                    print(e.args[0])
-                    self.search_engine.LoadingImageFailed.emit('Image too big', path)
-                    continue
-                except UnidentifiedImageError as e:
-                    print(e.args[0])
-                    self.search_engine.LoadingImageFailed.emit('Loading image failed', path)
-                    continue
-                if image:
-                    self._add_image(image)
+                self._raise_stage_error()
+                return
+            if self.ungrouped_rows and (not len(self.hashed_files) or
+                                        time.monotonic() - self.last_grouping > self.STREAM_INTERVAL):
+                self._group_added_images()
+            if self.scan_finished and self.hash_cache and not len(self.hashed_files):
+                self.hash_cache.flush()
+            if time.monotonic() - last_stats > self.STATS_INTERVAL:
+                print(format_stats(self.queues))
+                last_stats = time.monotonic()
+
+    def _scan_finished(self):
+        self.scan_finished = True
+        if self.skipped_directories:
+            print(f'{self.skipped_directories} unchanged directories were not listed again.')
+        print(format_stats(self.queues))
+        if self.settings.hash_decoding == HashDecoding.COMPARE:
+            self._print_decoding_comparison()
         self.search_engine.ImageSearchEnded.emit()
-
-    def _add_image(self, image: ImageInfo):
-        image.index = len(self.images)
-        self.images.append(image)
-
-        hash_arr = self.images_hash_map.get(image.hash)
-        if not hash_arr:
-            hash_arr = []
-            self.images_hash_map[image.hash] = hash_arr
-        hash_arr.append(image)
-
-        self.search_engine.ImageFound.emit(image)
+        if self.grouper:
+            # Groups were already found during the scan.
+            self.groups.extend(self.grouper.groups.values())
+            self._results_ready()
+            return
+        self._find_results()
+        if self.settings.watch:
+            self.grouper = IncrementalGrouper(self.catalog, self.settings.radius, self.cascade, self.graph)
+            self.grouper.load(self.groups)
+
+    def _print_decoding_comparison(self):
+        distances = self.catalog.rows['reduced_distance']
+        distances = distances[distances >= 0]
+        if len(distances):
+            print(f'Reduced decoding: {len(distances)} images compared, {numpy.count_nonzero(distances)} hashes '
+                  f'differ, max distance {distances.max()}, mean distance {distances.mean():.3f}.')
+
+    def _add_result(self, result: HashResult):
+        row = None
+        # Previous version of the file is replaced, even if the new one is not an image.
+        self._remove_image(result.path)
+        if result.error:
+            print(result.message)
+            self.search_engine.LoadingImageFailed.emit(result.error, result.path)
+        elif result.is_image:
+            if result.reduced_distance:
+                print(f'"{result.path}": hash from reduced decoding differs by {result.reduced_distance} bits.')
+            row = self.catalog.append(result.path, result.real_path, pack_hash(result.hash), result.stat,
+                                      result.width, result.height, result.format,
+                                      reduced_distance=result.reduced_distance, hashes=result.hashes,
+                                      thumbnail=result.thumbnail)
+            self._image_added(row)
+        self._file_resolved(file_id(result.stat), row)
+
+    def _file_resolved(self, id: FileId, row: Optional[int]):
+        """Records row of the file, or that it isn't an image, and adds its links and copies waiting for it."""
+        with self.known_files_lock:
+            self.known_files[id] = row if row is not None else False
+            aliases = self.waiting_aliases.pop(id, [])
+        for entry in aliases:
+            if row is not None:
+                self._add_alias(row, entry)
+            else:
+                self._alias_resolved(entry, None)
+
+    def _add_alias(self, original: int, entry: FileEntry):
+        path, real_path, stat = entry
+        if path == self.catalog.path(original):
+            return
+        self._remove_image(path)
+        values = self.catalog.rows[original]
+        hashes, thumbnail = self.catalog.confirmation_of(original)
+        if self.catalog.transforms or self.catalog.blocks:
+            hashes = {**(hashes or {}), **self.catalog.transformed_hashes_of(original),
+                      **self.catalog.block_hashes_of(original)}
+        row = self.catalog.append(path, real_path, int(values['hash']), stat, int(values['width']),
+                                  int(values['height']), self.catalog.format(original), alias_of=original,
+                                  hashes=hashes, thumbnail=thumbnail)
+        # Copy is cached with a link to its original, so it isn't read again to find it. Links don't need that.
+        if file_id(stat) != (int(values['device']), int(values['inode'])):
+            with self.known_files_lock:
+                is_cached = real_path in self.cached_copies
+                self.cached_copies.discard(real_path)
+            if not is_cached:
+                self._cache_row(row)
+        self._image_added(row)
+        self._alias_resolved(entry, row)
+
+    def _alias_resolved(self, entry: FileEntry, row: Optional[int]):
+        # Copy is a separate file, which may have links of its own.
+        id = file_id(entry[2])
+        with self.known_files_lock:
+            is_copy = self.known_files.get(id, False) is None
+        if is_copy:
+            self._file_resolved(id, row)
+
+    def _image_added(self, row: int):
+        if self.grouper:
+            self.ungrouped_rows.append(row)
+        self.search_engine.ImageFound.emit(self.catalog.path(row))
+
+    def _group_added_images(self):
+        """Adds images to groups. It's done in batches, which is much faster when images come from the cache."""
+        if self.ungrouped_rows:
+            self._apply_changes(self.grouper.add(self.ungrouped_rows))
+            self.ungrouped_rows = []
+        self.last_grouping = time.monotonic()
+
+    def _remove_image(self, path: str):
+        """Removes previous version of a file, if there was one. Happens only when images are grouped as they come."""
+        if self.grouper:
+            row = self.catalog.find(path)
+            if row is not None:
+                self._remove_row(row)
+
+    def _remove_row(self, row: int):
+        self._apply_changes(self.grouper.remove(row))
+        values = self.catalog.rows[row]
+        id = (int(values['device']), int(values['inode']))
+        with self.known_files_lock:
+            if self.known_files.get(id) == row:
+                del self.known_files[id]
+        self.catalog.remove(row)
 
     def _find_results(self):
-        X = [image.hash for image in self.images]
-        if X:
-            self.image_tree = BallTree(X)
-            self.raw_results = self.image_tree.query_radius(X, 3)
-            for result in self.raw_results:
-                with self.stopped_mutex:
-                    if self.was_stopped:
-                        return
-                if len(result) < 2:
-                    continue
-                main_group = None  # group to which all other groups will be merged if there are multiple ones
-                new_group = []  # indices for images that weren't part of any group previously
-
-                for index in result:
-                    group = self.group_map.get(index)
-                    if not group:
-                        new_group.append(index)
-                    elif main_group is None:
-                        main_group = group
-                    elif main_group is not group:
-                        for image in group:
-                            self.group_map[image.index] = main_group
-                        main_group.merge(group)
-                        self.groups.remove(group)
-
-                if main_group is None:
-                    main_group = ImageGroup()
-                    self.groups.append(main_group)
-
-                images = [self.images[i] for i in new_group]
-                main_group.add_images(images)
-                for index in new_group:
-                    self.group_map[index] = main_group
-
+        valid = numpy.flatnonzero(self.catalog.valid)
+        if len(valid):
+            # Pairs are searched up to the maximum radius, so grouping can be changed later without searching.
+            hashes = self.catalog.hashes[valid]
+            first, second = similar_pairs(hashes, self.settings.max_radius, self.settings.neighbour_index,
+                                          self.settings.workers)
+            parts = [(valid[first], valid[second], numpy.zeros(len(first), dtype=numpy.uint8))]
+            if self.catalog.transforms:
+                index = HammingIndex(hashes, self.settings.max_radius)
+                first, second, transforms = transformed_pairs(
+                    index.query, numpy.arange(len(valid)),
+                    [self.catalog.rows[name][valid] for name in self.catalog.transforms])
+                parts.append((valid[first], valid[second], transforms))
+            if self.catalog.blocks:
+                parts.append(crop_pairs(self.catalog, BlockIndex().add(valid, self.catalog.rows['blocks'][valid])))
+            first, second, transforms = (numpy.concatenate(part) for part in zip(*parts))
+            self.graph.add(self.catalog, *self.cascade.confirm((first, second), transforms if len(parts) > 1 else None))
+            if self._is_stopped():
+                return
+            self.groups.extend(self.graph.groups(self.settings.radius))
+
+        self._results_ready()
+
+    def _results_ready(self):
+        # Groups within a higher radius include all images which may end up in the same group later.
+        self._compute_pixel_digests(self.graph.groups(self.settings.max_radius)
+                                    if self.settings.max_radius > self.settings.radius else self.groups)
+        self.search_engine.sort_groups(self.groups)
+        print(f'{self.hashed_count} files were hashed, {self.decoded_again_count} were decoded again to compare them.')
         self.search_engine.ResultsReady.emit(self.groups)
-        self.image_tree = None
+
+    def request_regroup(self) -> bool:
+        """
+        Called by the GUI thread when radius was changed. Returns False if this thread doesn't use the graph anymore,
+        so images can be grouped again by the caller. It never waits for the search.
+        """
+        with self.regroup_lock:
+            if self.uses_graph:
+                self.regroup_requested = True
+            return self.uses_graph
+
+    def _take_regroup_request(self) -> bool:
+        with self.regroup_lock:
+            requested, self.regroup_requested = self.regroup_requested, False
+        return requested
+
+    def _release_graph(self):
+        """Lets the GUI thread use the graph. Radius changes requested before are applied first."""
+        while True:
+            with self.regroup_lock:
+                if not self.regroup_requested:
+                    self.uses_graph = False
+                    return
+                self.regroup_requested = False
+            self.search_engine.groups = self.graph.groups(self.settings.radius)
+            self.search_engine.sort_groups(self.search_engine.groups)
+            self.search_engine.Regrouped.emit(self.search_engine.groups)
+
+    def _regroup(self):
+        """Replaces groups with ones within the new radius, found from pairs in the graph."""
+        groups = self.grouper.regroup(self.settings.radius)
+        self._compute_pixel_digests(groups)
+        self.search_engine.sort_groups(groups)
+        if self.scan_finished:
+            self.search_engine.groups = groups
+        self.search_engine.Regrouped.emit(groups)
+
+    def _compute_confirmation(self, rows: numpy.ndarray):
+        """
+        Decodes images again, computing hashes and thumbnails which confirm similarity. Stores them in the catalog
+        and cache. Only originals are decoded, links and copies get the same data.
+        """
+        kinds = self.catalog.confirmation_hashes
+        aliases: Dict[int, List[int]] = {}
+        for row in rows.tolist():
+            aliases.setdefault(self.catalog.original(row), []).append(row)
+        originals = [row for row in aliases if self.catalog.rows['confirmation'][row] == 0]
+        for row in set(aliases) - set(originals):  # Original is known, only its aliases need its data
+            self._share_confirmation(row, aliases[row])
+        for start in range(0, len(originals), self.CONFIRMATION_BATCH):
+            if self._is_stopped():
+                return
+            batch = originals[start:start + self.CONFIRMATION_BATCH]
+            files = [(self.catalog.path(row), self.catalog.real_path(row)) for row in batch]
+            self.decoded_again_count += len(files)
+            for row, result in zip(batch, self.hashing_pool.compute(files, kinds, self.catalog.use_thumbnails)):
+                if not result.is_image:
+                    print(result.message or f'"{result.path}": image could not be hashed again.')
+                    self.catalog.set_confirmation(row, None)
+                else:
+                    self.catalog.set_confirmation(row, result.hashes, result.thumbnail)
+                    self._cache_row(row)
+                self._share_confirmation(row, aliases[row])
+
+    def _share_confirmation(self, original: int, rows: List[int]):
+        """Sets confirmation data of the original to its links and copies among rows."""
+        hashes, thumbnail = self.catalog.confirmation_of(original)
+        for row in rows:
+            if row != original:
+                self.catalog.set_confirmation(row, hashes, thumbnail)
+                if hashes is not None:
+                    self._cache_row(row)
+
+    def _compute_pixel_digests(self, image_lists: Iterable[Iterable[ImageInfo]]):
+        """
+        Decodes in full resolution images which may be identical to others in their group, as they have the same
+        dimensions, and stores digests of their pixels. Only originals are decoded, links and copies get their digest.
+        """
+        aliases: Dict[int, List[int]] = {}
+        for images in image_lists:
+            members = numpy.array([image.index for image in images], dtype=numpy.int64)
+            values = self.catalog.rows[members]
+            dimensions = values['width'].astype(numpy.int64) << 32 | values['height']
+            _, inverse, counts = numpy.unique(dimensions, return_inverse=True, return_counts=True)
+            for row in members[counts[inverse] > 1].tolist():
+                aliases.setdefault(self.catalog.original(row), []).append(row)
+        rows = sorted(row for row in aliases if self.catalog.rows['pixel_digest'][row] == 0)
+        for row in set(aliases).difference(rows):  # Digest of the original is known, only its aliases need it
+            self._share_pixel_digest(row, aliases[row])
+        for start in range(0, len(rows), self.CONFIRMATION_BATCH):
+            if self._is_stopped():
+                return
+            batch = rows[start:start + self.CONFIRMATION_BATCH]
+            digests = self.hashing_pool.pixel_digests([self.catalog.real_path(row) for row in batch])
+            self.decoded_again_count += len(batch)
+            for row, digest in zip(batch, digests):
+                self.catalog.set_pixel_digest(row, digest)
+                if digest is None:
+                    print(f'"{self.catalog.path(row)}": pixels of the image could not be compared.')
+                else:
+                    self._cache_row(row)
+                self._share_pixel_digest(row, aliases[row])
+
+    def _share_pixel_digest(self, original: int, rows: List[int]):
+        """Sets digest of pixels of the original to its links and copies among rows, which don't have it yet."""
+        digest = self.catalog.pixel_digest(original)
+        for row in rows:
+            if row != original and self.catalog.rows['pixel_digest'][row] == 0:
+                self.catalog.set_pixel_digest(row, digest)
+                if digest is not None:
+                    self._cache_row(row)
+
+    def _cache_row(self, row: int):
+        """Stores hashes of the image in the cache again, after data computed later was added to the catalog."""
+        if not self.hash_cache:
+            return
+        # Image decoded in color for some hashes may give slightly different main hash. Cache keeps the one which is
+        # used.
+        values = self.catalog.rows[row]
+        result = HashResult(self.catalog.path(row), self.catalog.real_path(row), unpack_hash(int(values['hash'])))
+        hashes, result.thumbnail = self.catalog.confirmation_of(row)
+        # Hashes of transformed images and of blocks are required by the cache, so the entry must keep them.
+        result.hashes = {**(hashes or {}), **self.catalog.transformed_hashes_of(row),
+                         **self.catalog.block_hashes_of(row)}
+        digest = self.catalog.pixel_digest(row)
+        if digest is not None:
+            result.hashes[PIXEL_DIGEST] = digest
+        original = self.catalog.original(row)
+        if int(values['alias_of']) >= 0 and self.catalog.real_path(original) != result.real_path:
+            result.original = (self.catalog.real_path(original), int(self.catalog.rows['mtime_ns'][original]))
+        result.width, result.height = int(values['width']) or None, int(values['height']) or None
+        result.format = self.catalog.format(row)
+        result.stat = SnapshotStat(int(values['size']), int(values['mtime_ns']), int(values['inode']),
+                                   int(values['device']))
+        self.hash_cache.add(result)
+
+    def _apply_changes(self, changes: List[Change]):
+        self._compute_pixel_digests(change.images for change in changes)
+        for change, group, images, merged in changes:
+            if change == GroupChange.ADDED:
+                self.search_engine.GroupAdded.emit(group)
+            elif change == GroupChange.CHANGED:
+                self.search_engine.GroupChanged.emit(group, images)
+            elif change == GroupChange.MERGED:
+                self.search_engine.GroupsMerged.emit(group, images, list(merged))
+            else:
+                self.search_engine.GroupRemoved.emit(group)
 
     def stop(self) -> None:
         with self.stopped_mutex:
@@ -159,26 +707,50 @@ class SearchThread(QThread):
 
 
 class SearchEngine(QObject):
-    ImageFound = Signal(ImageInfo)
+    ImageFound = Signal(str)  # Path of the image
     LoadingImageFailed = Signal(str, str)
     ImageSearchEnded = Signal()
     ResultsReady = Signal(list)
+    SearchFailed = Signal(str)  # Search was ended by an error, with its description. Results won't be ready.
+    # Changes of groups made during the scan (when streaming) and after results were ready, when directories are
+    # watched. Groups in ResultsReady are the ones which were reported by these signals.
+    GroupAdded = Signal(ImageGroup)
+    GroupChanged = Signal(ImageGroup, list)  # Group and its new list of images
+    GroupsMerged = Signal(ImageGroup, list, list)  # Group, its new list of images and groups which became part of it
+    GroupRemoved = Signal(ImageGroup)
+    Regrouped = Signal(list)  # All groups were replaced, after radius was changed
 
     def __init__(self, settings: Settings):
         super().__init__()
         self.settings: Settings = settings
         self.search_thread: Optional[SearchThread] = None
 
-        self.images: List[ImageInfo] = []
-        self.images_hash_map = {}
-        self.raw_results: Optional[ndarray] = None
+        self.catalog = ImageCatalog(list(settings.confirmation), settings.pixel_threshold is not None,
+                                    TRANSFORM_NAMES if settings.orientations else (), settings.crops)
         self.groups: List[ImageGroup] = []
-        self.group_map: Dict[int, ImageGroup] = {}
+        self.graph = SimilarityGraph(settings.max_radius)
 
     def start_comparison(self):
         self.search_thread = SearchThread(self)
         self.search_thread.start()
 
+    def regroup(self, radius: int):
+        """
+        Groups images again with another radius, not higher than the maximum one, using pairs kept from the search.
+        New groups are reported by Regrouped.
+        """
+        self.settings.radius = min(radius, self.graph.max_radius)
+        if self.search_thread is not None and self.search_thread.request_regroup():
+            return  # Search thread will regroup images, as it still uses the graph.
+        self.groups = self.graph.groups(self.settings.radius)
+        self.sort_groups(self.groups)
+        self.Regrouped.emit(self.groups)
+
+    def sort_groups(self, groups: List[ImageGroup]):
+        if self.settings.pixel_threshold is not None:
+            # The most similar groups go first.
+            groups.sort(key=lambda group: group.score or 0, reverse=True)
+
     def stop(self):
         self.search_thread.stop()
         self.search_thread.wait()
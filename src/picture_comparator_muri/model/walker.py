@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import os
+from typing import List, Iterator, Set, Tuple, Iterable, Optional
+
+from picture_comparator_muri.model.hash_cache import FileEntry, HashCache, DirectorySnapshot
+
+
+FileId = Tuple[int, int]  # Device and inode
+
+
+def file_id(stat: os.stat_result) -> FileId:
+    return stat.st_dev, stat.st_ino
+
+
+class DirectoryWalker:
+    """
+    Iterates over files in given directories. Uses an explicit stack instead of recursion, so deep trees can't exceed
+    recursion limit, and reuses type and stat information returned by os.scandir to avoid additional system calls.
+    Directories are identified by device and inode, so each of them is listed once, no matter how many links or
+    overlapping arguments lead to it. This also protects from symlink loops.
+
+    When cache is given, scan is incremental. Each listed directory is stored as a snapshot, and directories whose
+    modification time matches their snapshot are not listed again; their files are restored from the snapshot.
+    Modification time of a directory changes only when entries are added, removed or renamed, so restored files are
+    still stat'ed, as they may have been overwritten in place.
+    """
+    def __init__(self, directories: Iterable[str], recursive: bool = True, cache: Optional[HashCache] = None):
+        self.directories: List[str] = list(directories)
+        self.recursive: bool = recursive
+        self.cache: Optional[HashCache] = cache
+        self.visited: Set[FileId] = set()
+        self.skipped_directories: int = 0
+
+    def __iter__(self) -> Iterator[FileEntry]:
+        # Stack holds paths as seen by the user and real paths. Real paths of files are built from real path of the
+        # directory, so they don't need to be resolved one by one.
+        stack: List[Tuple[str, str]] = [(os.path.abspath(d), os.path.realpath(d)) for d in reversed(self.directories)]
+        while stack:
+            directory, real_directory = stack.pop()
+            try:
+                stat = os.stat(real_directory)
+            except OSError as e:
+                print(f'"{directory}": cannot be accessed. {e}')
+                continue
+            id = file_id(stat)
+            if id in self.visited:
+                continue
+            self.visited.add(id)
+
+            snapshot = self.cache.snapshot(real_directory, stat.st_mtime_ns) if self.cache else None
+            if snapshot is not None:
+                self.skipped_directories += 1
+                subdirectories = snapshot.restore_dirs(directory)
+                yield from self._restored_files(snapshot, directory)
+            else:
+                snapshot = DirectorySnapshot(real_directory, stat.st_mtime_ns)
+                subdirectories = []
+                try:
+                    with os.scandir(directory) as entries:
+                        for entry in entries:
+                            try:
+                                if entry.is_dir():
+                                    real_path = self._real_path(entry, real_directory)
+                                    snapshot.add_dir(entry.name, real_path)
+                                    subdirectories.append((entry.path, real_path))
+                                elif entry.is_file():  # Skips sockets, pipes and devices
+                                    real_path = self._real_path(entry, real_directory)
+                                    stat = entry.stat()
+                                    snapshot.add_file(entry.name, real_path, stat)
+                                    yield entry.path, real_path, stat
+                            except OSError:  # Broken link or file removed in the meantime
+                                continue
+                except OSError as e:
+                    print(f'"{directory}": cannot be listed. {e}')
+                    continue
+                if self.cache:
+                    self.cache.add_snapshot(snapshot)
+            if self.recursive:
+                stack.extend(reversed(subdirectories))
+
+    @staticmethod
+    def _restored_files(snapshot: DirectorySnapshot, directory: str) -> Iterator[FileEntry]:
+        """Files of the directory, which didn't change since the snapshot, with their current stat."""
+        for path, real_path, _ in snapshot.restore_files(directory):
+            try:
+                yield path, real_path, os.stat(real_path)
+            except OSError:  # Target of a link was removed
+                continue
+
+    @staticmethod
+    def _real_path(entry: os.DirEntry, real_directory: str) -> str:
+        if entry.is_symlink():
+            return os.path.realpath(entry.path)
+        return os.path.join(real_directory, entry.name)
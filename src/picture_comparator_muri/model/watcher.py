@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import abc
+import os
+import time
+from enum import Enum
+from typing import List, Tuple, Dict, Iterable
+
+from picture_comparator_muri.model.walker import DirectoryWalker
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # Optional dependency. Polling is used without it.
+    INotify = None
+
+
+class WatchEvent(Enum):
+    CHANGED = 1  # File was created, modified or moved into watched directory
+    REMOVED = 2  # File was removed or moved out of watched directory
+    DIRECTORY_REMOVED = 3
+
+
+Event = Tuple[WatchEvent, str]
+
+
+class Watcher(abc.ABC):
+    """
+    Reports changes of files in watched directories, made since it was created. Changes made before events are read
+    are kept until then.
+    """
+    def __init__(self, directories: Iterable[str], recursive: bool = True):
+        self.directories: List[str] = [os.path.abspath(d) for d in directories]
+        self.recursive: bool = recursive
+
+    @abc.abstractmethod
+    def events(self, timeout: float) -> List[Event]:
+        """Waits up to timeout seconds for changes. Each path is reported only once, with its latest event."""
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(Watcher):
+    MASK = 0
+    if INotify is not None:
+        MASK = flags.CLOSE_WRITE | flags.CREATE | flags.DELETE | flags.MOVED_FROM | flags.MOVED_TO | \
+               flags.DELETE_SELF
+    # Events keep coming while files are being copied, so they are gathered for a while before being reported.
+    SETTLE_TIME = 0.2
+
+    def __init__(self, directories: Iterable[str], recursive: bool = True):
+        super().__init__(directories, recursive)
+        self.inotify = INotify()
+        self.watches: Dict[int, str] = {}
+        for directory in self.directories:
+            self._add_watches(directory)
+
+    def _add_watches(self, directory: str):
+        stack = [directory]
+        while stack:
+            directory = stack.pop()
+            try:
+                self.watches[self.inotify.add_watch(directory, self.MASK)] = directory
+                if self.recursive:
+                    with os.scandir(directory) as entries:
+                        stack.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+            except OSError as e:  # Most likely limit of watches was reached
+                print(f'"{directory}": cannot be watched. {e}')
+
+    def _files_in(self, directory: str) -> List[Event]:
+        return [(WatchEvent.CHANGED, path) for path, _, _ in DirectoryWalker([directory], self.recursive)]
+
+    def _read(self, timeout: float) -> List[Event]:
+        events = []
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if event.mask & flags.Q_OVERFLOW:
+                # Events were dropped by the kernel, e.g. while they waited for the scan, so all files are checked.
+                for directory in self.directories:
+                    events.extend(self._files_in(directory))
+                continue
+            directory = self.watches.get(event.wd)
+            if directory is None:
+                continue
+            if event.mask & flags.IGNORED:
+                del self.watches[event.wd]
+                continue
+            if event.mask & flags.DELETE_SELF:
+                continue  # Reported by parent directory.
+            path = os.path.join(directory, event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO) and self.recursive:
+                    self._add_watches(path)
+                    # Files could appear before the watch was added.
+                    events.extend(self._files_in(path))
+                elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+                    events.append((WatchEvent.DIRECTORY_REMOVED, path))
+            elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                events.append((WatchEvent.CHANGED, path))
+            elif event.mask & flags.CREATE:
+                # Regular files are reported once they are closed, links don't get such event.
+                if os.path.islink(path):
+                    events.append((WatchEvent.CHANGED, path))
+            elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+                events.append((WatchEvent.REMOVED, path))
+        return events
+
+    def events(self, timeout: float) -> List[Event]:
+        events = self._read(timeout)
+        if events:
+            deadline = time.monotonic() + self.SETTLE_TIME
+            while time.monotonic() < deadline:
+                events.extend(self._read(self.SETTLE_TIME))
+        return _latest(events)
+
+    def close(self):
+        self.inotify.close()
+
+
+class PollingWatcher(Watcher):
+    """Fallback which lists watched directories periodically and compares their content."""
+    INTERVAL = 10.
+
+    def __init__(self, directories: Iterable[str], recursive: bool = True):
+        super().__init__(directories, recursive)
+        self.state: Dict[str, Tuple[int, int]] = self._list()
+        self._next_poll: float = time.monotonic() + self.INTERVAL
+
+    def _list(self) -> Dict[str, Tuple[int, int]]:
+        return {path: (stat.st_mtime_ns, stat.st_size)
+                for path, _, stat in DirectoryWalker(self.directories, self.recursive)}
+
+    def events(self, timeout: float) -> List[Event]:
+        wait = self._next_poll - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(wait, 0))
+        self._next_poll = time.monotonic() + self.INTERVAL
+        state = self._list()
+        events = [(WatchEvent.REMOVED, path) for path in self.state.keys() - state.keys()]
+        events.extend((WatchEvent.CHANGED, path) for path, value in state.items() if self.state.get(path) != value)
+        self.state = state
+        return events
+
+
+def _latest(events: List[Event]) -> List[Event]:
+    latest: Dict[str, WatchEvent] = {}
+    for event, path in events:
+        latest.pop(path, None)  # Keeps order of the last occurrence
+        latest[path] = event
+    return [(event, path) for path, event in latest.items()]
+
+
+def create_watcher(directories: Iterable[str], recursive: bool = True) -> Watcher:
+    if INotify is not None:
+        try:
+            return InotifyWatcher(directories, recursive)
+        except OSError as e:
+            print(f'inotify is not available, falling back to polling. {e}')
+    return PollingWatcher(directories, recursive)
@@ -1,8 +1,7 @@
-from PySide6.QtCore import QModelIndex
-from PySide6.QtWidgets import QFileSystemModel
+from PySide6.QtCore import QModelIndex, QAbstractItemModel
 
 
-def path_from_index(index: QModelIndex, model: QFileSystemModel = None):
+def path_from_index(index: QModelIndex, model: QAbstractItemModel = None):
     path = []
     while index.isValid():
         if model:
@@ -0,0 +1,60 @@
+import os
+from typing import List, Set, Tuple
+
+import numpy
+from PIL import Image, ImageDraw, ImageFilter
+
+from picture_comparator_muri.model.catalog import ImageCatalog
+from picture_comparator_muri.model.grouping import crop_pairs
+from picture_comparator_muri.model.hashing import compute_hash, pack_hash
+from picture_comparator_muri.model.neighbour_index import BlockIndex
+
+LOGOS = [
+    lambda draw: draw.ellipse((250, 180, 390, 300), fill=(200, 30, 30)),
+    lambda draw: draw.rectangle((220, 190, 380, 280), fill=(20, 60, 160)),
+    lambda draw: draw.polygon([(260, 300), (330, 180), (400, 300)], fill=(30, 140, 40)),
+    lambda draw: [draw.line((240, 170 + 18 * i, 390, 170 + 18 * i), fill=(90, 90, 90), width=6) for i in range(6)],
+    lambda draw: draw.arc((240, 160, 390, 310), 20, 300, fill=(150, 40, 150), width=12),
+    lambda draw: draw.rectangle((280, 220, 360, 250), outline=(0, 0, 0), width=4),
+]
+
+
+def save(directory, images: dict) -> List[str]:
+    paths = []
+    for name, image in images.items():
+        paths.append(str(directory / name))
+        image.save(paths[-1])
+    return paths
+
+
+def draw_logo(shape) -> Image.Image:
+    image = Image.new('RGB', (640, 480), 'white')
+    shape(ImageDraw.Draw(image))
+    return image
+
+
+def draw_photo() -> Image.Image:
+    noise = numpy.random.default_rng(1).integers(0, 256, (60, 80, 3), dtype=numpy.uint8)
+    return Image.fromarray(noise).resize((640, 480), Image.Resampling.BICUBIC).filter(ImageFilter.GaussianBlur(3))
+
+
+def crops_found(paths: List[str]) -> Set[Tuple[str, str]]:
+    catalog = ImageCatalog(blocks=True)
+    for path in paths:
+        result = compute_hash(path, path, blocks=True)
+        catalog.append(path, path, pack_hash(result.hash), os.stat(path), hashes=result.hashes)
+    rows = numpy.arange(len(paths))
+    first, second, _ = crop_pairs(catalog, BlockIndex().add(rows, catalog.rows['blocks'][rows]))
+    return {(os.path.basename(paths[a]), os.path.basename(paths[b])) for a, b in zip(first.tolist(), second.tolist())}
+
+
+def test_cropped_copy_is_found(tmp_path):
+    photo = draw_photo()
+    paths = save(tmp_path, {'photo.png': photo, 'photo_crop.png': photo.crop((64, 48, 640, 480))})
+    assert crops_found(paths) == {('photo.png', 'photo_crop.png')}
+
+
+def test_logos_on_plain_background_are_not_crops(tmp_path):
+    # Their white backgrounds match, but blocks showing only the background aren't compared.
+    paths = save(tmp_path, {f'logo{i}.png': draw_logo(shape) for i, shape in enumerate(LOGOS)})
+    assert crops_found(paths) == set()
@@ -0,0 +1,98 @@
+import os
+from collections import Counter
+
+import pytest
+
+from picture_comparator_muri.model import copies
+from picture_comparator_muri.model.copies import CopyFinder, PARTIAL_SIZE
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """Counts partial and full digests computed for each file."""
+    counts = {'partial': Counter(), 'full': Counter()}
+    partial_digest, full_digest = copies.partial_digest, copies.full_digest
+
+    def counted_partial(path, size):
+        counts['partial'][os.path.basename(path)] += 1
+        return partial_digest(path, size)
+
+    def counted_full(path):
+        counts['full'][os.path.basename(path)] += 1
+        return full_digest(path)
+
+    monkeypatch.setattr(copies, 'partial_digest', counted_partial)
+    monkeypatch.setattr(copies, 'full_digest', counted_full)
+    return counts
+
+
+def write(directory, name: str, content: bytes):
+    path = str(directory / name)
+    with open(path, 'wb') as file:
+        file.write(content)
+    return path, path, os.stat(path)
+
+
+def test_files_of_unique_sizes_are_not_read(tmp_path, reads):
+    finder = CopyFinder()
+    for i in range(1, 5):
+        assert finder.find_original(write(tmp_path, f'{i}', b'x' * i)) is None
+    assert not reads['partial'] and not reads['full']
+
+
+def test_small_copies_are_found_by_partial_digest(tmp_path, reads):
+    finder = CopyFinder()
+    original = write(tmp_path, 'original', b'a' * 100)
+    assert finder.find_original(original) is None
+    assert finder.find_original(write(tmp_path, 'other', b'b' * 100)) is None
+    assert finder.find_original(write(tmp_path, 'copy', b'a' * 100)) == original
+    # Partial digest covers whole small files, so they are never read again.
+    assert reads['partial'] == {'original': 1, 'other': 1, 'copy': 1}
+    assert not reads['full']
+
+
+def test_big_copies_are_found_by_full_digest(tmp_path, reads):
+    finder = CopyFinder()
+    size = 3 * PARTIAL_SIZE
+    original = write(tmp_path, 'original', b'a' * size)
+    assert finder.find_original(original) is None
+    # The same beginning and end, but different middle.
+    middle = write(tmp_path, 'middle', b'a' * PARTIAL_SIZE + b'b' * PARTIAL_SIZE + b'a' * PARTIAL_SIZE)
+    assert finder.find_original(middle) is None
+    assert finder.find_original(write(tmp_path, 'copy', b'a' * size)) == original
+    assert finder.find_original(write(tmp_path, 'copy2', b'a' * size)) == original
+    assert finder.find_original(write(tmp_path, 'copy3', b'a' * size + b'a')) is None  # Only one of its size
+    for name in ('original', 'middle', 'copy', 'copy2'):
+        assert reads['partial'][name] == 1
+        assert reads['full'][name] == 1
+    assert 'copy3' not in reads['partial']
+
+
+def test_added_files_are_read_only_when_another_one_has_their_size(tmp_path, reads):
+    finder = CopyFinder()
+    original = write(tmp_path, 'original', b'a' * 10)
+    finder.add(original)
+    finder.add(write(tmp_path, 'other', b'b' * 20))
+    assert not reads['partial']
+    assert finder.find_original(write(tmp_path, 'copy', b'a' * 10)) == original
+    assert reads['partial'] == {'original': 1, 'copy': 1}
+
+
+def test_unreadable_files_never_match(tmp_path):
+    finder = CopyFinder()
+    removed = write(tmp_path, 'removed', b'a' * 10)
+    finder.add(removed)
+    os.remove(removed[0])
+    copy = write(tmp_path, 'copy', b'a' * 10)
+    assert finder.find_original(copy) is None
+    assert finder.find_original(write(tmp_path, 'copy2', b'a' * 10)) == copy
+
+
+def test_cached_original(tmp_path):
+    finder = CopyFinder()
+    original = write(tmp_path, 'original', b'a' * 10)
+    finder.add(original)
+    copy = write(tmp_path, 'copy', b'a' * 10)
+    assert finder.cached_original(copy, (original[1], original[2].st_mtime_ns)) == original
+    assert finder.cached_original(copy, (original[1], original[2].st_mtime_ns + 1)) is None  # Original changed
+    assert finder.cached_original(copy, (str(tmp_path / 'unknown'), original[2].st_mtime_ns)) is None
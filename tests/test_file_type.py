@@ -0,0 +1,94 @@
+import io
+
+import pytest
+from PIL import Image
+
+from picture_comparator_muri.model.file_type import IMAGE, IMAGE_SIGNATURES, NOT_IMAGE, detect_format, sniff
+
+
+def encoded(format: str, **options) -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (16, 16), 'red').save(buffer, format, **options)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('signature, offset, format', IMAGE_SIGNATURES)
+def test_signatures(signature, offset, format):
+    assert sniff(b'\x00' * offset + signature + b'\x00' * 16) == format
+
+
+@pytest.mark.parametrize('pil_format, format', [
+    ('JPEG', 'JPEG'), ('PNG', 'PNG'), ('GIF', 'GIF'), ('BMP', 'BMP'), ('TIFF', 'TIFF'), ('ICO', 'ICO'),
+    ('WEBP', 'WEBP'), ('PPM', 'PPM')
+])
+def test_files_written_by_pil(pil_format, format):
+    assert sniff(encoded(pil_format)) == format
+
+
+@pytest.mark.parametrize('header, format', [
+    (b'RIFF\x24\x00\x00\x00WEBPVP8 ', 'WEBP'),
+    (b'RIFF\x24\x00\x00\x00WAVEfmt ', NOT_IMAGE),
+    (b'\x00\x00\x00\x18ftypheic\x00\x00\x00\x00', 'HEIF'),
+    (b'\x00\x00\x00\x18ftypmif1\x00\x00\x00\x00', 'HEIF'),
+    (b'\x00\x00\x00\x1cftypavif\x00\x00\x00\x00', 'AVIF'),
+    (b'\x00\x00\x00\x18ftypisom\x00\x00\x02\x00', NOT_IMAGE),
+    (b'P1\n2 2\n0 1\n1 0\n', 'PPM'),
+    (b'P5 2 2 255 ', 'PPM'),
+    (b'PK\x03\x04\x14\x00', NOT_IMAGE),
+    (b'%PDF-1.7\n', NOT_IMAGE),
+    (b'SQLite format 3\x00', NOT_IMAGE),
+    (b'hello world', None),
+])
+def test_containers_and_other_files(header, format):
+    assert sniff(header) == format
+
+
+@pytest.mark.parametrize('header, format', [
+    (b'', None),
+    (b'\x89PN', None),
+    (b'\xff\xd8', None),
+    (b'RIFF', NOT_IMAGE),
+    (b'RIFF\x24\x00\x00\x00WE', NOT_IMAGE),
+    (b'\x00\x00\x00\x18ftyp', NOT_IMAGE),
+    (b'P6', None),
+])
+def test_truncated_headers(header, format):
+    assert sniff(header) == format
+
+
+def detect(content: bytes, path: str):
+    file = io.BytesIO(content)
+    format = detect_format(file, path)
+    assert file.tell() == 0  # Rewound for PIL
+    return format
+
+
+def test_format_is_taken_from_content():
+    png = encoded('PNG')
+    assert detect(png, 'image.png') == 'PNG'
+    assert detect(png, 'image.jpg') == 'PNG'
+    assert detect(png, 'image') == 'PNG'
+    assert detect(png, 'image.unknown') == 'PNG'
+
+
+def test_non_image_extension_is_not_read():
+    assert detect(encoded('PNG'), 'image.txt') is None
+    assert detect(encoded('JPEG'), 'movie.mp4') is None
+
+
+def test_non_image_content_with_image_extension():
+    assert detect(b'PK\x03\x04\x14\x00' + b'\x00' * 32, 'archive.jpg') is None
+    assert detect(b'RIFF\x24\x00\x00\x00WAVEfmt ', 'sound.webp') is None
+
+
+def test_unknown_content_is_left_to_pil_by_image_extension():
+    assert detect(b'unknown format', 'image.jpg') == IMAGE
+    assert detect(b'', 'empty.png') == IMAGE
+    assert detect(b'\x89PN', 'truncated.png') == IMAGE
+
+
+def test_unknown_content_without_image_extension_is_checked_by_libmagic():
+    assert detect(b'', 'empty') is None
+    assert detect(b'\x89PN', 'truncated') is None
+    assert detect(b'hello world', 'notes') is None
+    assert detect(b'<svg xmlns="http://www.w3.org/2000/svg"></svg>', 'drawing') == 'image/svg+xml'
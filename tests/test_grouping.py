@@ -0,0 +1,112 @@
+from typing import List
+
+from picture_comparator_muri.controller.settings import Settings
+from picture_comparator_muri.main import create_parser
+from picture_comparator_muri.model.catalog import ImageCatalog
+from picture_comparator_muri.model.grouping import IncrementalGrouper, Change, GroupChange, SimilarityGraph
+from picture_comparator_muri.model.hash_cache import SnapshotStat
+from picture_comparator_muri.model.search_engine import SearchEngine, SearchThread
+
+# Hashes of images a to e. Groups {a, b} and {c, d} are 8 bits apart, e is within 4 bits of a and c, f only of a.
+HASHES = {
+    'a': 0,
+    'b': 1 << 40,
+    'c': 0xFF,
+    'd': 0xFF | 1 << 50,
+    'e': 0x0F,
+    'f': 1 << 60,
+    'g': 0xFFFF << 20,  # Not similar to any
+}
+
+
+def add_images(catalog: ImageCatalog, names: str) -> List[int]:
+    return [catalog.append(f'/images/{name}.png', f'/images/{name}.png', HASHES[name],
+                           SnapshotStat(100, 0, len(catalog) + 1, 1)) for name in names]
+
+
+def names(change: Change) -> str:
+    return ''.join(image.path[len('/images/')] for image in change.images)
+
+
+def group_names(groups) -> List[str]:
+    return sorted(''.join(image.path[len('/images/')] for image in group) for group in groups)
+
+
+def remove(grouper: IncrementalGrouper, catalog: ImageCatalog, name: str) -> List[Change]:
+    row = catalog.find(f'/images/{name}.png')
+    changes = grouper.remove(row)
+    catalog.remove(row)
+    return changes
+
+
+def test_groups_are_added_merged_and_removed():
+    catalog = ImageCatalog()
+    grouper = IncrementalGrouper(catalog, 4)
+
+    changes = grouper.add(add_images(catalog, 'abg'))
+    assert [(change.type, names(change)) for change in changes] == [(GroupChange.ADDED, 'ab')]
+    assert [(change.type, names(change)) for change in grouper.add(add_images(catalog, 'cd'))] == \
+           [(GroupChange.ADDED, 'cd')]
+    assert len(grouper.groups) == 2
+
+    # Image similar to both groups joins them.
+    changes = grouper.add(add_images(catalog, 'e'))
+    assert [(change.type, names(change)) for change in changes] == [(GroupChange.MERGED, 'abcde')]
+    merged = changes[0].merged
+    assert len(merged) == 1 and merged[0] is not changes[0].group
+    assert len(grouper.groups) == 1
+    group = changes[0].group
+
+    changes = grouper.add(add_images(catalog, 'f'))
+    assert [(change.type, change.group, names(change)) for change in changes] == \
+           [(GroupChange.CHANGED, group, 'abcdef')]
+
+    # Without the image linking them, the group splits again. The bigger part keeps the group.
+    changes = remove(grouper, catalog, 'e')
+    assert [(change.type, change.group is group, names(change)) for change in changes] == \
+           [(GroupChange.CHANGED, True, 'abf'), (GroupChange.ADDED, False, 'cd')]
+    second = changes[1].group
+
+    changes = remove(grouper, catalog, 'd')
+    assert [(change.type, change.group, change.images) for change in changes] == [(GroupChange.REMOVED, second, [])]
+    assert len(grouper.groups) == 1 and next(iter(grouper.groups.values())) is group
+    assert remove(grouper, catalog, 'g') == []  # Wasn't in any group
+
+
+def test_images_added_together_are_grouped_once():
+    catalog = ImageCatalog()
+    grouper = IncrementalGrouper(catalog, 4)
+    changes = grouper.add(add_images(catalog, 'abcdefg'))
+    assert [(change.type, names(change)) for change in changes] == [(GroupChange.ADDED, 'abcdef')]
+
+
+def test_regroup_with_another_distance():
+    catalog = ImageCatalog()
+    # Pairs are kept in the graph up to its maximum radius, so groups can be found again with a bigger distance.
+    grouper = IncrementalGrouper(catalog, 4, graph=SimilarityGraph(8))
+    assert group_names(change.group for change in grouper.add(add_images(catalog, 'abcd'))) == ['ab', 'cd']
+    assert group_names(grouper.regroup(8)) == ['abcd']
+    assert group_names(grouper.regroup(0)) == []
+    assert group_names(grouper.regroup(1)) == ['ab', 'cd']
+
+
+def test_search_engine_regroups_from_the_graph():
+    engine = SearchEngine(Settings(create_parser().parse_args(['--radius', '4', '--max-radius', '8'])))
+    regrouped = []
+    engine.Regrouped.connect(lambda groups: regrouped.append(group_names(group.images for group in groups)))
+    grouper = IncrementalGrouper(engine.catalog, 4, graph=engine.graph)
+    grouper.add(add_images(engine.catalog, 'abcdg'))
+    # While the search thread uses the graph, it regroups images itself, once it lets it go.
+    engine.search_thread = SearchThread(engine)
+    engine.regroup(8)
+    assert regrouped == []
+    engine.regroup(1)
+    engine.search_thread._release_graph()
+    assert regrouped == [['ab', 'cd']]
+    # Then images are regrouped directly, with the radius limited by the maximum one.
+    engine.regroup(20)
+    assert engine.settings.radius == 8
+    engine.regroup(0)
+    engine.regroup(4)
+    assert regrouped == [['ab', 'cd'], ['abcd'], [], ['ab', 'cd']]
+    assert group_names(group.images for group in engine.groups) == ['ab', 'cd']
@@ -0,0 +1,92 @@
+import sqlite3
+
+import pytest
+
+from picture_comparator_muri.model.hash_cache import DirectorySnapshot, HashCache, SnapshotStat
+from picture_comparator_muri.model.hashing import HashResult, unpack_hash
+
+HASH = unpack_hash(0x0123456789abcdef)
+STAT = SnapshotStat(1000, 5000, 7, 1)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'hashes.sqlite')
+
+
+def result(real_path: str = '/images/a.png', stat=STAT, hashes=None) -> HashResult:
+    result = HashResult(real_path, real_path, HASH)
+    result.hashes = hashes or {}
+    result.width, result.height, result.format = 640, 480, 'PNG'
+    result.stat = stat
+    return result
+
+
+def store(path: str, *results: HashResult, **options):
+    cache = HashCache(path, **options)
+    for r in results:
+        cache.add(r)
+    cache.close()
+
+
+def lookup(path: str, stat=STAT, real_path: str = '/images/a.png', **options):
+    cache = HashCache(path, **options)
+    try:
+        found, missing = cache.lookup([(real_path, real_path, stat)])
+    finally:
+        cache.close()
+    assert len(found) + len(missing) == 1
+    return found[0] if found else None
+
+
+def test_entry_is_used_while_file_is_the_same(path):
+    store(path, result(hashes={'phash': 42}))
+    found = lookup(path)
+    assert found.hash == HASH
+    assert found.hashes == {'whash': 0x0123456789abcdef, 'phash': 42}
+    assert (found.width, found.height, found.format) == (640, 480, 'PNG')
+    assert found.from_cache
+
+
+@pytest.mark.parametrize('stat', [SnapshotStat(1001, 5000, 7, 1), SnapshotStat(1000, 5001, 7, 1),
+                                  SnapshotStat(1000, 5000, 8, 1)], ids=['size', 'mtime', 'inode'])
+def test_entry_is_invalid_when_file_changed(path, stat):
+    store(path, result())
+    assert lookup(path, stat) is None
+    # New version replaces the old one.
+    store(path, result(stat=stat))
+    assert lookup(path, stat) is not None
+    assert lookup(path) is None
+
+
+def test_entry_needs_main_and_required_hashes(path):
+    store(path, result(hashes={'rotate90': 1}))
+    assert lookup(path, hash_kind='phash') is None
+    assert lookup(path, hash_kind='whash+full') is None
+    assert lookup(path, required=['rotate90']) is not None
+    assert lookup(path, required=['rotate90', 'block0']) is None
+
+
+def test_files_which_are_not_images_are_cached(path):
+    not_image = HashResult('/images/a.png', '/images/a.png')
+    not_image.stat = STAT
+    store(path, not_image)
+    found = lookup(path, hash_kind='phash')
+    assert found.hash is None and not found.is_image
+
+
+def test_other_schema_version_is_dropped(path):
+    store(path, result())
+    cache = HashCache(path)
+    cache.add_snapshot(DirectorySnapshot('/images', 5000))
+    cache.close()
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute(f'PRAGMA user_version = {HashCache.SCHEMA_VERSION - 1}')
+    connection.close()
+    assert lookup(path) is None
+    connection = sqlite3.connect(path)
+    assert connection.execute('PRAGMA user_version').fetchone()[0] == HashCache.SCHEMA_VERSION == 6
+    assert connection.execute('SELECT COUNT(*) FROM files').fetchone()[0] == 0
+    assert connection.execute('SELECT COUNT(*) FROM directories').fetchone()[0] == 0
+    connection.close()
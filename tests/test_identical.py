@@ -0,0 +1,60 @@
+import pytest
+from PIL import Image
+
+from picture_comparator_muri.model.hashing import SIZE_LIMIT, compute_pixel_digest
+from picture_comparator_muri.model.image_group import ImageGroup
+from picture_comparator_muri.model.image_info import ImageInfo
+
+
+@pytest.fixture(autouse=True)
+def no_decoding(monkeypatch):
+    """Images mustn't be decoded to compare them: big ones can't be and it would happen in the GUI thread."""
+    def qimage(self, size=None):
+        raise AssertionError(f'{self.path} was decoded')
+
+    monkeypatch.setattr(ImageInfo, 'qimage', qimage)
+
+
+def image(path: str, digest=None, dimensions=(8, 8), inode: int = 1) -> ImageInfo:
+    info = ImageInfo(path, path, 0)
+    info.pixel_digest = digest
+    info.dimensions = dimensions
+    info.set_file_info(100, 0, 1, inode)
+    return info
+
+
+def identical_groups(images):
+    group = ImageGroup()
+    group.add_images(images)
+    group.set_identical()
+    return [image.identical_group for image in group.images]
+
+
+def test_identical_by_digest():
+    a, b, c = image('a', 1 << 63 | 1, inode=1), image('b', 1 << 63 | 1, inode=2), image('c', 1 << 63 | 2, inode=3)
+    assert a.is_identical(b)
+    assert not a.is_identical(c)
+    assert identical_groups([a, b, c]) == [0, 0, None]
+
+
+def test_images_without_digest_are_not_identical(tmp_path):
+    # Images this big aren't decoded in full, neither for the digest nor by Qt.
+    width, height = 8192, SIZE_LIMIT // 8192
+    paths = []
+    for name, color in (('black.png', 0), ('white.png', 1)):
+        path = str(tmp_path / name)
+        Image.new('1', (width, height), color).save(path)
+        paths.append(path)
+        assert compute_pixel_digest(path) is None
+    a, b = (image(path, dimensions=(width, height), inode=inode) for inode, path in enumerate(paths))
+    assert not a.is_identical(b)
+    assert identical_groups([a, b]) == [None, None]
+
+
+def test_aliases_without_digest_are_identical():
+    original, other = image('a', inode=1), image('c', inode=3)
+    copy = image('b', inode=2)
+    copy.alias_of = original
+    assert original.is_identical(copy)
+    assert not original.is_identical(other)
+    assert identical_groups([original, copy, other]) == [0, 0, None]
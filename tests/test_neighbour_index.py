@@ -0,0 +1,161 @@
+from itertools import combinations
+
+import numpy
+import pytest
+
+from picture_comparator_muri.model import neighbour_index
+from picture_comparator_muri.model.catalog import MIN_BLOCK_BITS
+from picture_comparator_muri.model.hashing import BLOCKS
+from picture_comparator_muri.model.neighbour_index import HammingIndex, LiveHammingIndex, balltree_pairs, \
+    brute_force_pairs, similar_pairs, NeighbourIndex, BlockIndex
+
+
+def clustered_hashes(count: int = 300, seed: int = 0) -> numpy.ndarray:
+    """Random hashes with two copies of each, which differ by up to 23 bits, so pairs are found at every radius."""
+    random = numpy.random.default_rng(seed)
+    hashes = [int(value) for value in random.integers(0, (1 << 64) - 1, count // 3, numpy.uint64, endpoint=True)]
+    copies = [value ^ sum(1 << int(bit) for bit in random.choice(64, random.integers(0, 24), replace=False))
+              for _ in range(2) for value in hashes]
+    return numpy.array(hashes + copies, dtype=numpy.uint64)
+
+
+def expected_pairs(hashes: numpy.ndarray, radius: int) -> set:
+    return {(i, j) for i, j in combinations(range(len(hashes)), 2)
+            if bin(int(hashes[i]) ^ int(hashes[j])).count('1') <= radius}
+
+
+def as_set(pairs) -> set:
+    first, second = pairs
+    return {(min(a, b), max(a, b)) for a, b in zip(first.tolist(), second.tolist())}
+
+
+HASHES = clustered_hashes()
+
+
+@pytest.mark.parametrize('radius', range(0, 21))
+def test_hamming_index_finds_same_pairs_as_brute_force(radius):
+    expected = expected_pairs(HASHES, radius)
+    first, second = HammingIndex(HASHES, radius).pairs()
+    assert (first < second).all()
+    assert len(first) == len(expected)
+    assert as_set((first, second)) == expected
+
+
+@pytest.mark.parametrize('radius', [0, 3, 9, 20])
+def test_hamming_index_query(radius):
+    index = HammingIndex(HASHES[:200], radius)
+    queries = HASHES[200:]
+    expected = {(i, j) for i in range(len(queries)) for j in range(200)
+                if bin(int(queries[i]) ^ int(HASHES[j])).count('1') <= radius}
+    first, second = index.query(queries)
+    assert set(zip(first.tolist(), second.tolist())) == expected
+
+
+@pytest.mark.parametrize('radius', [0, 5, 9, 20])
+def test_live_hamming_index_finds_pairs_of_added_hashes(radius):
+    index = LiveHammingIndex(radius)
+    ids = numpy.arange(len(HASHES)) + 1000
+    found = []
+    # Batches of different sizes make segments merge.
+    for start, end in [(0, 10), (10, 11), (11, 50), (50, 51), (51, 200), (200, len(HASHES))]:
+        first, second = index.add(ids[start:end], HASHES[start:end])
+        found.extend(zip(first.tolist(), second.tolist()))
+    assert len(index) == len(HASHES)
+    expected = {(i + 1000, j + 1000) for i, j in expected_pairs(HASHES, radius)}
+    assert len(found) == len(expected)
+    assert {(min(a, b), max(a, b)) for a, b in found} == expected
+
+
+@pytest.mark.parametrize('radius', [0, 9, 20])
+def test_balltree_finds_same_pairs_as_brute_force(radius):
+    assert as_set(balltree_pairs(HASHES, radius)) == expected_pairs(HASHES, radius)
+
+
+@pytest.mark.parametrize('radius', [0, 9, 20])
+def test_brute_force_finds_all_pairs(radius, monkeypatch):
+    # Small blocks, so pairs are found across several blocks of rows and columns, by several threads.
+    monkeypatch.setattr(neighbour_index, 'BLOCK_ROWS', 32)
+    monkeypatch.setattr(neighbour_index, 'BLOCK_COLUMNS', 64)
+    first, second = brute_force_pairs(HASHES, radius, 4)
+    assert (first < second).all()
+    assert len(first) == len(expected_pairs(HASHES, radius))
+    assert as_set((first, second)) == expected_pairs(HASHES, radius)
+
+
+@pytest.mark.parametrize('method', list(NeighbourIndex))
+def test_all_methods_find_the_same_pairs(method):
+    assert as_set(similar_pairs(HASHES, 9, method, 2)) == expected_pairs(HASHES, 9)
+
+
+def test_empty_index():
+    first, second = HammingIndex(numpy.zeros(0, dtype=numpy.uint64), 5).pairs()
+    assert not len(first) and not len(second)
+    assert not len(LiveHammingIndex(5).query(HASHES)[0])
+    assert not len(brute_force_pairs(numpy.zeros(0, dtype=numpy.uint64), 5)[0])
+
+
+def block_hashes(count: int, seed: int = 0) -> numpy.ndarray:
+    """
+    Random hashes of blocks of images, in which each image after the first copies a few blocks of an earlier image,
+    at other positions.
+    """
+    random = numpy.random.default_rng(seed)
+    blocks = random.integers(0, (1 << 64) - 1, (count, len(BLOCKS)), numpy.uint64, endpoint=True)
+    for image in range(1, count):
+        other = random.integers(0, image)
+        shared = random.integers(0, 4)
+        blocks[image, random.choice(len(BLOCKS), shared, replace=False)] = \
+            blocks[other, random.choice(len(BLOCKS), shared, replace=False)]
+    return blocks
+
+
+def expected_block_pairs(index: BlockIndex, blocks: numpy.ndarray) -> set:
+    """Pairs of images in which at least min_shared blocks of the second one share a band with a block of the first."""
+    bits = [bin(int(value)).count('1') for value in blocks.flatten()]
+    informative = (numpy.array(bits) >= MIN_BLOCK_BITS).reshape(blocks.shape) & \
+        (numpy.array(bits) <= 64 - MIN_BLOCK_BITS).reshape(blocks.shape)
+
+    def bands(image: int, block: int) -> set:
+        if not informative[image, block]:
+            return set()
+        return {(band, int(blocks[image, block]) >> shift & mask)
+                for band, (shift, mask) in enumerate(zip(index.shifts, index.masks))}
+
+    pairs = set()
+    for first, second in combinations(range(len(blocks)), 2):
+        keys = set().union(*(bands(first, block) for block in range(len(BLOCKS))))
+        shared = sum(bool(bands(second, block) & keys) for block in range(len(BLOCKS)))
+        if shared >= index.min_shared:
+            pairs.add((first, second))
+    return pairs
+
+
+@pytest.mark.parametrize('min_shared', [1, 2, 3])
+def test_block_index_counts_shared_blocks(min_shared):
+    blocks = block_hashes(60)
+    index = BlockIndex(min_shared)
+    found = set()
+    for start, end in [(0, 1), (1, 10), (10, 11), (11, 40), (40, 60)]:
+        found |= as_set(index.add(numpy.arange(start, end), blocks[start:end]))
+    assert len(index) > 0
+    expected = expected_block_pairs(index, blocks)
+    assert len(expected) > 10
+    assert any(first + 1 < second for first, second in expected)  # Not only neighbours share blocks
+    assert found == expected
+
+
+def test_block_index_skips_plain_blocks():
+    blocks = block_hashes(2)
+    blocks[1] = blocks[0]
+    blocks[:, 2:] = 0xFF  # Plain blocks, which are the same in unrelated images
+    blocks[1, 1] = 0xFFFF0000FFFF0000  # Only one informative block is shared
+    assert not len(BlockIndex(2).add(numpy.arange(2), blocks)[0])
+
+
+def test_block_index_skips_common_keys():
+    random = numpy.random.default_rng(0)
+    blocks = random.integers(0, (1 << 64) - 1, (BlockIndex.MAX_POSTINGS + 2, len(BLOCKS)), numpy.uint64, endpoint=True)
+    blocks[:, :2] = blocks[0, :2]  # Blocks shared by too many images don't tell them apart
+    index = BlockIndex(2)
+    assert len(index.add(numpy.arange(10), blocks[:10])[0])  # Not too common yet
+    assert not len(index.add(numpy.arange(10, len(blocks)), blocks[10:])[0])
@@ -0,0 +1,128 @@
+import os
+import random
+import threading
+import time
+from typing import List
+
+import pytest
+from PIL import Image, ImageFilter
+
+from picture_comparator_muri.controller.settings import Settings
+from picture_comparator_muri.main import create_parser
+from picture_comparator_muri.model import search_engine, watcher
+from picture_comparator_muri.model.image_group import ImageGroup
+from picture_comparator_muri.model.pipeline import Marker, MarkerType
+from picture_comparator_muri.model.search_engine import SearchEngine, SearchThread
+from picture_comparator_muri.model.walker import DirectoryWalker
+
+
+def draw_photo(seed: int) -> Image.Image:
+    """Blurred noise, so hashes of different seeds differ a lot and ones of the same seed survive resaving."""
+    rng = random.Random(seed)
+    noise = Image.frombytes('RGB', (32, 24), bytes(rng.randrange(256) for _ in range(32 * 24 * 3)))
+    return noise.resize((320, 240), Image.Resampling.BICUBIC).filter(ImageFilter.GaussianBlur(4))
+
+
+@pytest.fixture
+def photos(tmp_path):
+    """Directory with 3 pairs of the same photo saved as PNG and JPEG, and one photo without a pair."""
+    directory = tmp_path / 'photos'
+    directory.mkdir()
+    for seed in range(3):
+        image = draw_photo(seed)
+        image.save(directory / f'{seed}.png')
+        image.save(directory / f'{seed}.jpg', quality=80)
+    draw_photo(3).save(directory / '3.png')
+    return directory
+
+
+class Search:
+    """Runs the search in the calling thread, with the cache kept in a temporary directory."""
+    def __init__(self, directory, *options: str):
+        self.settings = Settings(create_parser().parse_args(['-d', str(directory), '-w', '2', *options]))
+        self.engine = SearchEngine(self.settings)
+        self.results: List[List[ImageGroup]] = []
+        self.errors: List[str] = []
+        self.engine.ResultsReady.connect(self.results.append)
+        self.engine.SearchFailed.connect(self.errors.append)
+        self.thread = SearchThread(self.engine)
+
+    def run(self) -> List[List[str]]:
+        self.engine.search_thread = self.thread
+        self.thread.run()
+        assert not self.errors
+        assert len(self.results) == 1
+        return group_names(self.results[0])
+
+
+def group_names(groups: List[ImageGroup]) -> List[List[str]]:
+    return sorted(sorted(image.path.rsplit('/', 1)[1] for image in group.images) for group in groups)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+
+
+PAIRS = [['0.jpg', '0.png'], ['1.jpg', '1.png'], ['2.jpg', '2.png']]
+
+
+def test_finds_pairs(photos):
+    assert Search(photos).run() == PAIRS
+
+
+def test_main_hash_confirms_similarity(photos):
+    # Main hash is listed among confirmation hashes, so it is both a column of the catalog and an extra hash.
+    assert Search(photos, '--hash', 'whash', '--confirm', 'whash=5', 'phash=12').run() == PAIRS
+    # Second search takes all of them from the cache.
+    assert Search(photos, '--hash', 'whash', '--confirm', 'whash=5').run() == PAIRS
+
+
+def test_watch_reports_changes_made_during_scan(photos, monkeypatch):
+    monkeypatch.setattr(watcher.PollingWatcher, 'INTERVAL', .1)
+
+    class ChangingWalker(DirectoryWalker):
+        """Changes files in the directory once it was walked, but before the scan is finished."""
+        def __iter__(self):
+            yield from super().__iter__()
+            (photos / '0.png').unlink()
+            draw_photo(0).save(photos / '4.png')
+            draw_photo(5).save(photos / '1.png')
+
+    monkeypatch.setattr(search_engine, 'DirectoryWalker', ChangingWalker)
+    search = Search(photos, '--watch', '--no-cache')
+    thread = search.thread
+    walk = threading.Thread(target=thread._walk_stage)
+    walk.start()
+    found, changed, removed = set(), set(), set()
+    scan_finished = False
+    deadline = time.monotonic() + 10
+    try:
+        while (changed != {'1.png', '4.png'} or not removed) and time.monotonic() < deadline:
+            item = thread.found_files.get(.1)
+            if isinstance(item, Marker):
+                assert item.type in (MarkerType.SCAN_FINISHED, MarkerType.FILE_REMOVED)
+                scan_finished = scan_finished or item.type == MarkerType.SCAN_FINISHED
+                if item.type == MarkerType.FILE_REMOVED:
+                    removed.add(os.path.basename(item.path))
+            elif item is not None:
+                (changed if scan_finished else found).add(os.path.basename(item[0]))
+    finally:
+        thread.stop()
+        walk.join()
+    assert found >= {'0.png', '1.png', '2.png', '3.png'}
+    assert changed == {'1.png', '4.png'}
+    assert removed == {'0.png'}
+
+
+@pytest.mark.parametrize('options', [[], ['--confirm', 'phash=12', 'colorhash=6'],
+                                     ['--orientations', '--crops', '--verify-pixels', '0.5']])
+def test_second_search_takes_images_from_cache(photos, options):
+    first = Search(photos, *options)
+    assert first.run() == PAIRS
+    assert first.thread.hashed_count == 7
+    assert first.thread.decoded_again_count > 0
+    second = Search(photos, *options)
+    assert second.run() == PAIRS
+    assert second.thread.hashed_count == 0
+    assert second.thread.decoded_again_count == 0
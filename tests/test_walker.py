@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from picture_comparator_muri.model.hash_cache import HashCache
+from picture_comparator_muri.model.walker import DirectoryWalker
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = HashCache(str(tmp_path / 'hashes.sqlite'))
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'tree'
+    (root / 'sub').mkdir(parents=True)
+    for path in ('a.png', 'b.png', 'sub/c.png'):
+        (root / path).write_bytes(b'x' * 10)
+    os.symlink(root / 'a.png', root / 'sub' / 'link.png')
+    return root
+
+
+def walk(root, cache=None):
+    walker = DirectoryWalker([str(root)], cache=cache)
+    files = {os.path.relpath(path, root): (real_path, stat.st_size, stat.st_mtime_ns, stat.st_ino)
+             for path, real_path, stat in walker}
+    if cache:
+        cache.flush()
+    return files, walker.skipped_directories
+
+
+def test_unchanged_directories_are_restored(tree, cache):
+    full, _ = walk(tree)
+    assert sorted(full) == ['a.png', 'b.png', 'sub/c.png', 'sub/link.png']
+    assert full['sub/link.png'][0] == str(tree / 'a.png')
+    assert walk(tree, cache) == (full, 0)
+    assert walk(tree, cache) == (full, 2)
+
+
+def test_files_overwritten_in_place_are_noticed(tree, cache):
+    walk(tree, cache)
+    directory = os.stat(tree)
+    with open(tree / 'a.png', 'wb') as file:  # Like an image editor saving over the original
+        file.write(b'y' * 20)
+    os.utime(tree, ns=(directory.st_atime_ns, directory.st_mtime_ns))
+    files, skipped = walk(tree, cache)
+    assert skipped == 2
+    assert files == walk(tree)[0]
+    assert files['a.png'][1] == files['sub/link.png'][1] == 20
+
+
+def test_changed_directories_are_listed_again(tree, cache):
+    walk(tree, cache)
+    (tree / 'sub' / 'c.png').unlink()
+    (tree / 'sub' / 'd.png').write_bytes(b'z')
+    files, skipped = walk(tree, cache)
+    assert skipped == 1
+    assert files == walk(tree)[0]
+    assert 'sub/d.png' in files and 'sub/c.png' not in files